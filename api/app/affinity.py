@@ -0,0 +1,159 @@
+import asyncio
+import json
+import os
+from functools import wraps
+from logging import Logger
+
+from aio_pika import ExchangeType
+from aio_pika.abc import AbstractChannel, AbstractIncomingMessage
+from aioredis.client import Redis
+from app.constants import GAME_IDLE_TIMEOUT, SESSION_AFFINITY, WORKER_EXCHANGE
+from app.game_registry import GameRegistry
+from app.rmq import RMQConnectionManager
+
+
+class AffinityConfig:
+    HEARTBEAT_INTERVAL = 10  # seconds between worker liveness (and pin expiry) refreshes
+    HEARTBEAT_TTL = 30  # seconds after which a worker that stopped refreshing is considered gone
+
+
+class WorkerRouter:
+    """
+    Session affinity: pins each game, and both of its players, to the worker the game was created on
+
+    Socket.IO connections stay on whichever worker accepted them, but game events are handled on the game's worker,
+    where both players' registry entries, queues and cached game state live. Events received on another worker are
+    forwarded to it over RabbitMQ; replies reach the client through the Redis-backed Socket.IO manager. Pins whose
+    worker has gone away are ignored (the event is handled locally and the game re-pinned).
+
+    Without SESSION_AFFINITY, handlers run locally as before. Every worker keeps its liveness key fresh either way (it
+    is also used to find the games of workers that went away, see GameController.adopt_clocks).
+    """
+
+    # KEYS: pin. ARGV: key prefix of live workers. Returns the pinned worker if it is alive
+    LOOKUP_SCRIPT = """
+    local worker = redis.call("GET", KEYS[1])
+    if worker and redis.call("EXISTS", ARGV[1] .. worker) == 1 then
+        return worker
+    end
+    return false
+    """
+
+    def __init__(self, redis_client: Redis, rmq: RMQConnectionManager, gr: GameRegistry, logger: Logger):
+        self.redis_client = redis_client
+        self.rmq = rmq
+        self.gr = gr
+        self.logger = logger
+        self.lookup_script = redis_client.register_script(self.LOOKUP_SCRIPT)
+        self.worker_id = gr.worker_id
+        self.handlers = {}  # event -> handler, for events forwarded to this worker
+        self.pinned = {}  # sid -> gid, players pinned to this worker
+        self.heartbeat = None
+        if SESSION_AFFINITY:
+            rmq.add_on_channel_open_callback(self.init_listener)
+
+    @staticmethod
+    def get_player_pin_key(sid):
+        return f"worker:player:{sid}"
+
+    @staticmethod
+    def get_game_pin_key(gid):
+        return f"worker:game:{gid}"
+
+    @staticmethod
+    def get_alive_key(worker_id=""):
+        return f"worker:alive:{worker_id}"
+
+    async def init_listener(self, channel: AbstractChannel):
+        """Declare the worker exchange and this worker's exclusive queue, and consume events forwarded to it"""
+        self.logger.info("Initialising forwarding listener on worker ID " + str(os.getpid()))
+
+        async def on_message(message: AbstractIncomingMessage):
+            data = json.loads(message.body)
+            handler = self.handlers.get(data["event"])
+            if handler is None:
+                self.logger.error(f"No handler for forwarded event {data['event']}")
+                return
+            await handler(data["sid"], *data["args"])
+
+        exchange = await channel.declare_exchange(WORKER_EXCHANGE, ExchangeType.DIRECT)
+        queue = await channel.declare_queue(exclusive=True)
+        await queue.bind(exchange, routing_key=self.worker_id)
+        await queue.consume(on_message, no_ack=True)
+
+    async def get_worker(self, key):
+        worker = await self.lookup_script(keys=[key], args=[self.get_alive_key()])
+        return worker.decode() if worker else None
+
+    def forward(self, worker_id, event, sid, args):
+        body = json.dumps({"event": event, "sid": sid, "args": list(args)}).encode()
+        self.rmq.publish(WORKER_EXCHANGE, worker_id, body)
+
+    async def sync_pins(self, sid):
+        """Pin a player (and their game) to this worker when they enter a game here, unpin when they leave it"""
+        gid, pinned_gid = self.gr.get_gid(sid), self.pinned.get(sid)
+        if gid == pinned_gid:
+            return
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            if pinned_gid is not None:
+                del self.pinned[sid]
+                pipe.delete(self.get_player_pin_key(sid))
+                if not self.gr.get_players(pinned_gid):  # last player of the game on this worker
+                    pipe.delete(self.get_game_pin_key(pinned_gid))
+            if gid is not None:
+                self.pinned[sid] = gid
+                pipe.set(self.get_player_pin_key(sid), self.worker_id, ex=GAME_IDLE_TIMEOUT)
+                pipe.set(self.get_game_pin_key(gid), self.worker_id, ex=GAME_IDLE_TIMEOUT)
+            await pipe.execute()
+
+    def route(self, event, by_gid=False):
+        """
+        Produces a wrapper that runs an SIO event handler on the worker the player's game is pinned to (or, with by_gid,
+        the game given as the first argument), forwarding the event there if that is another worker
+        """
+
+        def decorator(handler):
+            self.handlers[event] = handler
+            if not SESSION_AFFINITY:
+                return handler
+
+            @wraps(handler)
+            async def wrapper(sid, *args):
+                worker_id = None
+                if by_gid and args:
+                    worker_id = await self.get_worker(self.get_game_pin_key(args[0]))
+                elif self.gr.get_gid(sid) is None:  # player's game (if any) is on another worker
+                    worker_id = await self.get_worker(self.get_player_pin_key(sid))
+                if worker_id is not None and worker_id != self.worker_id:
+                    self.forward(worker_id, event, sid, args)
+                    return
+                try:
+                    return await handler(sid, *args)
+                finally:
+                    await self.sync_pins(sid)
+
+            self.handlers[event] = wrapper  # forwarded events may still need their pins updated
+            return wrapper
+
+        return decorator
+
+    async def run_heartbeat(self):
+        while True:
+            try:
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    pipe.set(self.get_alive_key(self.worker_id), 1, ex=AffinityConfig.HEARTBEAT_TTL)
+                    for sid, gid in self.pinned.items():
+                        pipe.expire(self.get_player_pin_key(sid), GAME_IDLE_TIMEOUT)
+                        pipe.expire(self.get_game_pin_key(gid), GAME_IDLE_TIMEOUT)
+                    await pipe.execute()
+            except Exception as exc:
+                self.logger.error(f"Worker heartbeat failed: {exc}")
+            await asyncio.sleep(AffinityConfig.HEARTBEAT_INTERVAL)
+
+    def start(self):
+        self.heartbeat = asyncio.create_task(self.run_heartbeat())
+
+    async def stop(self):
+        if self.heartbeat:
+            self.heartbeat.cancel()
+            await self.redis_client.delete(self.get_alive_key(self.worker_id))
@@ -0,0 +1,218 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+from logging import Logger
+from time import time
+
+import aiosqlite
+import chess.pgn
+from app.constants import ARCHIVE_DB_PATH
+from app.models import Game, Outcome
+from chess import Termination
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import StreamingResponse
+
+router = APIRouter(prefix="/archive", tags=["archive"])
+
+
+class ArchiveConfig:
+    MAX_QUEUED = 10000  # rounds awaiting a write on this worker (further rounds are dropped)
+    BATCH_SIZE = 200  # max rounds written per transaction
+    FLUSH_INTERVAL = 1  # seconds the writer waits for more rounds before writing a batch
+    BUSY_TIMEOUT = 5000  # milliseconds to wait for another worker's write lock on the database
+    PAGE_SIZE = 50  # default number of rounds per page
+    MAX_PAGE_SIZE = 500
+
+
+class MatchArchive:
+    """
+    Append-only archive of completed rounds (PGN and match metadata) in SQLite, shared by all workers on the host
+
+    Rounds are queued in memory and written in batches by a background writer, so game handlers never wait on disk.
+    Rounds still queued when a worker is killed (rather than shut down) are lost.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS rounds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        gid TEXT NOT NULL,
+        round INTEGER NOT NULL,
+        n_rounds INTEGER NOT NULL,
+        white TEXT,
+        black TEXT,
+        wager REAL NOT NULL,
+        time_control INTEGER NOT NULL,
+        outcome INTEGER NOT NULL,
+        result TEXT NOT NULL,
+        time_remaining_white REAL NOT NULL,
+        time_remaining_black REAL NOT NULL,
+        finished_at REAL NOT NULL,
+        pgn TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS rounds_gid ON rounds (gid);
+    CREATE INDEX IF NOT EXISTS rounds_white ON rounds (white);
+    CREATE INDEX IF NOT EXISTS rounds_black ON rounds (black);
+    """
+
+    INSERT = """
+    INSERT INTO rounds (
+        gid, round, n_rounds, white, black, wager, time_control, outcome, result,
+        time_remaining_white, time_remaining_black, finished_at, pgn
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+
+    COLUMNS = (
+        "id, gid, round, n_rounds, white, black, wager, time_control, outcome, result, "
+        "time_remaining_white, time_remaining_black, finished_at"
+    )
+
+    def __init__(self, logger: Logger, path=ARCHIVE_DB_PATH):
+        self.logger = logger
+        self.path = path
+        self.db = None
+        self.queue = asyncio.Queue(ArchiveConfig.MAX_QUEUED)
+        self.writer = None
+
+    async def _connect(self):
+        db = await aiosqlite.connect(self.path)
+        await db.execute(f"PRAGMA busy_timeout = {ArchiveConfig.BUSY_TIMEOUT}")
+        return db
+
+    async def start(self):
+        self.db = await self._connect()
+        await self.db.execute("PRAGMA journal_mode = WAL")  # readers don't block the writers (or each other)
+        await self.db.executescript(self.SCHEMA)
+        await self.db.commit()
+        self.writer = asyncio.create_task(self._write())
+
+    async def stop(self):
+        """Write out the rounds still queued and close the database"""
+        if self.writer:
+            self.writer.cancel()
+        rounds = []
+        while not self.queue.empty():
+            rounds.append(self.queue.get_nowait())
+        if self.db:
+            await self._write_batch(rounds)
+            await self.db.close()
+
+    def record(self, gid: str, game: Game, outcome: int, winner_ind: int | None):
+        """Queue a completed round (winner_ind indexes game.players, None for a draw) for writing"""
+        black, white = (game.player_wallet_addrs.get(sid) for sid in game.players)
+        if winner_ind is None:
+            result = "1/2-1/2"
+        else:
+            result = "1-0" if winner_ind == 1 else "0-1"
+        row = (
+            gid,
+            game.round,
+            game.n_rounds,
+            white and white.lower(),
+            black and black.lower(),
+            game.wager,
+            game.time_control,
+            outcome,
+            result,
+            game.tr_w,
+            game.tr_b,
+            time(),
+        )
+        try:
+            self.queue.put_nowait((row, game.board.copy()))  # the PGN is generated by the writer
+        except asyncio.QueueFull:
+            self.logger.error(f"Archive queue full, dropping round {game.round} of game {gid}")
+
+    async def _write(self):
+        while True:
+            rounds = [await self.queue.get()]
+            await asyncio.sleep(ArchiveConfig.FLUSH_INTERVAL)
+            while len(rounds) < ArchiveConfig.BATCH_SIZE and not self.queue.empty():
+                rounds.append(self.queue.get_nowait())
+            await self._write_batch(rounds)
+
+    async def _write_batch(self, rounds):
+        if not rounds:
+            return
+        try:
+            await self.db.executemany(self.INSERT, [(*row, self._pgn(row, board)) for row, board in rounds])
+            await self.db.commit()
+        except Exception as exc:
+            self.logger.error(f"Failed to archive {len(rounds)} rounds: {exc}")
+
+    @staticmethod
+    def _pgn(row, board):
+        gid, round, _, white, black, wager, time_control, outcome, result, tr_w, tr_b, finished_at = row
+        pgn = chess.pgn.Game.from_board(board)
+        pgn.headers["Event"] = f"Dechecs match {gid}"
+        pgn.headers["Site"] = "https://dechecs.netlify.app"
+        pgn.headers["Date"] = datetime.fromtimestamp(finished_at, timezone.utc).strftime("%Y.%m.%d")
+        pgn.headers["Round"] = str(round)
+        pgn.headers["White"] = white or "?"
+        pgn.headers["Black"] = black or "?"
+        pgn.headers["Result"] = result
+        pgn.headers["TimeControl"] = str(time_control * 60)
+        pgn.headers["Termination"] = outcome_name(outcome)
+        pgn.headers["WhiteClock"] = f"{max(tr_w, 0) / 1000:.1f}"
+        pgn.headers["BlackClock"] = f"{max(tr_b, 0) / 1000:.1f}"
+        pgn.headers["Wager"] = str(wager)
+        return str(pgn)
+
+    async def read_rounds(self, after: int, limit: int, gid: str | None = None, wallet: str | None = None, pgn=False):
+        """Rounds with IDs after the given one (oldest first), as dicts, fetched from disk as they are iterated over"""
+        conditions, params = ["id > ?"], [after]
+        if gid:
+            conditions.append("gid = ?")
+            params.append(gid)
+        if wallet:
+            conditions.append("(white = ? OR black = ?)")
+            params += [wallet.lower(), wallet.lower()]
+        columns = self.COLUMNS + (", pgn" if pgn else "")
+        query = f"SELECT {columns} FROM rounds WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?"
+        db = await self._connect()
+        try:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(query, (*params, limit)) as cursor:
+                async for row in cursor:
+                    yield dict(row)
+        finally:
+            await db.close()
+
+
+def outcome_name(outcome: int):
+    """Name of an outcome code sent to clients (python-chess termination or Outcome value)"""
+    for enum in (Termination, Outcome):
+        try:
+            return enum(outcome).name.lower()
+        except ValueError:
+            continue
+    return "unknown"
+
+
+@router.get("/rounds")
+async def get_rounds(
+    request: Request,
+    after: int = 0,
+    limit: int = Query(ArchiveConfig.PAGE_SIZE, ge=1, le=ArchiveConfig.MAX_PAGE_SIZE),
+    gid: str | None = None,
+    wallet: str | None = None,
+    pgn: bool = False,
+):
+    """
+    Archived rounds, oldest first, as newline delimited JSON (streamed)
+
+    Pages are keyed by round ID: pass the ID of the last round received as `after` to get the next page. Filter by
+    game ID and/or wallet address (either colour), and set `pgn` to include each round's PGN.
+    """
+    rounds = request.app.state.archive.read_rounds(after, limit, gid, wallet, pgn)
+    return StreamingResponse((json.dumps(r) + "\n" async for r in rounds), media_type="application/x-ndjson")
+
+
+@router.get("/games/{gid}/pgn")
+async def get_game_pgn(request: Request, gid: str):
+    """All archived rounds of a match, as a PGN file (streamed)"""
+    rounds = request.app.state.archive.read_rounds(0, ArchiveConfig.MAX_PAGE_SIZE, gid, pgn=True)
+    return StreamingResponse(
+        (r["pgn"] + "\n\n" async for r in rounds),
+        media_type="application/x-chess-pgn",
+        headers={"Content-Disposition": f'attachment; filename="{gid}.pgn"'},
+    )
@@ -0,0 +1,79 @@
+import asyncio
+import heapq
+from logging import Logger
+from time import time_ns
+
+import app.utils as utils
+from app.models import Game
+
+
+class ClockConfig:
+    TICK_INTERVAL = 0.1  # seconds between checks for expired clocks
+    MIN_COMPACT_SIZE = 64  # heap size under which stale entries are left to be discarded lazily
+
+
+class GameClock:
+    """
+    Server-side game clock
+
+    Keeps a min-heap of flag deadlines (epoch ms at which the player to move runs out of time) for the live games on
+    this worker, and fires a timeout callback when one passes. Re-arming a game just pushes a new entry; entries that
+    no longer match a game's current deadline are discarded lazily when they reach the top of the heap, or all at once
+    when they outnumber the armed games.
+    """
+
+    def __init__(self, logger: Logger):
+        self.deadlines = []  # heap of (deadline, gid)
+        self.armed = {}  # gid -> current deadline
+        self.on_timeout = None
+        self.ticker = None
+        self.timeouts = set()  # timeout callbacks running (referenced until done)
+        self.logger = logger
+
+    def arm(self, gid: str, game: Game):
+        """(Re)arm the clock of a game from its current state, or disarm it if no clock is running"""
+        if game.finished or game.round_over or len(game.players) < 2:
+            self.disarm(gid)
+            return
+        deadline = game.turn_start_time + utils.time_remaining(game)
+        self.armed[gid] = deadline
+        heapq.heappush(self.deadlines, (deadline, gid))
+        self._compact()
+
+    def disarm(self, gid: str):
+        self.armed.pop(gid, None)
+        self._compact()
+
+    def _compact(self):
+        """Rebuild the heap from the armed deadlines once most of its entries are stale"""
+        if len(self.deadlines) > max(ClockConfig.MIN_COMPACT_SIZE, 2 * len(self.armed)):
+            self.deadlines = [(deadline, gid) for gid, deadline in self.armed.items()]
+            heapq.heapify(self.deadlines)
+
+    async def tick(self):
+        while True:
+            await asyncio.sleep(ClockConfig.TICK_INTERVAL)
+            now = time_ns() / 1_000_000
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, gid = heapq.heappop(self.deadlines)
+                if self.armed.get(gid) != deadline:
+                    continue  # stale entry
+                del self.armed[gid]
+                task = asyncio.create_task(self.on_timeout(gid))
+                self.timeouts.add(task)
+                task.add_done_callback(self.timeouts.discard)
+
+    def start(self, on_timeout):
+        """
+        Start the ticker
+
+        :param on_timeout: coroutine function called with the game ID when a game's clock runs out
+        """
+        self.on_timeout = on_timeout
+        self.ticker = asyncio.create_task(self.tick())
+
+    def stop(self):
+        if self.ticker:
+            self.ticker.cancel()
+        self.deadlines.clear()
+        self.armed.clear()
@@ -0,0 +1,150 @@
+import json
+import struct
+
+from app.models import Game
+from chess import STARTING_FEN, Board, Move
+
+# Binary game state layout (little endian):
+#   header   version, tr_w, tr_b, turn_start_time, wager, time_control, round, n_rounds, flags (finished, round over)
+#   players  count followed by length-prefixed sids
+#   wallets  count followed by (sid, wallet address) pairs
+#   score    count followed by (sid, score) pairs
+#   board    length-prefixed starting FEN (empty for the standard position), move count, packed moves
+#
+# Strings are at most 255 bytes, time control, round and number of rounds at most 65535 (client-supplied values are
+# checked by GameController before they get here).
+# Moves are packed into 16 bits: from square (6), to square (6), promotion piece type (3).
+# Keeping the move list (rather than just the FEN) means repetition draws can be claimed after a reload.
+
+CODEC_VERSION = 2
+SUPPORTED_CODEC_VERSIONS = (1, 2)  # v1 had a bool in place of the flags byte, so is read identically
+
+FLAG_FINISHED = 1
+FLAG_ROUND_OVER = 2
+
+_HEADER = struct.Struct("<BddddHHHB")
+_COUNT = struct.Struct("<H")
+_STR_LEN = struct.Struct("<B")
+_FEN_LEN = struct.Struct("<H")
+_SCORE = struct.Struct("<d")
+_MOVE = struct.Struct("<H")
+
+
+def _pack_str(s: str):
+    b = s.encode()
+    return _STR_LEN.pack(len(b)) + b
+
+
+def _unpack_str(buf: bytes, offset: int):
+    (n,) = _STR_LEN.unpack_from(buf, offset)
+    offset += _STR_LEN.size
+    return buf[offset : offset + n].decode(), offset + n
+
+
+def _pack_move(move: Move):
+    return _MOVE.pack(move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12))
+
+
+def _unpack_move(packed: int):
+    return Move(packed & 0x3F, (packed >> 6) & 0x3F, (packed >> 12) or None)
+
+
+def encode_game(game: Game):
+    """Encode game state to compact binary representation"""
+    board = game.board
+    root_fen = board.root().fen() if board.move_stack else board.fen()
+    if root_fen == STARTING_FEN:
+        root_fen = ""
+    root_fen = root_fen.encode()
+
+    parts = [
+        _HEADER.pack(
+            CODEC_VERSION,
+            game.tr_w,
+            game.tr_b,
+            game.turn_start_time,
+            game.wager,
+            game.time_control,
+            game.round,
+            game.n_rounds,
+            (FLAG_FINISHED if game.finished else 0) | (FLAG_ROUND_OVER if game.round_over else 0),
+        ),
+        _COUNT.pack(len(game.players)),
+    ]
+    parts.extend(_pack_str(sid) for sid in game.players)
+    parts.append(_COUNT.pack(len(game.player_wallet_addrs)))
+    for sid, addr in game.player_wallet_addrs.items():
+        parts.append(_pack_str(sid))
+        parts.append(_pack_str(addr))
+    parts.append(_COUNT.pack(len(game.match_score)))
+    for sid, score in game.match_score.items():
+        parts.append(_pack_str(sid))
+        parts.append(_SCORE.pack(score))
+    parts.append(_FEN_LEN.pack(len(root_fen)))
+    parts.append(root_fen)
+    parts.append(_COUNT.pack(len(board.move_stack)))
+    parts.extend(_pack_move(m) for m in board.move_stack)
+    return b"".join(parts)
+
+
+def decode_game(buf: bytes):
+    """Decode game state from compact binary representation"""
+    version, tr_w, tr_b, turn_start_time, wager, time_control, rnd, n_rounds, flags = _HEADER.unpack_from(buf, 0)
+    if version not in SUPPORTED_CODEC_VERSIONS:
+        raise ValueError(f"Unsupported game state codec version: {version}")
+    offset = _HEADER.size
+
+    (n,) = _COUNT.unpack_from(buf, offset)
+    offset += _COUNT.size
+    players = []
+    for _ in range(n):
+        sid, offset = _unpack_str(buf, offset)
+        players.append(sid)
+
+    (n,) = _COUNT.unpack_from(buf, offset)
+    offset += _COUNT.size
+    wallet_addrs = {}
+    for _ in range(n):
+        sid, offset = _unpack_str(buf, offset)
+        wallet_addrs[sid], offset = _unpack_str(buf, offset)
+
+    (n,) = _COUNT.unpack_from(buf, offset)
+    offset += _COUNT.size
+    match_score = {}
+    for _ in range(n):
+        sid, offset = _unpack_str(buf, offset)
+        (match_score[sid],) = _SCORE.unpack_from(buf, offset)
+        offset += _SCORE.size
+
+    (n,) = _FEN_LEN.unpack_from(buf, offset)
+    offset += _FEN_LEN.size
+    board = Board(buf[offset : offset + n].decode() or STARTING_FEN)
+    offset += n
+
+    (n,) = _COUNT.unpack_from(buf, offset)
+    offset += _COUNT.size
+    for (packed,) in _MOVE.iter_unpack(buf[offset : offset + n * _MOVE.size]):
+        board.push(_unpack_move(packed))
+
+    return Game(
+        players=players,
+        board=board,
+        tr_w=tr_w,
+        tr_b=tr_b,
+        turn_start_time=turn_start_time,
+        time_control=time_control,
+        wager=wager,
+        player_wallet_addrs=wallet_addrs,
+        match_score=match_score,
+        round=rnd,
+        n_rounds=n_rounds,
+        finished=bool(flags & FLAG_FINISHED),
+        round_over=bool(flags & FLAG_ROUND_OVER),
+    )
+
+
+def decode_legacy_game(game: str | bytes):
+    """Decode game state stored in the legacy JSON + FEN format"""
+    game_dict = json.loads(game)
+    game_dict["board"] = Board(game_dict["board"])
+    return Game(**game_dict)
@@ -10,8 +10,37 @@ class TimeConstants:
     MILLISECONDS_PER_MINUTE = 60000
 
 
+class RoutingMode:
+    PER_PLAYER = "per_player"  # topic exchange per game, queue and consumer per player
+    SHARED = "shared"  # single shared exchange, one exclusive queue and consumer per worker
+
+
+class EventBusBackend:
+    RABBITMQ = "rabbitmq"
+    REDIS = "redis"  # Redis pub/sub
+    MEMORY = "memory"  # in process, single worker only
+
+
 MAX_EMIT_RETRIES = 5
+MAX_UPDATE_RETRIES = 5
 BROADCAST_KEY = "all"
+SPECTATOR_KEY = "spectators"  # routing key of game events only sent to spectators (e.g. round starts)
+SHARED_EXCHANGE = "games"  # exchange used in shared routing mode, routing keys are "{gid}.{sid or BROADCAST_KEY}"
+LOBBY_KEY = "lobby"  # prefix of the sorted sets indexing open games, and channel of lobby changes
+ACTIVE_GAMES_KEY = "active_games"  # sorted set of game IDs in progress, scored by last activity time
+GAME_IDLE_TIMEOUT = 3600  # seconds without a save after which a game no longer counts as in progress (and is reaped)
+GAME_KEY_TTL = 2 * GAME_IDLE_TIMEOUT  # expiry of a game's Redis keys, refreshed on every save (backstop for the reaper)
+REAPER_LOCK_KEY = "reaper:lock"  # held by the worker reaping idle games, for one pass
+SETTLEMENT_QUEUE_KEY = "settlement:queue"  # list of pending on-chain settlement jobs
+SETTLEMENT_INFLIGHT_KEY = "settlement:inflight"  # hash of game ID -> sent settlement transaction awaiting a receipt
+SETTLEMENT_FAILED_KEY = "settlement:failed"  # list of settlement jobs that could not be sent
+SETTLEMENT_LOCK_KEY = "settlement:signer"  # held by the single worker that signs settlement transactions
+WORKER_EXCHANGE = "workers"  # direct exchange used to forward events between workers (session affinity), keyed by worker ID
+ROUND_BREAK = 20  # seconds between the end of a round and the start of the next
+DELAYED_JOBS_KEY = "jobs:delayed"  # sorted set of scheduled jobs, scored by due time
+JOB_ATTEMPTS_KEY = "jobs:attempts"  # hash of scheduled job -> number of times it has been claimed
+DEAD_JOBS_KEY = "jobs:dead"  # list of scheduled jobs that failed too many times
+REDIS_BATCH_SIZE = 500  # number of games read or cleared per Redis round trip in bulk operations
 
 REDIS_URL = os.environ.get("REDIS_URL")
 ALCHEMY_API_URL = os.environ.get("ALCHEMY_API_URL")
@@ -19,3 +48,14 @@ CLOUDAMQP_URL = os.environ.get("CLOUDAMQP_URL")
 SC_ADDRESS = os.environ.get("SC_ADDRESS")
 WALLET_PK = os.environ.get("WALLET_PK")
 CMC_API_KEY = os.environ.get("CMC_API_KEY")
+CMC_API_URL = os.environ.get("CMC_API_URL", "https://pro-api.coinmarketcap.com/v2/cryptocurrency/quotes/latest")
+RMQ_ROUTING_MODE = os.environ.get("RMQ_ROUTING_MODE", RoutingMode.PER_PLAYER)
+RMQ_PUBLISHER_CONFIRMS = os.environ.get("RMQ_PUBLISHER_CONFIRMS", "false").lower() == "true"
+EVENT_BUS = os.environ.get("EVENT_BUS", EventBusBackend.RABBITMQ)
+EVENT_BUS_LOCAL_FAST_PATH = os.environ.get("EVENT_BUS_LOCAL_FAST_PATH", "true").lower() == "true"
+SIO_BATCH_EVENTS = os.environ.get("SIO_BATCH_EVENTS", "false").lower() == "true"
+SESSION_AFFINITY = os.environ.get("SESSION_AFFINITY", "false").lower() == "true"
+RESUMABLE_SESSIONS = os.environ.get("RESUMABLE_SESSIONS", "false").lower() == "true"
+RESUME_SECRET = os.environ.get("RESUME_SECRET")
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", 1))  # proxies in front of the server appending to X-Forwarded-For
+ARCHIVE_DB_PATH = os.environ.get("ARCHIVE_DB_PATH", "archive.db")
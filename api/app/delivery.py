@@ -0,0 +1,101 @@
+import asyncio
+import random
+from collections import deque
+from logging import Logger
+
+import app.metrics as metrics
+from app.constants import MAX_EMIT_RETRIES, SIO_BATCH_EVENTS
+from app.models import Event
+from socketio.asyncio_server import AsyncServer
+
+
+class DeliveryConfig:
+    MAX_QUEUED = 10000  # events awaiting delivery on this worker, across all clients (further events are dropped)
+    BACKOFF_INITIAL = 0.05  # seconds before the first retry, doubling up to BACKOFF_MAX (with jitter)
+    BACKOFF_MAX = 2
+
+
+class EmitScheduler:
+    """
+    Delivers game events to clients connected to this worker
+
+    Each client has a queue, drained in order by at most one sender task, so a retried event can't be overtaken by a
+    later one (e.g. moves arriving out of order). Failed emits are retried with exponential backoff and jitter, up to
+    MAX_EMIT_RETRIES attempts, after which the event is dead-lettered (dropped and counted). The total number of queued
+    events, and so of outstanding work, is bounded.
+
+    With batching, everything queued for a client during one event loop iteration is sent as a single "events" emit
+    (a list of [name, data] pairs, in order) rather than one emit per event.
+    """
+
+    def __init__(self, sio: AsyncServer, logger: Logger, max_queued=DeliveryConfig.MAX_QUEUED, batch=SIO_BATCH_EVENTS):
+        self.sio = sio
+        self.logger = logger
+        self.max_queued = max_queued
+        self.batch = batch
+        self.queues = {}  # sid -> deque of events
+        self.senders = {}  # sid -> task draining the sid's queue
+        self.n_queued = 0
+
+    def emit(self, event: Event, sid: str):
+        """Queue an event for delivery to a client"""
+        if self.n_queued >= self.max_queued:
+            self.logger.error(f"Delivery queue full, dropping {event.name} event for {sid}")
+            metrics.emit_dead_letters.labels(event.name).inc()
+            return
+        self.queues.setdefault(sid, deque()).append(event)
+        self.n_queued += 1
+        if sid not in self.senders:
+            self.senders[sid] = asyncio.create_task(self._send(sid))
+
+    async def _send(self, sid):
+        queue = self.queues[sid]
+        try:
+            while queue:
+                if not self.batch:
+                    await self._deliver(queue[0], sid)
+                    queue.popleft()
+                    self.n_queued -= 1
+                    continue
+                await asyncio.sleep(0)  # let the rest of this loop iteration's events for the client queue up
+                n = len(queue)
+                if n == 1:
+                    await self._deliver(queue[0], sid)
+                else:
+                    await self._deliver(Event("events", [[queue[i].name, queue[i].data] for i in range(n)]), sid)
+                for _ in range(n):
+                    queue.popleft()
+                self.n_queued -= n
+        finally:
+            # the sid may have been removed (and re-added) while this was running
+            if self.senders.get(sid) is asyncio.current_task():
+                del self.senders[sid]
+            if not queue and self.queues.get(sid) is queue:
+                del self.queues[sid]
+
+    async def _deliver(self, event: Event, sid):
+        for attempt in range(1, MAX_EMIT_RETRIES + 1):
+            try:
+                with metrics.emit_duration.labels(event.name).time():
+                    await self.sio.emit(event.name, event.data, to=sid)
+                return
+            except Exception as exc:
+                if attempt == MAX_EMIT_RETRIES:
+                    self.logger.error(f"Emit event failed {MAX_EMIT_RETRIES} times, giving up: {exc}")
+                    metrics.emit_dead_letters.labels(event.name).inc()
+                    return
+                backoff = min(DeliveryConfig.BACKOFF_INITIAL * 2 ** (attempt - 1), DeliveryConfig.BACKOFF_MAX)
+                self.logger.error(f"Emit event failed with exception: {exc}, retrying...")
+                metrics.emit_retries.labels(event.name).inc()
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+
+    def remove(self, sid):
+        """Drop a client's undelivered events (e.g. once it has disconnected)"""
+        sender = self.senders.pop(sid, None)
+        if sender:
+            sender.cancel()
+        self.n_queued -= len(self.queues.pop(sid, ()))
+
+    def clear(self):
+        for sid in list(self.queues):
+            self.remove(sid)
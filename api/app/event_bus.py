@@ -0,0 +1,380 @@
+import asyncio
+import json
+import os
+from abc import ABC, abstractmethod
+from collections import deque
+from logging import Logger
+
+import app.metrics as metrics
+import app.utils as utils
+from aio_pika import ExchangeType
+from aio_pika.abc import AbstractChannel, AbstractIncomingMessage, AbstractQueue
+from aioredis.client import Redis
+from app.constants import (
+    BROADCAST_KEY,
+    EVENT_BUS_LOCAL_FAST_PATH,
+    RMQ_ROUTING_MODE,
+    SHARED_EXCHANGE,
+    SPECTATOR_KEY,
+    EventBusBackend,
+    RoutingMode,
+)
+from app.delivery import EmitScheduler
+from app.exceptions import CustomException
+from app.game_registry import GameRegistry
+from app.models import Event
+from app.rmq import RMQConnectionManager
+
+
+class EventBusConfig:
+    MAX_PENDING = 10000  # events awaiting publishing to Redis (oldest dropped first)
+    POLL_TIMEOUT = 1  # seconds to wait for a Redis message before checking the subscriptions again
+
+
+class EventBus(ABC):
+    """
+    Carries game events from the worker they are published on to the workers the game's players (and spectators) are
+    connected to, where they are handed to the emit scheduler (spectator events to on_spectator_event)
+
+    Events are addressed to a game and a routing key: a player ID, BROADCAST_KEY (both players, and spectators) or
+    SPECTATOR_KEY (spectators only). Backends differ in how events travel between workers; subclasses implement
+    _publish and the subscription hooks, and pass events received for this worker to receive.
+
+    With the local fast path, events whose recipients are all players on this worker are delivered in process, without
+    a round trip through the backend. Broadcasts still go through the backend, to spectators only.
+    """
+
+    def __init__(self, gr: GameRegistry, delivery: EmitScheduler, logger: Logger, local_fast_path=EVENT_BUS_LOCAL_FAST_PATH):
+        self.gr = gr
+        self.delivery = delivery
+        self.logger = logger
+        self.local_fast_path = local_fast_path
+        self.on_publish_callbacks = []
+        self.on_spectator_event = None  # called with the game ID and event, for games watched from this worker
+
+    def add_on_publish_callback(self, callback):
+        """Register a function to be called with the game ID, routing key and body of every event published"""
+        self.on_publish_callbacks.append(callback)
+
+    def publish(self, gid: str, event: Event, rk=BROADCAST_KEY):
+        """Send an event to a game's players (and spectators), wherever they are connected"""
+        with metrics.publish_duration.labels(event.name).time():
+            body = json.dumps(event.__dict__).encode()
+            for callback in self.on_publish_callbacks:
+                callback(gid, rk, body)
+            local_players = self.gr.get_players(gid)
+            if self.local_fast_path and (rk in local_players or rk == BROADCAST_KEY and len(local_players) == 2):
+                metrics.bus_events.labels("local").inc()
+                for sid in local_players if rk == BROADCAST_KEY else (rk,):
+                    self.delivery.emit(event, sid)
+                if rk != BROADCAST_KEY:
+                    return
+                rk = SPECTATOR_KEY
+            metrics.bus_events.labels("backend").inc()
+            self._publish(gid, rk, body)
+
+    def receive(self, gid: str, rk: str, body: bytes, sid=None, spectators=True):
+        """
+        Hand an event received from the backend to this worker's recipients: its players of the game (or just the
+        player given, for backends with a subscription per player) and, unless they have a subscription of their own,
+        its spectators
+        """
+        event = Event(**json.loads(body))
+        if sid is not None:
+            self.delivery.emit(event, sid)
+            return
+        local_players = self.gr.get_players(gid)
+        if rk == BROADCAST_KEY:
+            for sid in local_players:
+                self.delivery.emit(event, sid)
+        elif rk in local_players:
+            self.delivery.emit(event, rk)
+        if spectators and rk in (BROADCAST_KEY, SPECTATOR_KEY):
+            self.receive_spectator_event(gid, event)
+
+    def receive_spectator_event(self, gid: str, event: Event):
+        if self.on_spectator_event is not None:
+            self.on_spectator_event(gid, event)
+
+    @abstractmethod
+    def _publish(self, gid: str, rk: str, body: bytes):
+        """Send an event (serialised) to the game's recipients through the backend"""
+
+    @property
+    def is_ready(self):
+        """Whether this worker can receive events yet"""
+        return True
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def create_game(self, gid):
+        """Set up the routing of a new game's events"""
+
+    async def subscribe(self, gid, sid):
+        """Route a game's events to a player connected to this worker (call after adding the player to the registry)"""
+
+    async def unsubscribe(self, gid, sid):
+        """Stop routing a game's events to a player (call after removing the player from the registry)"""
+
+    async def drop_player(self, gid, sid):
+        """Release the resources routing a game's events to a player who has left it (call after unsubscribe)"""
+
+    async def teardown_game(self, gid, sids=()):
+        """Release the resources routing a game's events (this worker's, and those of the players given, on any worker)"""
+
+    async def watch(self, gid):
+        """Route a game's broadcast and spectator events to this worker's spectators"""
+
+    async def unwatch(self, gid):
+        """Stop routing a game's events to this worker's spectators"""
+
+
+class InMemoryEventBus(EventBus):
+    """Events never leave the process: for a single worker, e.g. for tests and benchmarks without a broker"""
+
+    def _publish(self, gid, rk, body):
+        self.receive(gid, rk, body)
+
+
+class RedisEventBus(EventBus):
+    """
+    Events go through Redis pub/sub, on a channel per game. Each worker subscribes to the channels of the games its
+    players and spectators are in, and publishes the events of one event loop iteration in a single pipeline
+    """
+
+    def __init__(self, redis_client: Redis, gr: GameRegistry, delivery: EmitScheduler, logger: Logger, **kwargs):
+        super().__init__(gr, delivery, logger, **kwargs)
+        self.redis_client = redis_client
+        self.pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        self.pending = deque()  # (channel, message)
+        self.flusher = None
+        self.reader = None
+        self.channels = set()  # channels subscribed to
+        self.watched = set()  # games with spectators on this worker
+
+    @staticmethod
+    def get_channel(gid):
+        return f"events:{gid}"
+
+    def _publish(self, gid, rk, body):
+        if len(self.pending) >= EventBusConfig.MAX_PENDING:
+            self.logger.error("Event bus publish buffer full, dropping oldest event")
+            self.pending.popleft()
+        self.pending.append((self.get_channel(gid), json.dumps({"rk": rk, "event": body.decode()})))
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        while self.pending:
+            batch = list(self.pending)
+            self.pending.clear()
+            try:
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for channel, message in batch:
+                        pipe.publish(channel, message)
+                    await pipe.execute()
+            except Exception as exc:
+                self.logger.error(f"Failed to publish {len(batch)} events: {exc}")
+
+    async def read(self):
+        while True:
+            if not self.pubsub.subscribed:
+                await asyncio.sleep(EventBusConfig.POLL_TIMEOUT)
+                continue
+            try:
+                message = await self.pubsub.get_message(timeout=EventBusConfig.POLL_TIMEOUT)
+                if message is None:
+                    continue
+                gid = message["channel"].decode().split(":", 1)[1]
+                data = json.loads(message["data"])
+                self.receive(gid, data["rk"], data["event"].encode())
+            except Exception as exc:
+                self.logger.error(f"Failed to receive event: {exc}")
+                await asyncio.sleep(EventBusConfig.POLL_TIMEOUT)
+
+    async def start(self):
+        self.reader = asyncio.create_task(self.read())
+
+    async def stop(self):
+        if self.reader:
+            self.reader.cancel()
+        if self.flusher:
+            await self.flusher
+        await self.pubsub.close()
+
+    async def _update_subscription(self, gid):
+        channel = self.get_channel(gid)
+        wanted = bool(self.gr.get_players(gid)) or gid in self.watched
+        if wanted and channel not in self.channels:
+            self.channels.add(channel)
+            await self.pubsub.subscribe(channel)
+        elif not wanted and channel in self.channels:
+            self.channels.discard(channel)
+            await self.pubsub.unsubscribe(channel)
+
+    async def subscribe(self, gid, sid):
+        await self._update_subscription(gid)
+
+    async def unsubscribe(self, gid, sid):
+        await self._update_subscription(gid)
+
+    async def watch(self, gid):
+        self.watched.add(gid)
+        await self._update_subscription(gid)
+
+    async def unwatch(self, gid):
+        self.watched.discard(gid)
+        await self._update_subscription(gid)
+
+
+class RabbitMQEventBus(EventBus):
+    """
+    Events go through RabbitMQ, in one of two routing modes (RMQ_ROUTING_MODE):
+      - per player: a topic exchange per game, and a queue and consumer per player
+      - shared: a single topic exchange, and one exclusive queue per worker, bound to the games of its players
+
+    Spectators have one exclusive queue per worker (on a channel of its own, so a failed (un)bind can't disrupt the
+    players' consumers), bound to the broadcast and spectator routing keys of each watched game.
+    """
+
+    def __init__(self, rmq: RMQConnectionManager, gr: GameRegistry, delivery: EmitScheduler, logger: Logger, **kwargs):
+        super().__init__(gr, delivery, logger, **kwargs)
+        self.rmq = rmq
+        self.shared_queue: AbstractQueue = None  # this worker's queue in shared routing mode
+        self.spectator_channel = None
+        self.spectator_queue: AbstractQueue = None
+        if RMQ_ROUTING_MODE == RoutingMode.SHARED:
+            rmq.add_on_channel_open_callback(self.init_shared_listener)
+        rmq.add_on_channel_open_callback(self.init_spectator_listener)
+
+    @property
+    def is_ready(self):
+        return self.spectator_queue is not None and (RMQ_ROUTING_MODE != RoutingMode.SHARED or self.shared_queue is not None)
+
+    def _publish(self, gid, rk, body):
+        if RMQ_ROUTING_MODE == RoutingMode.SHARED:
+            self.rmq.publish(SHARED_EXCHANGE, utils.get_shared_routing_key(gid, rk), body)
+        else:
+            self.rmq.publish(gid, rk, body)
+
+    async def init_listener(self, gid, sid, queue: AbstractQueue):
+        self.logger.info("Initialising listener for game " + gid + ", user " + sid + ", on worker ID " + str(os.getpid()))
+
+        async def on_message(message: AbstractIncomingMessage):
+            self.receive(gid, message.routing_key, message.body, sid)
+
+        self.gr.add_game_consumer(gid, queue, await queue.consume(on_message, no_ack=True))
+
+    async def init_shared_listener(self, channel: AbstractChannel):
+        """Shared routing mode: declare the shared exchange and this worker's exclusive queue, and consume from it"""
+        self.logger.info("Initialising shared listener on worker ID " + str(os.getpid()))
+
+        async def on_message(message: AbstractIncomingMessage):
+            gid, rk = message.routing_key.split(".", 1)
+            self.receive(gid, rk, message.body, spectators=False)  # spectators get events through their own queue
+
+        await channel.declare_exchange(SHARED_EXCHANGE, ExchangeType.TOPIC)
+        queue = await channel.declare_queue(exclusive=True)
+        await queue.consume(on_message, no_ack=True)
+        self.shared_queue = queue
+
+    async def init_spectator_listener(self, _: AbstractChannel):
+        """Open the spectator channel, declare this worker's spectator queue and consume from it"""
+        self.logger.info("Initialising spectator listener on worker ID " + str(os.getpid()))
+
+        async def on_message(message: AbstractIncomingMessage):
+            if RMQ_ROUTING_MODE == RoutingMode.SHARED:
+                gid = message.routing_key.split(".", 1)[0]
+            else:
+                gid = message.exchange
+            self.receive_spectator_event(gid, Event(**json.loads(message.body)))
+
+        self.spectator_channel = await self.rmq.connection.channel()
+        if RMQ_ROUTING_MODE == RoutingMode.SHARED:
+            await self.spectator_channel.declare_exchange(SHARED_EXCHANGE, ExchangeType.TOPIC)
+        self.spectator_queue = await self.spectator_channel.declare_queue(exclusive=True)
+        await self.spectator_queue.consume(on_message, no_ack=True)
+
+    async def create_game(self, gid):
+        if RMQ_ROUTING_MODE == RoutingMode.PER_PLAYER:
+            # create fanout exchange for game
+            await self.rmq.channel.declare_exchange(gid, ExchangeType.TOPIC)
+
+    async def subscribe(self, gid, sid):
+        if RMQ_ROUTING_MODE == RoutingMode.SHARED:
+            if self.shared_queue is None:
+                raise CustomException("Server is starting up. Please try again shortly", sid)
+            if len(self.gr.get_players(gid)) == 1:  # first local player of this game
+                await self.shared_queue.bind(SHARED_EXCHANGE, routing_key=utils.get_shared_routing_key(gid, "#"))
+            return
+
+        # create player queue
+        queue = await self.rmq.channel.declare_queue(utils.get_queue_name(gid, sid))
+        # bind the queue to the game exchange
+        await queue.bind(gid, routing_key=sid)
+        await queue.bind(gid, routing_key=BROADCAST_KEY)
+
+        # init listener
+        await self.init_listener(gid, sid, queue)
+
+    async def unsubscribe(self, gid, sid):
+        if RMQ_ROUTING_MODE == RoutingMode.SHARED:
+            if self.shared_queue is not None and not self.gr.get_players(gid):  # last local player of this game
+                await self.shared_queue.unbind(SHARED_EXCHANGE, routing_key=utils.get_shared_routing_key(gid, "#"))
+            return
+
+        for queue, _ in self.gr.get_game_consumers(gid):
+            if queue.name == utils.get_queue_name(gid, sid):
+                await queue.unbind(gid, routing_key=sid)
+                await queue.unbind(gid, routing_key=BROADCAST_KEY)
+
+    async def drop_player(self, gid, sid):
+        """Cancel this worker's consumer of a player's queue and delete the queue (per player routing mode)"""
+        if RMQ_ROUTING_MODE != RoutingMode.PER_PLAYER:
+            return
+        for queue, ctag in list(self.gr.get_game_consumers(gid)):
+            if queue.name == utils.get_queue_name(gid, sid):
+                await queue.cancel(ctag)
+                self.gr.remove_game_consumer(gid, queue, ctag)
+                await self.rmq.channel.queue_delete(queue.name)
+
+    async def teardown_game(self, gid, sids=()):
+        """Cancel this worker's consumers for a game, delete its queues and exchange"""
+        queue_names = {utils.get_queue_name(gid, sid) for sid in sids}
+        for queue, ctag in self.gr.get_game_consumers(gid):
+            await queue.cancel(ctag)
+            queue_names.add(queue.name)
+        self.gr.remove_all_game_consumers(gid)
+        if RMQ_ROUTING_MODE == RoutingMode.PER_PLAYER:
+            for name in queue_names:
+                await self.rmq.channel.queue_delete(name)
+            await self.rmq.channel.exchange_delete(gid)
+
+    def _spectator_bindings(self, gid):
+        """(exchange, routing key) pairs carrying a game's events for spectators"""
+        if RMQ_ROUTING_MODE == RoutingMode.SHARED:
+            return [(SHARED_EXCHANGE, utils.get_shared_routing_key(gid, rk)) for rk in (BROADCAST_KEY, SPECTATOR_KEY)]
+        return [(gid, rk) for rk in (BROADCAST_KEY, SPECTATOR_KEY)]
+
+    async def watch(self, gid):
+        for exchange, rk in self._spectator_bindings(gid):
+            await self.spectator_queue.bind(exchange, routing_key=rk)
+
+    async def unwatch(self, gid):
+        try:
+            for exchange, rk in self._spectator_bindings(gid):
+                await self.spectator_queue.unbind(exchange, routing_key=rk)
+        except Exception as exc:  # e.g. the game's exchange has already been deleted, along with the bindings
+            self.logger.warning(f"Failed to unbind spectator queue from game {gid}: {exc}")
+
+
+def create_event_bus(backend: str, rmq: RMQConnectionManager, redis_client: Redis, gr: GameRegistry, delivery: EmitScheduler, logger: Logger):
+    if backend == EventBusBackend.MEMORY:
+        return InMemoryEventBus(gr, delivery, logger)
+    if backend == EventBusBackend.REDIS:
+        return RedisEventBus(redis_client, gr, delivery, logger)
+    return RabbitMQEventBus(rmq, gr, delivery, logger)
@@ -1,4 +1,4 @@
-import app.utils as utils
+import app.metrics as metrics
 from app.models import Event
 
 
@@ -16,22 +16,28 @@ class CustomException(Exception):
 
 
 class SocketIOExceptionHandler:
-    def __init__(self, sio, rmq, logger):
+    def __init__(self, sio, bus, logger):
         self.sio = sio
-        self.rmq = rmq
+        self.bus = bus
         self.logger = logger
 
     def sio_exception_handler(self, handler):
-        """Produces a wrapper that goes around SIO event handlers"""
+        """Produces a wrapper that goes around SIO event handlers (also records their latency, errors and concurrency)"""
+        event = handler.__name__
 
         async def wrapper(*args, **kwargs):
-            try:
-                return await handler(*args, **kwargs)
-            except CustomException as exc:
-                self.logger.error(f"Exception caught in {handler.__name__}: {exc}")
-                if exc.emit_local:  # emit to single recipient on local SIO server
-                    await self.sio.emit("error", exc.message, to=exc.sid)
-                else:  # emit to every player in game
-                    utils.publish_event(self.rmq.channel, exc.gid, Event("error", exc.message))
+            with metrics.event_duration.labels(event).time(), metrics.events_in_flight.labels(event).track_inprogress():
+                try:
+                    return await handler(*args, **kwargs)
+                except CustomException as exc:
+                    metrics.event_errors.labels(event, "handled").inc()
+                    self.logger.error(f"Exception caught in {handler.__name__}: {exc}")
+                    if exc.emit_local:  # emit to single recipient on local SIO server
+                        await self.sio.emit("error", exc.message, to=exc.sid)
+                    else:  # emit to every player in game
+                        self.bus.publish(exc.gid, Event("error", exc.message))
+                except Exception:
+                    metrics.event_errors.labels(event, "unhandled").inc()
+                    raise
 
         return wrapper
@@ -1,39 +1,146 @@
+import asyncio
+import json
+import uuid
+from time import time
+
 import aiohttp
-from app.constants import CMC_API_KEY
-from fastapi import APIRouter, HTTPException
-from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
+from aioredis.client import Redis
+from app.constants import CMC_API_KEY, CMC_API_URL
+from fastapi import APIRouter, HTTPException, Request
+from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR, HTTP_503_SERVICE_UNAVAILABLE
 
 router = APIRouter(prefix="/exchange", tags=["exchange"])
 
 
+class ExchangeRateConfig:
+    FRESH_TTL = 60  # seconds a fetched rate is served without revalidation
+    MAX_STALE = 900  # seconds a rate may be served (stale) while a refresh is attempted
+    REFRESH_LOCK_TTL = 10  # seconds; only one worker fetches from upstream at a time
+    REFRESH_WAIT_INTERVAL = 0.1  # seconds between checks for a rate fetched by another worker
+    FAILURE_TTL = 10  # seconds after a failed fetch during which no worker calls the upstream API again
+
+
+class ExchangeRateCache:
+    """
+    MATIC/GBP exchange rate, cached in worker memory and in Redis (shared across workers)
+
+    Stale rates are served while a single background refresh runs. Concurrent misses in a worker share one refresh,
+    and a Redis lock makes sure only one worker calls the upstream API at a time. A failed fetch is remembered (in
+    Redis) for FAILURE_TTL, during which stale rates are still served and misses fail straight away, without calling
+    the upstream API.
+    """
+
+    REDIS_KEY = "exchange_rate:matic_gbp"
+    LOCK_KEY = "exchange_rate:matic_gbp:refresh"
+    FAILURE_KEY = "exchange_rate:matic_gbp:failed"
+
+    # KEYS: lock. ARGV: owner token. Releases the lock only if it is still held by the owner
+    RELEASE_SCRIPT = """
+    if redis.call("GET", KEYS[1]) == ARGV[1] then
+        return redis.call("DEL", KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, redis_client: Redis, url=CMC_API_URL, api_key=CMC_API_KEY):
+        self.redis_client = redis_client
+        self.url = url
+        self.api_key = api_key
+        self.session = None
+        self.rate = None  # (rate, fetched at)
+        self.refresh_task = None
+        self.failed_until = 0  # time until which the upstream API is not called again (after a failed fetch)
+        self.release_script = redis_client.register_script(self.RELEASE_SCRIPT)
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            headers={
+                "X-CMC_PRO_API_KEY": self.api_key or "",
+                "Accept-Encoding": "deflate, gzip",
+                "Accept": "application/json",
+            }
+        )
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+    async def get(self):
+        """Returns tuple of exchange rate and its age in seconds"""
+        if self.rate is None or time() - self.rate[1] >= ExchangeRateConfig.FRESH_TTL:
+            cached = await self.redis_client.get(self.REDIS_KEY)
+            if cached:
+                self.rate = tuple(json.loads(cached))
+
+        if self.rate is not None:
+            age = time() - self.rate[1]
+            if age >= ExchangeRateConfig.FRESH_TTL:
+                self.refresh()  # revalidate in background, serve stale
+            if age < ExchangeRateConfig.MAX_STALE:
+                return self.rate[0], age
+
+        # nothing (usable) cached, wait for refresh
+        rate, fetched_at = await asyncio.shield(self.refresh())
+        return rate, time() - fetched_at
+
+    def refresh(self):
+        """Start a refresh, or join the one already running"""
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self._refresh())
+            self.refresh_task.add_done_callback(lambda t: t.cancelled() or t.exception())  # don't warn if unawaited
+        return self.refresh_task
+
+    def _unavailable(self):
+        return HTTPException(status_code=HTTP_503_SERVICE_UNAVAILABLE, detail="Exchange rate unavailable, please try again shortly")
+
+    async def _refresh(self):
+        if time() < self.failed_until or await self.redis_client.exists(self.FAILURE_KEY):
+            raise self._unavailable()  # a recent fetch failed, back off
+
+        token = str(uuid.uuid4())
+        if not await self.redis_client.set(self.LOCK_KEY, token, ex=ExchangeRateConfig.REFRESH_LOCK_TTL, nx=True):
+            # another worker is fetching, wait for its result (or failure)
+            known = self.rate[1] if self.rate else 0
+            deadline = time() + ExchangeRateConfig.REFRESH_LOCK_TTL
+            while time() < deadline:
+                await asyncio.sleep(ExchangeRateConfig.REFRESH_WAIT_INTERVAL)
+                cached, failed = await self.redis_client.mget(self.REDIS_KEY, self.FAILURE_KEY)
+                if cached and (rate := tuple(json.loads(cached)))[1] > known:
+                    self.rate = rate
+                    return rate
+                if failed:
+                    raise self._unavailable()
+            raise TimeoutError("Timed out waiting for exchange rate refresh")
+
+        try:
+            async with self.session.get(self.url, params={"symbol": "MATIC", "convert": "GBP"}) as response:
+                if response.status != 200:
+                    raise HTTPException(status_code=response.status, detail="Error fetching exchange rate from CoinMarketCap API")
+                data = await response.json()
+            self.rate = (data["data"]["MATIC"][0]["quote"]["GBP"]["price"], time())
+            await self.redis_client.set(self.REDIS_KEY, json.dumps(self.rate), ex=ExchangeRateConfig.MAX_STALE)
+            return self.rate
+        except Exception:
+            self.failed_until = time() + ExchangeRateConfig.FAILURE_TTL
+            await self.redis_client.set(self.FAILURE_KEY, 1, ex=ExchangeRateConfig.FAILURE_TTL)
+            raise
+        finally:
+            await self.release_script(keys=[self.LOCK_KEY], args=[token])
+
+
 @router.get("/matic-gbp")
-async def get_matic_gbp_exchange_rate():
+async def get_matic_gbp_exchange_rate(request: Request):
     """
-    Fetch the current exchange rate of MATIC to GBP from CoinMarketCap API
+    Fetch the current exchange rate of MATIC to GBP (CoinMarketCap API, cached)
 
     Returns:
-        dict: The exchange rate of MATIC to GBP
+        dict: The exchange rate of MATIC to GBP, its age in seconds and whether it is stale (being refreshed)
     """
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                "https://pro-api.coinmarketcap.com/v2/cryptocurrency/quotes/latest",
-                params={"symbol": "MATIC", "convert": "GBP"},
-                headers={
-                    "X-CMC_PRO_API_KEY": CMC_API_KEY,
-                    "Accept-Encoding": "deflate, gzip",
-                    "Accept": "application/json",
-                },
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    exchange_rate = data["data"]["MATIC"][0]["quote"]["GBP"]["price"]
-                    return {"exchange_rate": exchange_rate}
-                else:
-                    raise HTTPException(
-                        status_code=response.status,
-                        detail="Error fetching exchange rate from CoinMarketCap API",
-                    )
+        exchange_rate, age = await request.app.state.exchange_rate_cache.get()
+        return {"exchange_rate": exchange_rate, "age": round(age, 3), "stale": age >= ExchangeRateConfig.FRESH_TTL}
+    except HTTPException:
+        raise
     except Exception:
         raise HTTPException(
             status_code=HTTP_500_INTERNAL_SERVER_ERROR,
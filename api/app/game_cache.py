@@ -0,0 +1,60 @@
+from time import monotonic
+
+from app.models import Game
+from lru import LRU
+
+
+class GameCacheConfig:
+    MAX_SIZE = 1024  # max number of games held in memory per worker
+    IDLE_TTL = 300  # seconds after which an untouched entry is evicted
+
+
+class GameCache:
+    """
+    Per-worker LRU cache of live games, keyed by game ID
+
+    Entries are tagged with the Redis version counter of the game state they were saved as. A cached game is only
+    handed out if its version still matches Redis, i.e. no other worker has saved the game since.
+
+    Games are taken out of the cache when read for an update and put back when saved, so a handler that fails part way
+    through mutating a game never leaves a dirty copy behind. Read-only callers peek instead, leaving the entry cached.
+    """
+
+    def __init__(self, max_size=GameCacheConfig.MAX_SIZE, idle_ttl=GameCacheConfig.IDLE_TTL):
+        self.games = LRU(max_size)  # gid -> (version, game, last access time)
+        self.idle_ttl = idle_ttl
+
+    def take(self, gid: str, version: int | None) -> Game | None:
+        entry = self.games.pop(gid, None)
+        if entry is None or version is None:
+            return None
+        cached_version, game, last_access = entry
+        if cached_version != version or monotonic() - last_access > self.idle_ttl:
+            return None  # stale or idle
+        return game
+
+    def peek(self, gid: str, version: int | None) -> Game | None:
+        """Cached game, left in the cache (the caller must not mutate it)"""
+        entry = self.games.get(gid)
+        if entry is None or version is None:
+            return None
+        cached_version, game, last_access = entry
+        if cached_version != version or monotonic() - last_access > self.idle_ttl:
+            return None
+        return game
+
+    def put(self, gid: str, version: int, game: Game):
+        self.games[gid] = (version, game, monotonic())
+        self.evict_idle()
+
+    def remove(self, gid: str):
+        self.games.pop(gid, None)
+
+    def evict_idle(self):
+        """Evict idle entries from the least recently used end (stops at the first fresh one)"""
+        now = monotonic()
+        while (last := self.games.peek_last_item()) is not None and now - last[1][2] > self.idle_ttl:
+            self.remove(last[0])
+
+    def clear(self):
+        self.games.clear()
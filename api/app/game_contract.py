@@ -1,46 +1,71 @@
 from logging import Logger
 
+import app.metrics as metrics
 from app.abi import abi
 from app.constants import SC_ADDRESS, WALLET_PK
 from eth_utils import encode_hex
 from web3 import AsyncWeb3
+from web3.exceptions import TransactionNotFound
 
 
 class GameContract:
     """Wrapper around smart contract functions declareWinner and declareDraw"""
 
     GAS_LIMIT = 100000
+    FEE_FIELDS = ("maxFeePerGas", "maxPriorityFeePerGas", "gasPrice")
 
-    def __init__(self, w3: AsyncWeb3, logger: Logger):
+    def __init__(self, w3: AsyncWeb3, logger: Logger, address=SC_ADDRESS, private_key=WALLET_PK):
         self.w3 = w3
-        self.contract = w3.eth.contract(address=SC_ADDRESS, abi=abi)
-        self.acct = w3.eth.account.from_key(WALLET_PK)
+        self.contract = w3.eth.contract(address=address, abi=abi)
+        self.acct = w3.eth.account.from_key(private_key)
         self.logger = logger
 
-    async def declare_winner(self, gid: str, winner_addr: str):
-        """Declare winner of game"""
-        tx = await self.contract.functions.declareWinner(gid, winner_addr).build_transaction(
-            {
-                "from": self.acct.address,
-                "gas": self.GAS_LIMIT,
-                "nonce": await self.w3.eth.get_transaction_count(self.acct.address),
-            }
-        )
-        signed_tx = self.w3.eth.account.sign_transaction(tx, private_key=self.acct.key)
-        tx_hash = await self.w3.eth.send_raw_transaction(signed_tx.rawTransaction)
-        self.logger.info(f"Winner declared in game {gid}. Transaction hash: {encode_hex(tx_hash)}")
-        return await self.w3.eth.wait_for_transaction_receipt(tx_hash)
-
-    async def declare_draw(self, gid: str):
-        """Declare draw in game"""
-        tx = await self.contract.functions.declareDraw(gid).build_transaction(
-            {
-                "from": self.acct.address,
-                "gas": self.GAS_LIMIT,
-                "nonce": await self.w3.eth.get_transaction_count(self.acct.address),
-            }
-        )
-        signed_tx = self.w3.eth.account.sign_transaction(tx, private_key=self.acct.key)
-        tx_hash = await self.w3.eth.send_raw_transaction(signed_tx.rawTransaction)
-        self.logger.info(f"Draw declared in game {gid}. Transaction hash: {encode_hex(tx_hash)}")
-        return await self.w3.eth.wait_for_transaction_receipt(tx_hash)
+    async def get_nonce(self, block="pending"):
+        """Next nonce for the signing account, counting transactions still in the mempool (or only mined ones)"""
+        with metrics.contract_duration.labels("get_nonce").time():
+            return await self.w3.eth.get_transaction_count(self.acct.address, block)
+
+    async def sign_result(self, gid: str, winner_addr: str | None, nonce: int, fees: dict = None):
+        """
+        Build and sign declareWinner (or declareDraw if there is no winner), without sending it
+
+        :param nonce: transaction nonce (managed by the caller)
+        :param fees: fee fields to use (e.g. bumped fees when replacing a stuck transaction), estimated if not given
+        :returns: tuple of transaction hash, signed raw transaction and the fee fields it was signed with
+        """
+        if winner_addr is not None:
+            fn = self.contract.functions.declareWinner(gid, winner_addr)
+        else:
+            fn = self.contract.functions.declareDraw(gid)
+        with metrics.contract_duration.labels("sign_result").time():
+            tx = await fn.build_transaction({"from": self.acct.address, "gas": self.GAS_LIMIT, "nonce": nonce, **(fees or {})})
+            signed_tx = self.w3.eth.account.sign_transaction(tx, private_key=self.acct.key)
+        return encode_hex(signed_tx.hash), encode_hex(signed_tx.rawTransaction), {k: tx[k] for k in self.FEE_FIELDS if k in tx}
+
+    async def broadcast(self, raw_tx: str):
+        """Send a signed transaction (sending one the node already has is a no-op)"""
+        with metrics.contract_duration.labels("send_result").time():
+            try:
+                tx_hash = await self.w3.eth.send_raw_transaction(raw_tx)
+            except ValueError as exc:
+                if "already known" in str(exc):
+                    return
+                raise
+        self.logger.info(f"Settlement transaction sent: {encode_hex(tx_hash)}")
+
+    async def is_pending(self, tx_hash: str):
+        """Whether the node knows of a transaction (in the mempool or mined)"""
+        with metrics.contract_duration.labels("get_transaction").time():
+            try:
+                await self.w3.eth.get_transaction(tx_hash)
+                return True
+            except TransactionNotFound:
+                return False
+
+    async def get_receipt(self, tx_hash: str):
+        """Transaction receipt, or None if the transaction has not been mined yet"""
+        with metrics.contract_duration.labels("get_receipt").time():
+            try:
+                return await self.w3.eth.get_transaction_receipt(tx_hash)
+            except TransactionNotFound:
+                return None
@@ -1,79 +1,271 @@
-import asyncio
-import json
-import os
+import math
 import random
+import re
 import uuid
 from logging import Logger
-from time import time_ns
+from time import time, time_ns
 
 import aioredis
+import app.metrics as metrics
 import app.utils as utils
 from aioredis.client import Redis
-from app.constants import BROADCAST_KEY, MAX_EMIT_RETRIES, TimeConstants
+from app.affinity import WorkerRouter
+from app.archive import MatchArchive
+from app.constants import (
+    ACTIVE_GAMES_KEY,
+    GAME_IDLE_TIMEOUT,
+    GAME_KEY_TTL,
+    LOBBY_KEY,
+    MAX_UPDATE_RETRIES,
+    REDIS_BATCH_SIZE,
+    ROUND_BREAK,
+    RESUMABLE_SESSIONS,
+    SPECTATOR_KEY,
+    TimeConstants,
+)
+from app.clock import GameClock
+from app.delivery import EmitScheduler
+from app.event_bus import EventBus
 from app.exceptions import CustomException
-from app.game_contract import GameContract
+from app.game_cache import GameCache
 from app.game_registry import GameRegistry
+from app.lobby import GameLobby
 from app.models import Colour, Event, Game, Outcome
 from app.rate_limit import RateLimitConfig
-from app.rmq import RMQConnectionManager
+from app.resume import ResumeConfig, SessionResumer
+from app.scheduler import JobScheduler
+from app.settlement import SettlementQueue
 from chess import Board
 from socketio.asyncio_server import AsyncServer
 
 
+class GameConfig:
+    MAX_TIME_CONTROL = 180  # minutes
+    MAX_ROUNDS = 10
+    WALLET_ADDR_PATTERN = re.compile(r"0x[0-9a-fA-F]{40}")
+
+
 class GameController:
 
-    def __init__(self, rmq: RMQConnectionManager, redis_client: Redis, sio: AsyncServer, gr: GameRegistry, contract: GameContract, logger: Logger):
-        self.rmq = rmq
+    # KEYS: game state, game version, active games, game players, then any lobby index sets to update. ARGV: new state,
+    # expected version, timestamp, game ID, key TTL, then (with lobby sets) "add" or "remove", lobby entry, lobby channel
+    # and change notification. Returns new version, or -1 on conflict. Also refreshes the game's last activity time in
+    # the active games index and the expiry of its keys, and publishes lobby changes
+    CAS_SCRIPT = """
+    if (redis.call("GET", KEYS[2]) or "0") ~= ARGV[2] then
+        return -1
+    end
+    redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[5])
+    redis.call("ZADD", KEYS[3], "XX", ARGV[3], ARGV[4])
+    redis.call("EXPIRE", KEYS[4], ARGV[5])
+    local version = redis.call("INCR", KEYS[2])
+    redis.call("EXPIRE", KEYS[2], ARGV[5])
+    local changed = 0
+    for i = 5, #KEYS do
+        if ARGV[6] == "add" then
+            changed = redis.call("ZADD", KEYS[i], 0, ARGV[7])
+        else
+            changed = redis.call("ZREM", KEYS[i], ARGV[7])
+        end
+    end
+    if changed == 1 then
+        redis.call("PUBLISH", ARGV[8], ARGV[9])
+    end
+    return version
+    """
+
+    # KEYS: active games. ARGV: game ID, timestamp, concurrent game limit, idle cutoff timestamp
+    # Adds the game if the number of games active since the cutoff is under the limit (idle games are left to the
+    # reaper). Returns 1 if added
+    RESERVE_SCRIPT = """
+    if redis.call("ZCOUNT", KEYS[1], ARGV[4], "+inf") >= tonumber(ARGV[3]) then
+        return 0
+    end
+    redis.call("ZADD", KEYS[1], ARGV[2], ARGV[1])
+    return 1
+    """
+
+    # KEYS: game clock owner. ARGV: worker ID, key prefix of live workers, key TTL. Makes the worker the owner of the game's
+    # clock, unless another live worker already is. Returns 1 if it is the owner
+    ADOPT_SCRIPT = """
+    local owner = redis.call("GET", KEYS[1])
+    if owner and owner ~= ARGV[1] and redis.call("EXISTS", ARGV[2] .. owner) == 1 then
+        return 0
+    end
+    redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[3])
+    return 1
+    """
+
+    def __init__(
+        self,
+        bus: EventBus,
+        redis_client: Redis,
+        sio: AsyncServer,
+        gr: GameRegistry,
+        cache: GameCache,
+        clock: GameClock,
+        settlement: SettlementQueue,
+        delivery: EmitScheduler,
+        scheduler: JobScheduler,
+        archive: MatchArchive,
+        resumer: SessionResumer,
+        logger: Logger,
+    ):
+        self.bus = bus
         self.redis_client = redis_client
         self.sio = sio
         self.gr = gr
-        self.contract = contract
+        self.cache = cache
+        self.clock = clock
+        self.settlement = settlement
+        self.delivery = delivery
+        self.scheduler = scheduler
+        self.archive = archive
+        self.resumer = resumer
         self.logger = logger
+        self.cas_script = redis_client.register_script(self.CAS_SCRIPT)
+        self.reserve_script = redis_client.register_script(self.RESERVE_SCRIPT)
+        self.adopt_script = redis_client.register_script(self.ADOPT_SCRIPT)
 
-    def _on_emit_done(self, task, event, sid, attempts):
-        try:
-            task.result()  #  raises exception if task failed
-        except Exception as e:
-            if attempts < MAX_EMIT_RETRIES:
-                self.logger.error(f"Emit event failed with exception: {e}, retrying...")
-                new_task = asyncio.create_task(self.sio.emit(event.name, event.data, to=sid))
-                new_task.add_done_callback(lambda t, sid=sid: self._on_emit_done(t, event, sid, attempts + 1))
-            else:
-                self.logger.error(f"Emit event failed {MAX_EMIT_RETRIES} times, giving up")
-
-    async def init_listener(self, gid, sid):
-        self.logger.info("Initialising listener for game " + gid + ", user " + sid + ", on worker ID " + str(os.getpid()))
-
-        def on_message(_, __, ___, body):
-            message = json.loads(body)
-            event = Event(**message)
-            task = asyncio.create_task(self.sio.emit(event.name, event.data, to=sid))
-            task.add_done_callback(lambda t, sid=sid: self._on_emit_done(t, event, sid, 1))
-
-        self.gr.add_game_ctag(gid, self.rmq.channel.basic_consume(queue=utils.get_queue_name(gid, sid), on_message_callback=on_message, auto_ack=True))
-
-    async def get_game_by_gid(self, gid, sid):
-        """Get game state from redis by game ID"""
+    async def get_game_by_gid(self, gid, sid, read_only=False):
+        """
+        Get game state by game ID (from the worker's cache if up to date, otherwise from Redis)
+
+        :param read_only: the caller won't mutate the game, so it is left in (or added to) the cache rather than taken
+        """
         try:
-            game = utils.deserialise_game_state(await self.redis_client.get(utils.get_redis_key(gid)))
+            with metrics.redis_duration.labels("get_version").time():
+                version = int(await self.redis_client.get(utils.get_redis_version_key(gid)) or 0)
+            game = self.cache.peek(gid, version) if read_only else self.cache.take(gid, version)
+            cached = game is not None
+            if not cached:
+                with metrics.redis_duration.labels("get_game").time():
+                    state = await self.redis_client.get(utils.get_redis_key(gid))
+                game = utils.deserialise_game_state(state)
         except aioredis.RedisError as exc:
             raise CustomException(f"Redis error: {exc}", sid)
         if not game:
             raise CustomException("Game not found", sid)
+        game.version = version
+        if read_only and not cached:
+            self.cache.put(gid, version, game)
         return game
 
-    async def get_game_by_sid(self, sid):
-        """Get game state from redis by player ID"""
+    async def get_game_by_sid(self, sid, read_only=False):
+        """Get game state by player ID"""
         gid = self.gr.get_gid(sid)
-        game = await self.get_game_by_gid(gid, sid)
+        game = await self.get_game_by_gid(gid, sid, read_only)
         return game, gid
 
-    async def save_game(self, gid, game, _=None):
-        """Save game state in Redis"""
+    async def save_game(self, gid, game, _=None, lobby=False):
+        """
+        Save game state in Redis (write-through) and cache it under its new version
+
+        Compare-and-set: the write only goes through if the game has not been saved since it was read (game.version)
+
+        :param lobby: also add the game to, or remove it from, the open games index (in the same script)
+        :returns: False if the game was modified concurrently and nothing was written
+        """
+        state = utils.serialise_game_state(game)
+        keys = [utils.get_redis_key(gid), utils.get_redis_version_key(gid), ACTIVE_GAMES_KEY, utils.get_redis_registry_key(gid)]
+        args = [state, game.version, time(), gid, GAME_KEY_TTL]
+        if lobby:
+            op, entry = "add" if GameLobby.is_open(game) else "remove", GameLobby.get_entry(gid, game)
+            keys += GameLobby.get_index_keys(game.time_control, game.n_rounds)
+            args += [op, entry, LOBBY_KEY, GameLobby.get_message(op, entry)]
         try:
-            await self.redis_client.set(utils.get_redis_key(gid), utils.serialise_game_state(game))
+            with metrics.redis_duration.labels("save_game").time():
+                version = await self.cas_script(keys=keys, args=args)
         except aioredis.RedisError as exc:
+            self.cache.remove(gid)
             raise CustomException(f"Redis error: {exc}", emit_local=False, gid=gid)
+        if version < 0:
+            self.cache.remove(gid)
+            return False
+        game.version = version
+        self.cache.put(gid, version, game)
+        return True
+
+    async def update_game(self, gid, sid, update, lobby=False):
+        """
+        Read-modify-write a game with optimistic concurrency control
+
+        If another event saves the game in between the read and the write, the game is re-read and the update
+        re-applied, up to MAX_UPDATE_RETRIES times.
+
+        :param update: function that mutates the game in place and returns a result. Returning None means there is
+                       nothing to save. It may raise CustomException to abort the update
+        :param lobby: also update the game's entry in the open games index (see save_game)
+        :returns: tuple of the (updated) game and the update's result
+        """
+        for _ in range(MAX_UPDATE_RETRIES):
+            game = await self.get_game_by_gid(gid, sid)
+            result = update(game)
+            if result is None:
+                self.cache.put(gid, game.version, game)  # unchanged, so safe to hand back to the cache
+                return game, None
+            if await self.save_game(gid, game, sid, lobby):
+                self.clock.arm(gid, game)
+                return game, result
+            self.logger.warning(f"Concurrent update of game {gid}, retrying...")
+        raise CustomException("Game is busy, please try again", sid)
+
+    async def adopt_clocks(self):
+        """
+        Arm the server clock for the games in progress left behind by workers that went away: none of the workers their
+        players are registered on is alive (e.g. after a crash, or a restart, which comes back under a new worker ID).
+        Each is adopted by a single live worker, and by another if that one goes away too. Run at startup and on every
+        reaper pass, so games still count as their old worker's for a heartbeat TTL are adopted on a later pass
+        """
+        gids = [gid.decode() for gid in await self.redis_client.zrange(ACTIVE_GAMES_KEY, 0, -1)]
+        adopted = 0
+        for i in range(0, len(gids), REDIS_BATCH_SIZE):
+            batch = [gid for gid in gids[i : i + REDIS_BATCH_SIZE] if gid not in self.clock.armed]
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for gid in batch:
+                    pipe.hvals(utils.get_redis_registry_key(gid))
+                registered = [{worker_id.decode() for worker_id in workers} for workers in await pipe.execute()]
+            workers = list(set().union(*registered))
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for worker_id in workers:
+                    pipe.exists(WorkerRouter.get_alive_key(worker_id))
+                alive = {worker_id for worker_id, exists in zip(workers, await pipe.execute()) if exists}
+
+            owned = []
+            for gid in (gid for gid, worker_ids in zip(batch, registered) if not worker_ids & alive):
+                if await self.adopt_script(keys=[utils.get_redis_clock_key(gid)], args=[self.gr.worker_id, WorkerRouter.get_alive_key(), GAME_KEY_TTL]):
+                    owned.append(gid)
+            states = await self.redis_client.mget([utils.get_redis_key(gid) for gid in owned]) if owned else []
+            for gid, state in zip(owned, states):
+                if state:
+                    self.clock.arm(gid, utils.deserialise_game_state(state))
+                    adopted += 1
+        if adopted:
+            self.logger.info(f"Adopted the clocks of {adopted} games left behind by workers that went away")
+
+    @staticmethod
+    def parse_game_options(sid, time_control, wager, n_rounds):
+        """
+        Check the options of a game sent by a client (they must also fit the game state codec's fields)
+
+        :returns: tuple of the time control, wager and number of rounds, as int, float and int
+        """
+        try:
+            time_control, wager, n_rounds = int(time_control), float(wager), int(n_rounds)
+        except (TypeError, ValueError, OverflowError):
+            raise CustomException("Invalid game options", sid)
+        if not 0 < time_control <= GameConfig.MAX_TIME_CONTROL:
+            raise CustomException("Invalid time control", sid)
+        if not 0 < n_rounds <= GameConfig.MAX_ROUNDS:
+            raise CustomException("Invalid number of rounds", sid)
+        if not math.isfinite(wager) or wager <= 0:
+            raise CustomException("Invalid wager amount", sid)
+        return time_control, wager, n_rounds
+
+    @staticmethod
+    def check_wallet_addr(sid, wallet_addr):
+        if not isinstance(wallet_addr, str) or not GameConfig.WALLET_ADDR_PATTERN.fullmatch(wallet_addr):
+            raise CustomException("Invalid wallet address", sid)
 
     async def create(self, sid, time_control, wager, wallet_addr, n_rounds):
         """
@@ -85,13 +277,20 @@ class GameController:
         :param wallet_addr: player's wallet address
         :param n_rounds: number of rounds in the game
         """
+        time_control, wager, n_rounds = self.parse_game_options(sid, time_control, wager, n_rounds)
+        self.check_wallet_addr(sid, wallet_addr)
         gid = str(uuid.uuid4())
-        self.sio.enter_room(sid, gid)  # create a room for the game
 
-        games_inpr = 0
-        async for _ in self.redis_client.scan_iter("game:*"):  # count games in progress
-            games_inpr += 1
-        if games_inpr > RateLimitConfig.CONCURRENT_GAME_LIMIT:
+        now = time()
+        try:  # count games in progress and reserve a slot for this one
+            with metrics.redis_duration.labels("reserve_game").time():
+                reserved = await self.reserve_script(
+                    keys=[ACTIVE_GAMES_KEY],
+                    args=[gid, now, RateLimitConfig.CONCURRENT_GAME_LIMIT, now - GAME_IDLE_TIMEOUT],
+                )
+        except aioredis.RedisError as exc:
+            raise CustomException(f"Redis error: {exc}", sid)
+        if not reserved:
             raise CustomException("Server concurrent game limit reached. Please try again later", sid)
 
         tr = time_control * TimeConstants.MILLISECONDS_PER_MINUTE
@@ -109,22 +308,20 @@ class GameController:
             round=1,
         )
 
-        self.gr.add_player_gid_record(sid, gid)
-        await self.save_game(gid, game, sid)
+        try:
+            await self.gr.add_player_gid_record(sid, gid)
+            await self.save_game(gid, game, sid, lobby=True)
+        except Exception as exc:  # release the slot and registry record taken for the game
+            self.logger.error(f"Failed to create game {gid}: {exc}")
+            await self.gr.remove_player_gid_record(sid)
+            await self.redis_client.zrem(ACTIVE_GAMES_KEY, gid)
+            raise CustomException("Failed to create game, please try again", sid)
 
         # send game id to client
         await self.sio.emit("gameId", gid, to=sid)  # N.B no need to publish this to MQ
 
-        # create fanout exchange for game
-        self.rmq.channel.exchange_declare(exchange=gid, exchange_type="topic")
-        # create player 1 queue
-        self.rmq.channel.queue_declare(queue=utils.get_queue_name(gid, sid))
-        # bind the queue to the game exchange
-        self.rmq.channel.queue_bind(exchange=gid, queue=utils.get_queue_name(gid, sid), routing_key=sid)
-        self.rmq.channel.queue_bind(exchange=gid, queue=utils.get_queue_name(gid, sid), routing_key=BROADCAST_KEY)
-
-        # init listener
-        await self.init_listener(gid, sid)
+        await self.bus.create_game(gid)
+        await self.bus.subscribe(gid, sid)
 
     async def join(self, sid, gid):
         """
@@ -137,7 +334,7 @@ class GameController:
         :param sid: player's socket ID
         :param gid: game ID
         """
-        game = await self.get_game_by_gid(gid, sid)
+        game = await self.get_game_by_gid(gid, sid, read_only=True)
         if len(game.players) > 1:
             raise CustomException("This game already has two players", sid)
 
@@ -157,33 +354,27 @@ class GameController:
         :param gid: game ID
         :param wallet_addr: player's wallet address
         """
-        game = await self.get_game_by_gid(gid, sid)
-
-        self.sio.enter_room(sid, gid)  # join room
-        game.players.append(sid)
-        game.player_wallet_addrs[sid] = wallet_addr
-        game.match_score[sid] = 0
-
-        self.gr.add_player_gid_record(sid, gid)
+        self.check_wallet_addr(sid, wallet_addr)
 
-        # randomly pick white and black
-        random.shuffle(game.players)
+        def add_player(game: Game):
+            if len(game.players) > 1:
+                raise CustomException("This game already has two players", sid)
+            game.players.append(sid)
+            game.player_wallet_addrs[sid] = wallet_addr
+            game.match_score[sid] = 0
+            # randomly pick white and black
+            random.shuffle(game.players)
+            game.turn_start_time = time_ns() / 1_000_000  # reset turn start time
+            return True
 
-        game.turn_start_time = time_ns() / 1_000_000  # reset turn start time
+        game, _ = await self.update_game(gid, sid, add_player, lobby=True)
 
-        await self.save_game(gid, game, sid)
+        await self.gr.add_player_gid_record(sid, gid)
 
-        # create player 2 queue
-        self.rmq.channel.queue_declare(queue=utils.get_queue_name(gid, sid))
-        # bind the queue to the game exchange
-        self.rmq.channel.queue_bind(exchange=gid, queue=utils.get_queue_name(gid, sid), routing_key=sid)
-        self.rmq.channel.queue_bind(exchange=gid, queue=utils.get_queue_name(gid, sid), routing_key=BROADCAST_KEY)
-
-        await self.init_listener(gid, sid)
+        await self.bus.subscribe(gid, sid)
 
         # start the game
-        utils.publish_event(
-            self.rmq.channel,
+        self.bus.publish(
             gid,
             Event(
                 "start",
@@ -191,8 +382,7 @@ class GameController:
             ),
             game.players[0],
         )
-        utils.publish_event(
-            self.rmq.channel,
+        self.bus.publish(
             gid,
             Event(
                 "start",
@@ -200,8 +390,18 @@ class GameController:
             ),
             game.players[1],
         )
+        self.bus.publish(gid, Event("spectate", utils.get_spectate_data(game).__dict__), SPECTATOR_KEY)
+        if RESUMABLE_SESSIONS:
+            for pid in game.players:
+                self.bus.publish(gid, Event("resumeToken", {"gameId": gid, "token": self.resumer.issue_token(gid, pid)}), pid)
+
+    async def handle_end_of_round(self, gid: str, game: Game, outcome: int, winner_ind=None):
+        """
+        Archives the round, then ends the match or starts the next round
 
-    async def handle_end_of_round(self, gid: str, game: Game):
+        NOTE: the game passed in must already be saved with the round marked as over (and the updated match score)
+        """
+        self.archive.record(gid, game, outcome, winner_ind)
         overall_winner = None
         match_score = game.match_score
         if game.round == game.n_rounds:
@@ -211,80 +411,296 @@ class GameController:
             elif match_score[game.players[0]] < match_score[game.players[1]]:  # player who had white in last round wins overall
                 overall_winner = 1
 
-            # publish matchEnded event
-            utils.publish_event(self.rmq.channel, gid, Event("matchEnded", {"overallWinner": overall_winner}))
+            def finish(game: Game):
+                if game.finished:  # already finished (e.g. abandoned)
+                    return None
+                game.finished = True
+                return True
+
             # save game
-            game.finished = True
-            await self.save_game(gid, game)
+            game, finished = await self.update_game(gid, game.players[0], finish)
+            if not finished:
+                return
+
+            # publish matchEnded event
+            self.bus.publish(gid, Event("matchEnded", {"overallWinner": overall_winner}))
 
-            # declare result on SC
+            # queue declaration of result on SC
             if overall_winner is not None:
-                await self.contract.declare_winner(gid, game.player_wallet_addrs[game.players[overall_winner]])
+                await self.settlement.enqueue(gid, game.player_wallet_addrs[game.players[overall_winner]])
             else:  # draw
-                await self.contract.declare_draw(gid)
+                await self.settlement.enqueue(gid, None)
         else:
-            # start next round
-            await asyncio.sleep(20)  # wait 20 seconds before starting next round
-            game = await self.get_game_by_gid(gid, game.players[0])  # refresh game in memory
+            # start next round after a break (durable, so it still happens if this worker restarts in the meantime)
+            await self.scheduler.schedule("start_round", ROUND_BREAK, gid=gid, finished_round=game.round)
+
+    async def start_next_round(self, gid: str, finished_round: int):
+        """Start the round after finished_round (scheduled job, idempotent)"""
+
+        def start_next_round(game: Game):
+            if game.finished or game.round != finished_round or not game.round_over:
+                return None  # game abandoned, or next round already started
             game.round += 1
-            game.match_score = match_score  # restore match score
+            game.round_over = False
             game.board.reset()  # reset board
+            game.repetitions = None
             game.players.reverse()  # switch white and black
             game.tr_w = game.tr_b = TimeConstants.MILLISECONDS_PER_MINUTE * game.time_control
             game.turn_start_time = time_ns() / 1_000_000
-
-            if not game.finished:  # if game has not been abandoned, send start event
-                utils.publish_event(
-                    self.rmq.channel,
-                    gid,
-                    Event(
-                        "start",
-                        {"colour": Colour.BLACK.value[0], "timeRemaining": game.tr_b, "round": game.round, "totalRounds": game.n_rounds},
-                    ),
-                    game.players[0],
-                )
-                utils.publish_event(
-                    self.rmq.channel,
-                    gid,
-                    Event(
-                        "start",
-                        {"colour": Colour.WHITE.value[0], "timeRemaining": game.tr_w, "round": game.round, "totalRounds": game.n_rounds},
-                    ),
-                    game.players[1],
-                )
-            await self.save_game(gid, game)
+            return True
+
+        updated = await self.get_game_for_job(gid, start_next_round)
+        if updated is None:
+            return  # game deleted (both players left)
+        game, started = updated
+
+        if started:  # if game has not been abandoned, send start event
+            self.bus.publish(
+                gid,
+                Event(
+                    "start",
+                    {"colour": Colour.BLACK.value[0], "timeRemaining": game.tr_b, "round": game.round, "totalRounds": game.n_rounds},
+                ),
+                game.players[0],
+            )
+            self.bus.publish(
+                gid,
+                Event(
+                    "start",
+                    {"colour": Colour.WHITE.value[0], "timeRemaining": game.tr_w, "round": game.round, "totalRounds": game.n_rounds},
+                ),
+                game.players[1],
+            )
+            self.bus.publish(gid, Event("spectate", utils.get_spectate_data(game).__dict__), SPECTATOR_KEY)
 
     async def handle_exit(self, sid):
         if not self.gr.get_gid(sid):
             # if player already removed from game or game deleted, return
             return
 
-        game, gid = await self.get_game_by_sid(sid)
-        if len(game.players) > 1 and not game.finished:
-            # if game not finished, the player automatically loses the game
-            winner_ind = utils.opponent_ind(game.players.index(sid))
-            utils.publish_event(self.rmq.channel, gid, Event("move", {"winner": winner_ind, "outcome": Outcome.ABANDONED.value, "matchScore": game.match_score}))
-            utils.publish_event(self.rmq.channel, gid, Event("matchEnded", {"overallWinner": winner_ind}))
-            game.finished = True
-            await self.save_game(gid, game)
-            await self.contract.declare_winner(gid, game.player_wallet_addrs[game.players[winner_ind]])
+        gid = self.gr.get_gid(sid)
+        await self.abandon(gid, sid)
+        await self.clear_game(sid, gid)
+
+    async def abandon(self, gid, sid):
+        """The player leaves their game: if it is in progress, they lose the match"""
+
+        def abandon(game: Game):
+            if len(game.players) > 1 and not game.finished and sid in game.players:
+                # if game not finished, the player automatically loses the game
+                game.finished = True
+                return utils.opponent_ind(game.players.index(sid))
+            return None
+
+        game, winner_ind = await self.update_game(gid, sid, abandon)
+        if winner_ind is not None:
+            if not game.round_over:
+                self.archive.record(gid, game, Outcome.ABANDONED.value, winner_ind)
+            self.bus.publish(gid, Event("move", {"winner": winner_ind, "outcome": Outcome.ABANDONED.value, "matchScore": game.match_score}))
+            self.bus.publish(gid, Event("matchEnded", {"overallWinner": winner_ind}))
+            await self.settlement.enqueue(gid, game.player_wallet_addrs[game.players[winner_ind]])
+
+    async def handle_disconnect(self, sid):
+        """
+        With resumable sessions, a player who disconnects from a game in progress is given a grace period to resume it
+        (see resume) before forfeiting. Otherwise, or if the game is not in progress, they exit it
+        """
+        gid = self.gr.get_gid(sid)
+        if not RESUMABLE_SESSIONS or not gid:
+            return await self.handle_exit(sid)
+        game = await self.get_game_by_gid(gid, sid, read_only=True)
+        if game.finished or len(game.players) < 2:
+            return await self.handle_exit(sid)
+
+        await self.gr.remove_player_gid_record(sid)
+        await self.bus.unsubscribe(gid, sid)
+        await self.bus.drop_player(gid, sid)
+        await self.resumer.mark_away(gid, sid)
+        await self.scheduler.schedule("forfeit", ResumeConfig.GRACE_PERIOD, gid=gid, sid=sid)
+        opponent = next(p for p in game.players if p != sid)
+        self.bus.publish(gid, Event("opponentDisconnected", {"gracePeriod": ResumeConfig.GRACE_PERIOD}), opponent)
+
+    async def forfeit(self, gid, sid):
+        """A player who disconnected has not resumed within the grace period (scheduled job, idempotent)"""
+        game = await self.get_game_for_job(gid)
+        if game is None or sid not in game.players:
+            return  # game deleted, resumed, or already forfeited
+        await self.abandon(gid, sid)
+        await self.remove_player(gid, sid)
+        await self.resumer.clear_away(gid, sid)
+
+    async def resume(self, sid, gid, token):
+        """
+        Resume a game after a disconnect, within the grace period: the player rejoins under their new socket ID
 
-        await self.clear_game(sid, game, gid)
+        :param sid: player's new socket ID
+        :param gid: game ID
+        :param token: resume token sent to the player when the game started (or when they last resumed it)
+        :returns: tuple of the game and the events the player missed while away that it does not already reflect
+        """
+        old_sid = self.resumer.verify_token(gid, token) if RESUMABLE_SESSIONS else None
+        if old_sid is None:
+            raise CustomException("Invalid resume token", sid)
+        marker = await self.resumer.get_away_marker(gid, old_sid)
+        if marker is None:
+            raise CustomException("Session can't be resumed", sid)
+
+        def rejoin(game: Game):
+            if game.finished or old_sid not in game.players:
+                raise CustomException("Session can't be resumed", sid)
+            game.players[game.players.index(old_sid)] = sid
+            game.player_wallet_addrs[sid] = game.player_wallet_addrs.pop(old_sid)
+            game.match_score[sid] = game.match_score.pop(old_sid)
+            return True
+
+        await self.update_game(gid, sid, rejoin)
+        await self.scheduler.cancel("forfeit", gid=gid, sid=old_sid)  # a forfeit already under way finds the player gone
+        await self.resumer.clear_away(gid, old_sid)
+
+        await self.gr.add_player_gid_record(sid, gid)
+        await self.bus.subscribe(gid, sid)
+        # replay read after subscribing (so nothing falls in between) and after this worker's pending appends, and the
+        # state read last, so any move event also received live, or older than the state, is dropped from the replay
+        await self.resumer.flush_pending()
+        missed = await self.resumer.get_missed_events(gid, old_sid, marker)
+        game = await self.get_game_by_gid(gid, sid, read_only=True)
+        missed = self.filter_replay(missed, game)
+
+        opponent = next(p for p in game.players if p != sid)
+        self.bus.publish(gid, Event("opponentReconnected", None), opponent)
+        return game, missed
+
+    @staticmethod
+    def filter_replay(events, game: Game):
+        """
+        Drop the replayed events a resumed player's state snapshot already reflects: board moves of earlier rounds (before
+        the last start event) or up to the snapshot's ply, and resume tokens (a new one is sent)
+        """
+        last_start = max((i for i, e in enumerate(events) if e["name"] == "start"), default=-1)
+        ply = game.board.ply()
+        return [
+            e
+            for i, e in enumerate(events)
+            if e["name"] != "resumeToken"
+            and not (e["name"] == "move" and isinstance(e["data"], dict) and "seq" in e["data"] and (i < last_start or e["data"]["seq"] <= ply))
+        ]
+
+    async def get_game_for_job(self, gid, update_func=None):
+        """
+        Read a game for a scheduled job, or update it with update_func (returning the game and the function's result)
 
-    async def clear_game(self, sid, game, gid):
+        :returns: None if the game has been deleted, so the job is done. Raises if the game is there but could not be
+            read or updated (e.g. busy), so the job is retried later
+        """
+        try:
+            if update_func is None:
+                return await self.get_game_by_gid(gid, None, read_only=True)
+            return await self.update_game(gid, None, update_func)
+        except CustomException:
+            if await self.redis_client.exists(utils.get_redis_key(gid)):
+                raise
+            return None
+
+    async def clear_game(self, sid, gid):
         """Clears a user's game(s) from memory"""
-        self.gr.remove_player_gid_record(sid)
-        self.rmq.channel.queue_unbind(utils.get_queue_name(gid, sid), exchange=gid, routing_key=sid)
-        self.rmq.channel.queue_unbind(utils.get_queue_name(gid, sid), exchange=gid, routing_key=BROADCAST_KEY)
-        self.sio.leave_room(sid, gid)
-
-        if len(game.players) > 1:  # remove player from game.players
-            game.players.remove(sid)
-            await self.save_game(gid, game, sid)
-        else:  # last player to leave game
-            await self.sio.close_room(gid)
-            for ctag in self.gr.get_game_ctags(gid):
-                self.rmq.channel.basic_cancel(consumer_tag=ctag)
-            self.gr.remove_all_game_ctags(gid)
-            self.rmq.channel.exchange_delete(exchange=gid)
-            await self.redis_client.delete(utils.get_redis_key(gid))
+        await self.gr.remove_player_gid_record(sid)
+        await self.bus.unsubscribe(gid, sid)
+        await self.remove_player(gid, sid)
+
+    async def remove_player(self, gid, sid):
+        """Remove a player from a game, deleting the game if they were the last one in it"""
+
+        def remove_player(game: Game):
+            if len(game.players) > 1 and sid in game.players:  # remove player from game.players
+                game.players.remove(sid)
+                return True
+            return None
+
+        game, removed = await self.update_game(gid, sid, remove_player)
+        if not removed and sid in game.players:  # last player to leave game
+            await self.teardown_game(gid)
+            with metrics.redis_duration.labels("delete_game").time():
+                async with self.redis_client.pipeline(transaction=True) as pipe:
+                    pipe.delete(
+                        utils.get_redis_key(gid),
+                        utils.get_redis_version_key(gid),
+                        utils.get_redis_registry_key(gid),
+                        utils.get_redis_events_key(gid),
+                    )
+                    pipe.zrem(ACTIVE_GAMES_KEY, gid)
+                    if GameLobby.is_open(game):  # creator left before anyone joined
+                        self.remove_from_lobby(pipe, gid, game)
+                    await pipe.execute()
+
+    @staticmethod
+    def remove_from_lobby(pipe, gid, game):
+        """Queue the removal of an open game from the lobby index (and its notification) on a pipeline"""
+        entry = GameLobby.get_entry(gid, game)
+        for key in GameLobby.get_index_keys(game.time_control, game.n_rounds):
+            pipe.zrem(key, entry)
+        pipe.publish(LOBBY_KEY, GameLobby.get_message("remove", entry))
+
+    async def teardown_game(self, gid, sids=()):
+        """
+        Release the routing of a game's events (this worker's, and that of the players given, on any worker), and drop
+        it from the cache and clock
+        """
+        await self.bus.teardown_game(gid, sids)
+        self.cache.remove(gid)
+        self.clock.disarm(gid)
+
+    async def reap_games(self, gids):
+        """
+        Settle, tear down and delete games idle for longer than GAME_IDLE_TIMEOUT (e.g. left behind by a worker that
+        went away without its players disconnecting). Unfinished matches are settled as draws, refunding both players.
+        Games busy with an update are skipped until the next pass
+
+        :returns: number of games reaped
+        """
+
+        def abandon(game: Game):
+            if len(game.players) > 1 and not game.finished:
+                game.finished = True
+                return True
+            return None
+
+        still_open = {}  # gid -> game, for games no one joined
+        reaped = []
+        for gid in gids:
+            try:
+                try:
+                    game, abandoned = await self.update_game(gid, None, abandon)
+                except CustomException as exc:
+                    if exc.message != "Game not found":
+                        continue  # busy (so not idle after all): left for the next pass
+                    game, abandoned = None, None  # state already expired (lobby entry dropped when a lobby page reaches it)
+                reaped.append(gid)
+                if game is not None and GameLobby.is_open(game):
+                    still_open[gid] = game
+                if abandoned:
+                    if not game.round_over:
+                        self.archive.record(gid, game, Outcome.ABANDONED.value, None)
+                    self.bus.publish(gid, Event("matchEnded", {"overallWinner": None}))
+                    await self.settlement.enqueue(gid, None)
+                players = await self.gr.get_registered_players(gid)
+                # players are dropped before the game's event routing is torn down (see SettlementQueue._publish_status)
+                await self.redis_client.delete(utils.get_redis_registry_key(gid))
+                await self.teardown_game(gid, players)
+            except Exception as exc:
+                self.logger.error(f"Failed to reap game {gid}: {exc}")
+
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for gid in reaped:
+                pipe.delete(
+                    utils.get_redis_key(gid),
+                    utils.get_redis_version_key(gid),
+                    utils.get_redis_registry_key(gid),
+                    utils.get_redis_events_key(gid),
+                )
+            if reaped:
+                pipe.zrem(ACTIVE_GAMES_KEY, *reaped)
+            for gid, game in still_open.items():
+                self.remove_from_lobby(pipe, gid, game)
+            await pipe.execute()
+        self.logger.info(f"Reaped {len(reaped)} idle games")
+        return len(reaped)
@@ -1,35 +1,70 @@
+import os
+import uuid
 from collections import defaultdict
 
+import app.utils as utils
+from aioredis.client import Redis
+from app.constants import GAME_KEY_TTL
+
 
 class GameRegistry:
-    """Stores two hash tables mapping player IDs to game IDs and game IDs to MQ consumer tags, respectively"""
+    """
+    Stores hash tables mapping player IDs to game IDs, game IDs to MQ consumers (queue, consumer tag) and game IDs to
+    the players connected to this worker (used to dispatch messages in shared routing mode)
+
+    Player records are mirrored to Redis (a hash of player ID -> worker ID per game, expiring with the game's state), so
+    the players of a game left behind by a worker that went away can still be found and its queues torn down.
+    """
 
-    def __init__(self):
+    def __init__(self, redis_client: Redis):
+        self.redis_client = redis_client
+        self.worker_id = f"{os.getpid()}:{uuid.uuid4()}"
         self.players_to_gids = {}
-        self.gids_to_ctags = defaultdict(list)
+        self.gids_to_consumers = defaultdict(list)
+        self.gids_to_players = defaultdict(set)
 
     def get_gid(self, sid):
         return self.players_to_gids.get(sid, None)
 
-    def add_player_gid_record(self, sid, gid):
+    def get_players(self, gid):
+        return self.gids_to_players.get(gid, set())
+
+    async def get_registered_players(self, gid):
+        """Players of a game on any worker (player ID -> worker ID)"""
+        players = await self.redis_client.hgetall(utils.get_redis_registry_key(gid))
+        return {sid.decode(): worker_id.decode() for sid, worker_id in players.items()}
+
+    async def add_player_gid_record(self, sid, gid):
         self.players_to_gids[sid] = gid
+        self.gids_to_players[gid].add(sid)
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(utils.get_redis_registry_key(gid), sid, self.worker_id)
+            pipe.expire(utils.get_redis_registry_key(gid), GAME_KEY_TTL)
+            await pipe.execute()
 
-    def remove_player_gid_record(self, sid):
-        self.players_to_gids.pop(sid, None)
+    async def remove_player_gid_record(self, sid):
+        gid = self.players_to_gids.pop(sid, None)
+        if gid in self.gids_to_players:
+            self.gids_to_players[gid].discard(sid)
+            if not self.gids_to_players[gid]:
+                del self.gids_to_players[gid]
+        if gid is not None:
+            await self.redis_client.hdel(utils.get_redis_registry_key(gid), sid)
 
-    def get_game_ctags(self, gid):
-        return self.gids_to_ctags.get(gid, [])
+    def get_game_consumers(self, gid):
+        return self.gids_to_consumers.get(gid, [])
 
-    def add_game_ctag(self, gid, ctag):
-        self.gids_to_ctags[gid].append(ctag)
+    def add_game_consumer(self, gid, queue, ctag):
+        self.gids_to_consumers[gid].append((queue, ctag))
 
-    def remove_game_ctag(self, gid, ctag):
-        if gid in self.gids_to_ctags:
-            self.gids_to_ctags[gid].remove(ctag)
+    def remove_game_consumer(self, gid, queue, ctag):
+        if gid in self.gids_to_consumers:
+            self.gids_to_consumers[gid].remove((queue, ctag))
 
-    def remove_all_game_ctags(self, gid):
-        self.gids_to_ctags.pop(gid, None)
+    def remove_all_game_consumers(self, gid):
+        self.gids_to_consumers.pop(gid, None)
 
     def clear(self):
         self.players_to_gids.clear()
-        self.gids_to_ctags.clear()
+        self.gids_to_consumers.clear()
+        self.gids_to_players.clear()
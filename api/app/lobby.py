@@ -0,0 +1,174 @@
+import asyncio
+import json
+from logging import Logger
+
+import app.utils as utils
+from aioredis.client import Redis
+from app.constants import LOBBY_KEY
+from app.models import Game
+from fastapi import APIRouter, Query, Request
+from socketio.asyncio_server import AsyncServer
+
+router = APIRouter(tags=["lobby"])
+
+
+class LobbyConfig:
+    PAGE_SIZE = 50  # default number of games per page
+    MAX_PAGE_SIZE = 200
+    POLL_TIMEOUT = 1  # seconds to wait for a lobby change before checking the subscription again
+    ROOM = "lobby"  # Socket.IO room of the clients watching the lobby on this worker
+
+
+class GameLobby:
+    """
+    Index of open games (waiting for a second player), and lobby change notifications
+
+    Each open game has an entry "{wager}:{time control}:{rounds}:{game ID}" (wager zero-padded, so entries sort by
+    wager) in four sorted sets: all open games, and those with its time control, its number of rounds and both. All
+    scores are 0, so a page is a ZRANGEBYLEX on the set matching the filters, bounded by the wager range and the cursor
+    (the last entry of the previous page): O(log n + page size), with no game state read.
+
+    Entries are added and removed by GameController in the same Lua script or transaction as the game state, which
+    also publishes the change on the lobby channel. Each worker with clients watching the lobby subscribes to it and
+    emits changes to its lobby room. Entries left behind by game state expiring are dropped when a page reaches them.
+    """
+
+    def __init__(self, redis_client: Redis, sio: AsyncServer, logger: Logger):
+        self.redis_client = redis_client
+        self.sio = sio
+        self.logger = logger
+        self.pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        self.watchers = set()  # sids watching the lobby on this worker
+        self.reader = None
+
+    @staticmethod
+    def get_index_key(time_control=None, n_rounds=None):
+        key = LOBBY_KEY
+        if time_control is not None:
+            key += f":tc:{time_control}"
+        if n_rounds is not None:
+            key += f":rounds:{n_rounds}"
+        return key
+
+    @staticmethod
+    def get_index_keys(time_control, n_rounds):
+        """Sorted sets an open game with the given time control and number of rounds is indexed in"""
+        return [GameLobby.get_index_key(tc, rounds) for tc in (None, time_control) for rounds in (None, n_rounds)]
+
+    @staticmethod
+    def format_wager(wager: float):
+        return f"{max(wager, 0):020.8f}"
+
+    @staticmethod
+    def get_entry(gid: str, game: Game):
+        return f"{GameLobby.format_wager(game.wager)}:{game.time_control}:{game.n_rounds}:{gid}"
+
+    @staticmethod
+    def parse_entry(entry: str):
+        wager, time_control, n_rounds, gid = entry.split(":", 3)
+        return {"gameId": gid, "wagerAmount": float(wager), "timeControl": int(time_control), "totalRounds": int(n_rounds)}
+
+    @staticmethod
+    def is_open(game: Game):
+        return len(game.players) == 1 and not game.finished
+
+    @staticmethod
+    def get_message(op: str, entry: str):
+        """Lobby change notification ("add" or "remove" an open game)"""
+        return json.dumps({"op": op, "game": GameLobby.parse_entry(entry)})
+
+    async def read_page(self, cursor=None, limit=LobbyConfig.PAGE_SIZE, time_control=None, n_rounds=None, min_wager=None, max_wager=None):
+        """
+        Open games matching the filters, by ascending wager, after the cursor (an entry returned by the previous page)
+
+        :returns: tuple of the games and the cursor of the next page (None if there are no more). A page may hold
+                  fewer than limit games if some were stale
+        """
+        key = self.get_index_key(time_control, n_rounds)
+        lower = "-" if min_wager is None else f"[{self.format_wager(min_wager)}"
+        if cursor is not None and (lower == "-" or cursor >= lower[1:]):
+            lower = f"({cursor}"
+        upper = "+" if max_wager is None else f"({self.format_wager(max_wager)};"  # ";" sorts right after ":"
+        entries = [e.decode() for e in await self.redis_client.zrangebylex(key, lower, upper, start=0, num=limit)]
+        if not entries:
+            return [], None
+
+        games = [self.parse_entry(e) for e in entries]
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for game in games:
+                pipe.exists(utils.get_redis_key(game["gameId"]))
+            exists = await pipe.execute()
+        stale = [e for e, found in zip(entries, exists) if not found]
+        if stale:
+            await self.remove_stale(stale)
+        return [g for g, found in zip(games, exists) if found], entries[-1] if len(entries) == limit else None
+
+    async def remove_stale(self, entries):
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for entry in entries:
+                game = self.parse_entry(entry)
+                for key in self.get_index_keys(game["timeControl"], game["totalRounds"]):
+                    pipe.zrem(key, entry)
+                pipe.publish(LOBBY_KEY, self.get_message("remove", entry))
+            await pipe.execute()
+
+    async def read(self):
+        while True:
+            if not self.pubsub.subscribed:
+                await asyncio.sleep(LobbyConfig.POLL_TIMEOUT)
+                continue
+            try:
+                message = await self.pubsub.get_message(timeout=LobbyConfig.POLL_TIMEOUT)
+                if message is None:
+                    continue
+                # emitted to this worker's room members only, each worker notifies its own watchers
+                await self.sio.emit("lobbyUpdate", json.loads(message["data"]), room=LobbyConfig.ROOM, ignore_queue=True)
+            except Exception as exc:
+                self.logger.error(f"Failed to send lobby update: {exc}")
+                await asyncio.sleep(LobbyConfig.POLL_TIMEOUT)
+
+    def start(self):
+        self.reader = asyncio.create_task(self.read())
+
+    async def stop(self):
+        if self.reader:
+            self.reader.cancel()
+        await self.pubsub.close()
+
+    async def watch(self, sid):
+        """Start sending lobby changes to a client"""
+        if sid in self.watchers:
+            return
+        self.watchers.add(sid)
+        self.sio.enter_room(sid, LobbyConfig.ROOM)
+        if len(self.watchers) == 1:
+            await self.pubsub.subscribe(LOBBY_KEY)
+
+    async def unwatch(self, sid):
+        """Stop sending lobby changes to a client (e.g. once it has disconnected)"""
+        if sid not in self.watchers:
+            return
+        self.watchers.discard(sid)
+        self.sio.leave_room(sid, LobbyConfig.ROOM)
+        if not self.watchers:
+            await self.pubsub.unsubscribe(LOBBY_KEY)
+
+
+@router.get("/games/open")
+async def get_open_games(
+    request: Request,
+    cursor: str | None = None,
+    limit: int = Query(LobbyConfig.PAGE_SIZE, ge=1, le=LobbyConfig.MAX_PAGE_SIZE),
+    time_control: int | None = None,
+    rounds: int | None = None,
+    min_wager: float | None = Query(None, ge=0),
+    max_wager: float | None = Query(None, ge=0),
+):
+    """
+    Games waiting for a second player, by ascending wager
+
+    Filter by time control (minutes), number of rounds and wager range (MATIC). Pass the cursor returned with a page to
+    get the next one; it is null on the last page.
+    """
+    games, next_cursor = await request.app.state.lobby.read_page(cursor, limit, time_control, rounds, min_wager, max_wager)
+    return {"games": games, "cursor": next_cursor}
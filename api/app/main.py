@@ -2,19 +2,47 @@ import logging
 from contextlib import asynccontextmanager
 
 import aioredis
-from app.constants import ALCHEMY_API_URL, CLOUDAMQP_URL, REDIS_URL
-from app.exceptions import SocketIOExceptionHandler
+from app.affinity import WorkerRouter
+from app.archive import MatchArchive
+from app.archive import router as archive_router
+from app.constants import (
+    ALCHEMY_API_URL,
+    CLOUDAMQP_URL,
+    EVENT_BUS,
+    REDIS_URL,
+    RMQ_PUBLISHER_CONFIRMS,
+    SESSION_AFFINITY,
+    EventBusBackend,
+)
+from app.clock import GameClock
+from app.delivery import EmitScheduler
+from app.event_bus import create_event_bus
+from app.exceptions import CustomException, SocketIOExceptionHandler
+from app.exchange import ExchangeRateCache
 from app.exchange import router as exchange_router
+from app.game_cache import GameCache
 from app.game_contract import GameContract
 from app.game_controller import GameController
 from app.game_registry import GameRegistry
+from app.lobby import GameLobby
+from app.lobby import router as lobby_router
 from app.log_formatter import custom_formatter
+from app.matchmaking import Matchmaker
+from app.metrics import mark_process_dead
+from app.metrics import router as metrics_router
 from app.play_controller import PlayController
+from app.position_cache import PositionCache
 from app.rate_limit import TokenBucketRateLimiter
+from app.reaper import GameReaper
+from app.resume import SessionResumer
 from app.rmq import RMQConnectionManager
+from app.scheduler import JobScheduler
+from app.settlement import SettlementQueue
+from app.spectators import SpectatorHub
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi_socketio import SocketManager
+from socketio import AsyncRedisManager
 from web3 import AsyncWeb3
 from web3.middleware import async_geth_poa_middleware
 
@@ -26,35 +54,83 @@ logger.handlers[0].setFormatter(custom_formatter)
 w3 = AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(ALCHEMY_API_URL))
 w3.middleware_onion.inject(async_geth_poa_middleware, layer=0)
 
-# game registry
-gr = GameRegistry()
-
-# connection token bucket (rate limiting)
-rate_limiter = TokenBucketRateLimiter()
-
 # Redis client and MQ setup
 redis_client = aioredis.Redis.from_url(REDIS_URL)
 
-# RabbitMQ connection manager (pika)
-rmq = RMQConnectionManager(CLOUDAMQP_URL, logger)
+# game registry (mirrored to Redis)
+gr = GameRegistry(redis_client)
+
+# in-memory cache of live games
+game_cache = GameCache()
+
+# per-worker cache of legal moves etc. by position
+position_cache = PositionCache()
+
+# server-side game clock (flag detection)
+clock = GameClock(logger)
+
+# token buckets (rate limiting), shared by all workers
+rate_limiter = TokenBucketRateLimiter(redis_client, logger)
+
+# MATIC/GBP exchange rate cache
+exchange_rate_cache = ExchangeRateCache(redis_client)
+
+# RabbitMQ connection manager (aio-pika)
+rmq = RMQConnectionManager(CLOUDAMQP_URL, logger, publisher_confirms=RMQ_PUBLISHER_CONFIRMS)
+
+# archive of completed rounds (SQLite, written in the background)
+archive = MatchArchive(logger)
+
+# session affinity: pins games to a worker, forwarding events received on other workers
+router = WorkerRouter(redis_client, rmq, gr, logger)
 
 
 @asynccontextmanager
 async def lifespan(_):
     """Handles startup/shutdown"""
-    # Start token refiller
-    rate_limiter.start_refiller()
+    # Open pooled HTTP session for exchange rate API
+    await exchange_rate_cache.start()
+    # Connect to RabbitMQ (if used), and start the event bus
+    if EVENT_BUS == EventBusBackend.RABBITMQ or SESSION_AFFINITY:
+        await rmq.connect()
+    await bus.start()
+    # Open match archive and start its writer
+    await archive.start()
+    # Start worker heartbeat (liveness, and session affinity pins)
+    router.start()
+    # Start game clock, adopting the games in progress left behind by workers that went away (also done by the reaper)
+    clock.start(pc.timeout)
+    await gc.adopt_clocks()
+    # Start settlement sender (only the worker holding the signer lock sends transactions)
+    settlement.start()
+    # Start reaper of idle games (one worker per pass)
+    reaper.start()
+    # Load the resume token signing key
+    await resumer.start()
+    # Start polling for due jobs
+    scheduler.start()
+    # Start sending lobby changes to the clients watching it
+    lobby.start()
 
     yield
 
     # Clean up before shutdown
-    rate_limiter.stop_refiller()
+    clock.stop()
+    settlement.stop()
+    reaper.stop()
+    scheduler.stop()
+    await router.stop()
+    await archive.stop()  # write out queued rounds
+    await lobby.stop()
+    await bus.stop()
+    delivery.clear()  # drop undelivered events
     gr.clear()  # clear game registry
-    if rmq.channel is not None and rmq.channel.is_open:  # close MQ
-        rmq.channel.close()
-    async for key in redis_client.scan_iter("game:*"):  # clear all games from redis cache
-        await redis_client.delete(key)
+    game_cache.clear()  # clear game cache
+    await rmq.close()  # close MQ
+    await exchange_rate_cache.close()  # close HTTP session
+    # games are left in Redis for the other workers (and this one, after a restart); idle ones expire or are reaped
     await redis_client.close()  # close redis connection
+    mark_process_dead()  # drop this worker's live metrics
 
 
 chess_api = FastAPI(lifespan=lifespan)
@@ -71,27 +147,65 @@ chess_api.add_middleware(
 )
 
 chess_api.include_router(exchange_router)
+chess_api.include_router(metrics_router)
+chess_api.include_router(archive_router)
+chess_api.include_router(lobby_router)
+chess_api.state.exchange_rate_cache = exchange_rate_cache
+chess_api.state.archive = archive
 
-socket_manager = SocketManager(app=chess_api)
+# with session affinity, emits to a client connected to another worker go through Redis
+socket_manager = SocketManager(app=chess_api, client_manager=AsyncRedisManager(REDIS_URL) if SESSION_AFFINITY else None)
+
+# Open games index and lobby change notifications
+lobby = GameLobby(redis_client, chess_api.sio, logger)
+chess_api.state.lobby = lobby
 
 # Contract wrapper
 contract = GameContract(w3, logger)
 
+# Delivery of game events to clients on this worker
+delivery = EmitScheduler(chess_api.sio, logger)
+
+# Game events between workers (RabbitMQ, Redis pub/sub or in process), delivered locally when possible
+bus = create_event_bus(EVENT_BUS, rmq, redis_client, gr, delivery, logger)
+
+# On-chain settlement queue
+settlement = SettlementQueue(redis_client, contract, bus, logger)
+
+# Durable delayed jobs (e.g. round starts)
+scheduler = JobScheduler(redis_client, logger)
+
+# Resume tokens and per-game replay buffers (resumable sessions)
+resumer = SessionResumer(redis_client, bus, logger)
+
 # Game controller
-gc = GameController(rmq, redis_client, chess_api.sio, gr, contract, logger)
+gc = GameController(bus, redis_client, chess_api.sio, gr, game_cache, clock, settlement, delivery, scheduler, archive, resumer, logger)
+scheduler.register("start_round", gc.start_next_round)
+scheduler.register("forfeit", gc.forfeit)
+
+# Matchmaking queue (pairs players seeking a game)
+matchmaker = Matchmaker(redis_client, chess_api.sio, gc, scheduler, logger)
+scheduler.register("requeue_seek", matchmaker.requeue)
+
+# Reaper of idle games
+reaper = GameReaper(redis_client, gc, logger)
+
+# Spectators connected to this worker (one event bus subscription per watched game)
+spectators = SpectatorHub(bus, chess_api.sio, gc, logger)
 
 # Play (in game events) controller
-pc = PlayController(rmq, chess_api.sio, gc)
+pc = PlayController(bus, chess_api.sio, gc, position_cache)
 
 # Global exception handler for controller methods
-sioexc = SocketIOExceptionHandler(chess_api.sio, rmq, logger)
+sioexc = SocketIOExceptionHandler(chess_api.sio, bus, logger)
 
 # Connect/disconnect handlers
 
 
 @chess_api.sio.on("connect")
-async def connect(sid, _):
-    if rate_limiter.consume_token():
+async def connect(sid, environ):
+    rate_limiter.add_client(sid, environ)
+    if await rate_limiter.consume_token("connect", sid):
         logger.info(f"Client {sid} connected")
     else:
         await chess_api.sio.emit("error", "Connection limit exceeded", to=sid)
@@ -101,19 +215,48 @@ async def connect(sid, _):
 
 @chess_api.sio.on("disconnect")
 async def disconnect(sid):
-    await gc.handle_exit(sid)
+    rate_limiter.remove_client(sid)
+    delivery.remove(sid)
+    await spectators.unwatch(sid)
+    await lobby.unwatch(sid)
+    await matchmaker.release(sid)
+    await leave_game(sid)
     logger.info(f"Client {sid} disconnected")
 
 
+@router.route("disconnect")
+async def leave_game(sid):
+    await gc.handle_disconnect(sid)
+
+
 # Game management event handlers
 
 
 @chess_api.sio.on("create")
+@router.route("create")
 @sioexc.sio_exception_handler
 async def create(sid, time_control, wager, wallet_addr, n_rounds):
+    if not await rate_limiter.consume_token("create", sid, wallet_addr):
+        raise CustomException("Too many games created, please try again later", sid)
     await gc.create(sid, time_control, wager, wallet_addr, n_rounds)
 
 
+@chess_api.sio.on("seek")
+@router.route("seek")
+@sioexc.sio_exception_handler
+async def seek(sid, time_control, wager, wallet_addr, n_rounds):
+    if not await rate_limiter.consume_token("create", sid, wallet_addr):  # may create a game
+        raise CustomException("Too many games created, please try again later", sid)
+    await matchmaker.seek(sid, time_control, wager, wallet_addr, n_rounds)
+
+
+@chess_api.sio.on("cancelSeek")
+@sioexc.sio_exception_handler
+async def cancel_seek(sid):
+    """Decline the game a seek was matched with (to seek again, or stop)"""
+    await matchmaker.release(sid)
+
+
 @chess_api.sio.on("join")
 @sioexc.sio_exception_handler
 async def join(sid, gid):
@@ -121,6 +264,7 @@ async def join(sid, gid):
 
 
 @chess_api.sio.on("acceptGame")
+@router.route("acceptGame", by_gid=True)
 @sioexc.sio_exception_handler
 async def accept_game(sid, gid, wallet_addr):
     await gc.accept_game(sid, gid, wallet_addr)
@@ -132,46 +276,107 @@ async def accept_game(sid, gid, wallet_addr):
 @chess_api.sio.on("move")
 @sioexc.sio_exception_handler
 async def move(sid, uci):
+    if not await rate_limiter.consume_token("move", sid):  # before forwarding, the client's IP is known here
+        raise CustomException("Too many moves, slow down", sid)
+    await play_move(sid, uci)
+
+
+@router.route("move")
+@sioexc.sio_exception_handler
+async def play_move(sid, uci):
     await pc.move(sid, uci)
 
 
+@chess_api.sio.on("resume")
+@router.route("resume", by_gid=True)
+@sioexc.sio_exception_handler
+async def resume(sid, gid, token):
+    await pc.resume(sid, gid, token)
+
+
+@chess_api.sio.on("resync")
+@router.route("resync")
+@sioexc.sio_exception_handler
+async def resync(sid):
+    await pc.resync(sid)
+
+
 @chess_api.sio.on("offerDraw")
+@router.route("offerDraw")
 @sioexc.sio_exception_handler
 async def offer_draw(sid):
     await pc.offer_draw(sid)
 
 
 @chess_api.sio.on("acceptDraw")
+@router.route("acceptDraw")
 @sioexc.sio_exception_handler
 async def accept_draw(sid):
     await pc.accept_draw(sid)
 
 
 @chess_api.sio.on("resign")
+@router.route("resign")
 @sioexc.sio_exception_handler
 async def resign(sid):
     await pc.resign(sid)
 
 
-# NOTE: flag means run out of clock time
+# NOTE: flag means run out of clock time. Timeouts are detected by the server clock; a client flag (the flagged colour is
+# ignored) just prompts an early check
 
 
 @chess_api.sio.on("flag")
+@router.route("flag")
+@sioexc.sio_exception_handler
+async def flag(sid, _=None):
+    await pc.flag(sid)
+
+
+# Spectating (handled on the spectator's worker, which subscribes to the game's events once for all its spectators)
+
+
+@chess_api.sio.on("spectate")
+@sioexc.sio_exception_handler
+async def spectate(sid, gid):
+    if not await rate_limiter.consume_token("spectate", sid):
+        raise CustomException("Too many requests, slow down", sid)
+    await spectators.watch(sid, gid)
+
+
+@chess_api.sio.on("unspectate")
+@sioexc.sio_exception_handler
+async def unspectate(sid):
+    await spectators.unwatch(sid)
+
+
+# Lobby (open games are listed on /games/open, watchers are sent lobbyUpdate events as games open and fill up)
+
+
+@chess_api.sio.on("watchLobby")
+@sioexc.sio_exception_handler
+async def watch_lobby(sid):
+    await lobby.watch(sid)
+
+
+@chess_api.sio.on("unwatchLobby")
 @sioexc.sio_exception_handler
-async def flag(sid, flagged):
-    await pc.flag(sid, flagged)
+async def unwatch_lobby(sid):
+    await lobby.unwatch(sid)
 
 
 # Rematch (game management)
 
 
 @chess_api.sio.on("offerRematch")
+@router.route("offerRematch")
 @sioexc.sio_exception_handler
 async def offer_rematch(sid):
     await gc.offer_rematch(sid)
 
 
 @chess_api.sio.on("acceptRematch")
+@router.route("acceptRematch")
 @sioexc.sio_exception_handler
 async def accept_rematch(sid):
     await gc.accept_rematch(sid)
@@ -181,6 +386,7 @@ async def accept_rematch(sid):
 
 
 @chess_api.sio.on("exit")
+@router.route("exit")
 @sioexc.sio_exception_handler
 async def exit(sid):
     """When a client exits the game/match, clear it from game registry and cache"""
@@ -0,0 +1,140 @@
+import json
+import math
+from logging import Logger
+from time import time
+
+import aioredis
+import app.metrics as metrics
+import app.utils as utils
+from aioredis.client import Redis
+from app.exceptions import CustomException
+from app.game_controller import GameController
+from app.scheduler import JobScheduler
+from socketio.asyncio_server import AsyncServer
+
+
+class MatchmakingConfig:
+    WAGER_BAND_RATIO = 1.25  # wagers in the same band differ by less than this factor
+    MAX_CLAIMS = 5  # games claimed per seek before giving up on the queue (e.g. all since joined by code)
+    MAX_STALE_SKIPS = 20  # queued games discarded per claim because their state is gone (creator left)
+    CLAIM_TIMEOUT = 60  # seconds a paired player has to accept before the game is offered to other seekers
+
+
+class Matchmaker:
+    """
+    Pairs players seeking a game with the same time control, number of rounds and wager band
+
+    Each bucket is a Redis sorted set of open games created by seekers, scored by when they were queued. A seeker claims
+    the oldest game in their bucket (ZPOPMIN in a Lua script, so O(log n) and no two seekers can claim the same game)
+    and is sent its info to accept, as if they had joined it by code; if the bucket is empty, a game is created for
+    them and queued. Either way the match starts through the usual create/acceptGame flow (and on-chain deposits).
+
+    A player holds at most one claim (recorded in Redis, expiring after CLAIM_TIMEOUT). It is released, putting the game
+    back at its place in the queue, when they seek again, cancel or disconnect, or when it times out without the game
+    being accepted. Games are dropped from the queue lazily: claims skip games whose state is gone.
+    """
+
+    # KEYS: bucket. ARGV: game key prefix, max stale games skipped. Returns the claimed game ID and its score, or false
+    CLAIM_SCRIPT = """
+    for _ = 1, tonumber(ARGV[2]) do
+        local popped = redis.call("ZPOPMIN", KEYS[1])
+        if #popped == 0 then
+            return false
+        end
+        if redis.call("EXISTS", ARGV[1] .. popped[1]) == 1 then
+            return popped
+        end
+    end
+    return false
+    """
+
+    def __init__(self, redis_client: Redis, sio: AsyncServer, gc: GameController, scheduler: JobScheduler, logger: Logger):
+        self.redis_client = redis_client
+        self.sio = sio
+        self.gc = gc
+        self.scheduler = scheduler
+        self.logger = logger
+        self.claim_script = redis_client.register_script(self.CLAIM_SCRIPT)
+
+    @staticmethod
+    def get_wager_band(wager: float):
+        return math.floor(math.log(wager, MatchmakingConfig.WAGER_BAND_RATIO))
+
+    @staticmethod
+    def get_bucket_key(time_control, n_rounds, band):
+        return f"seeks:{time_control}:{n_rounds}:{band}"
+
+    @staticmethod
+    def get_claim_key(sid):
+        return f"seeks:claim:{sid}"
+
+    async def claim(self, bucket):
+        """Take the oldest open game off a bucket, or None if there are none"""
+        with metrics.redis_duration.labels("claim_seek").time():
+            claimed = await self.claim_script(keys=[bucket], args=[utils.get_redis_key(""), MatchmakingConfig.MAX_STALE_SKIPS])
+        if not claimed:
+            return None
+        gid, score = claimed
+        return gid.decode(), float(score)
+
+    async def seek(self, sid, time_control, wager, wallet_addr, n_rounds):
+        """
+        Find an opponent: join the oldest matching open game, or create one for others to join
+
+        :param sid: player's socket ID
+        :param time_control: time control in minutes
+        :param wager: wager amount (MATIC), the joined game's wager may differ from it within the band
+        :param wallet_addr: player's wallet address
+        :param n_rounds: number of rounds in the game
+        """
+        if self.gc.gr.get_gid(sid):
+            raise CustomException("You are already in a game", sid)
+        time_control, wager, n_rounds = self.gc.parse_game_options(sid, time_control, wager, n_rounds)
+        self.gc.check_wallet_addr(sid, wallet_addr)
+        bucket = self.get_bucket_key(time_control, n_rounds, self.get_wager_band(wager))
+
+        try:
+            await self.release(sid)  # a player holds at most one claim
+            for _ in range(MatchmakingConfig.MAX_CLAIMS):
+                claimed = await self.claim(bucket)
+                if claimed is None:
+                    break
+                gid, score = claimed
+                try:
+                    await self.gc.join(sid, gid)  # sends the game info, raises if it has filled up since it was queued
+                except CustomException:
+                    continue
+                claim = {"gid": gid, "bucket": bucket, "score": score}
+                if not await self.redis_client.set(self.get_claim_key(sid), json.dumps(claim), ex=MatchmakingConfig.CLAIM_TIMEOUT, nx=True):
+                    await self.requeue(**claim)  # claimed by a concurrent seek of the same player
+                    raise CustomException("Already matched, please accept or cancel", sid)
+                await self.scheduler.schedule("requeue_seek", MatchmakingConfig.CLAIM_TIMEOUT, **claim)
+                await self.sio.emit("matched", gid, to=sid)
+                return
+
+            await self.gc.create(sid, time_control, wager, wallet_addr, n_rounds)
+            await self.redis_client.zadd(bucket, {self.gc.gr.get_gid(sid): time()})
+        except aioredis.RedisError as exc:
+            raise CustomException(f"Redis error: {exc}", sid)
+
+    async def release(self, sid):
+        """Give up a player's claim, if any (seeking again, cancelled or disconnected), putting its game back in the queue"""
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.get(self.get_claim_key(sid))
+            pipe.delete(self.get_claim_key(sid))
+            raw, _ = await pipe.execute()
+        if raw is None:
+            return
+        claim = json.loads(raw)
+        try:
+            await self.requeue(**claim)
+        except Exception as exc:
+            self.logger.error(f"Failed to requeue game {claim['gid']} released by {sid}, left to the scheduled requeue: {exc}")
+            return
+        await self.scheduler.cancel("requeue_seek", **claim)
+
+    async def requeue(self, gid, bucket, score):
+        """Put a claimed game back in its bucket if it is still waiting for an opponent (scheduled job, idempotent)"""
+        game = await self.gc.get_game_for_job(gid)
+        if game is not None and len(game.players) == 1 and not game.finished:
+            await self.redis_client.zadd(bucket, {gid: score}, nx=True)
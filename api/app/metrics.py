@@ -0,0 +1,40 @@
+import os
+
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# NOTE: with several workers, set PROMETHEUS_MULTIPROC_DIR (to an empty directory) before starting the server, so
+# metrics are aggregated across worker processes
+
+router = APIRouter(tags=["metrics"])
+
+event_duration = Histogram("sio_event_duration_seconds", "Socket.IO event handler latency", ["event"])
+event_errors = Counter("sio_event_errors_total", "Socket.IO event handler errors", ["event", "kind"])
+events_in_flight = Gauge("sio_events_in_flight", "Socket.IO event handlers running", ["event"], multiprocess_mode="livesum")
+emit_duration = Histogram("sio_emit_duration_seconds", "Socket.IO emit latency", ["event"])
+emit_retries = Counter("sio_emit_retries_total", "Socket.IO emits retried", ["event"])
+emit_dead_letters = Counter("sio_emit_dead_letters_total", "Socket.IO emits given up on", ["event"])
+redis_duration = Histogram("redis_operation_duration_seconds", "Redis operation latency", ["operation"])
+publish_duration = Histogram("mq_publish_duration_seconds", "Time to serialise and queue an event for publishing", ["event"])
+bus_events = Counter("bus_events_total", "Game events published, by path (delivered in process or through the event bus backend)", ["path"])
+flush_duration = Histogram("mq_flush_duration_seconds", "Time to publish a batch of queued messages to RabbitMQ")
+flush_messages = Counter("mq_flushed_messages_total", "Messages sent to RabbitMQ", ["result"])
+chess_duration = Histogram("chess_operation_duration_seconds", "python-chess move validation and position analysis latency", ["operation"])
+contract_duration = Histogram("contract_call_duration_seconds", "Smart contract (node RPC) call latency", ["call"])
+
+
+def mark_process_dead():
+    """Drop this worker's live gauges from the aggregate (call on shutdown)"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+@router.get("/metrics")
+def get_metrics():
+    """Prometheus metrics, aggregated across workers in multiprocess mode"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
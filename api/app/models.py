@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from enum import Enum
-from typing import Dict, List, Optional, Tuple
+from typing import Counter, Dict, List, Optional, Tuple
 
 from chess import Board
 
@@ -36,6 +36,9 @@ class Game:
     round: int  # current round
     n_rounds: int  # number of rounds
     finished: bool = False  # whether the game has finished
+    round_over: bool = False  # whether the current round has finished (and the next one has not started yet)
+    version: int = 0  # version of the state in Redis this was read as (not serialised)
+    repetitions: Optional[Counter[int]] = None  # occurrences of each position (zobrist hash) this round (not serialised)
 
 
 @dataclass
@@ -56,6 +59,37 @@ class MoveData:
     isCheck: bool
     enPassant: bool
     legalMoves: List[str]
+    seq: int  # ply number of this move, lets clients detect missed events
+    timeRemainingWhite: int
+    timeRemainingBlack: int
+
+
+@dataclass
+class ResyncData:
+    # full board state, sent on request when a client detects a gap in move seq numbers
+    seq: int
+    fen: str
+    turn: int
+    isCheck: bool
+    legalMoves: List[str]
+    moveStack: List[str]
+    timeRemainingWhite: int
+    timeRemainingBlack: int
+
+
+@dataclass
+class SpectateData:
+    # game state sent to spectators when they start watching and at the start of each round
+    round: int
+    totalRounds: int
+    white: Optional[str]  # wallet addresses
+    black: Optional[str]
+    matchScore: Tuple[float, float]  # [black, white]
+    seq: int  # ply number, move events with seq <= this are already included
+    fen: str
+    turn: int
     moveStack: List[str]
     timeRemainingWhite: int
     timeRemainingBlack: int
+    roundOver: bool
+    finished: bool
@@ -1,20 +1,23 @@
 from time import time_ns
 
+import app.metrics as metrics
 import app.utils as utils
+from app.event_bus import EventBus
 from app.exceptions import CustomException
 from app.game_controller import GameController
-from app.models import Castles, Event, MoveData, Outcome
-from app.rmq import RMQConnectionManager
+from app.models import Castles, Event, Game, MoveData, Outcome, ResyncData
+from app.position_cache import PositionCache
 from chess import Move
 from socketio.asyncio_server import AsyncServer
 
 
 class PlayController:
 
-    def __init__(self, rmq: RMQConnectionManager, sio: AsyncServer, gc: GameController):
-        self.rmq = rmq
+    def __init__(self, bus: EventBus, sio: AsyncServer, gc: GameController, positions: PositionCache):
+        self.bus = bus
         self.sio = sio
         self.gc = gc
+        self.positions = positions
 
     def _update_match_score(self, game, outcome, winner_sid=None):
         if outcome == Outcome.AGREEMENT.value:
@@ -28,92 +31,193 @@ class PlayController:
         return game, tuple(match_score)
 
     async def move(self, sid, uci):
-        game, gid = await self.gc.get_game_by_sid(sid)
-        board = game.board
+        gid = self.gc.gr.get_gid(sid)
         move = Move.from_uci(uci)
-        castles, en_passant = None, False
-        if board.is_kingside_castling(move):
-            castles = Castles.KINGSIDE
-        elif board.is_queenside_castling(move):
-            castles = Castles.QUEENSIDE
-        elif board.is_en_passant(move):
-            en_passant = True
-
-        try:
-            board.push(move)
-            outcome = board.outcome(claim_draw=True)
-        except AssertionError:
-            # move not pseudo-legal
-            raise CustomException("Ilegal move", sid)
-
-        time_now = time_ns() / 1_000_000
-        if utils.opponent_ind(game.board.turn) == 0:
-            game.tr_b -= time_now - game.turn_start_time
-        else:
-            game.tr_w -= time_now - game.turn_start_time
-
-        game.turn_start_time = time_now
-
-        match_score = None
-        if outcome:
-            winner_sid = None
-            if outcome.winner is not None:
-                winner_sid = game.players[int(outcome.winner)]
-            game, match_score = self._update_match_score(game, outcome.termination.value, winner_sid)
 
-        move_data = MoveData(
+        def push_move(game: Game):
+            board = game.board
+            if game.round_over:
+                raise CustomException("Round has finished", sid)
+            if game.players[int(board.turn)] != sid:
+                raise CustomException("Not your turn", sid)
+            time_now = time_ns() / 1_000_000
+            if utils.time_remaining(game, time_now) <= 0:
+                return self._flag(sid)(game)  # ran out of time before moving (e.g. between the deadline and the clock tick)
+            with metrics.chess_duration.labels("validate").time():
+                legal = board.is_legal(move)
+            if not legal:
+                raise CustomException("Ilegal move", sid)
+
+            castles, en_passant = None, False
+            if board.is_kingside_castling(move):
+                castles = Castles.KINGSIDE
+            elif board.is_queenside_castling(move):
+                castles = Castles.QUEENSIDE
+            elif board.is_en_passant(move):
+                en_passant = True
+
+            with metrics.chess_duration.labels("push_analyse").time():
+                board.push(move)
+                position, outcome = self.positions.analyse(game)
+
+            if utils.opponent_ind(game.board.turn) == 0:
+                game.tr_b -= time_now - game.turn_start_time
+            else:
+                game.tr_w -= time_now - game.turn_start_time
+
+            game.turn_start_time = time_now
+
+            match_score = None
+            if outcome:
+                winner_sid = None
+                if outcome.winner is not None:
+                    winner_sid = game.players[int(outcome.winner)]
+                game, match_score = self._update_match_score(game, outcome.termination.value, winner_sid)
+                game.round_over = True
+
+            return MoveData(
+                turn=int(board.turn),
+                winner=int(outcome.winner) if outcome else None,
+                matchScore=match_score,
+                outcome=outcome.termination.value if outcome else None,
+                move=str(board.peek()),
+                castles=castles.value if castles else None,
+                isCheck=position.is_check,
+                enPassant=en_passant,
+                legalMoves=list(position.legal_moves),
+                seq=board.ply(),
+                timeRemainingWhite=game.tr_w,
+                timeRemainingBlack=game.tr_b,
+            )
+
+        game, move_data = await self.gc.update_game(gid, sid, push_move)
+        if not isinstance(move_data, MoveData):  # round ended on time instead
+            if move_data is not None:
+                await self._end_on_time(gid, game, move_data)
+            return
+
+        # send updated game state to players
+        self.bus.publish(gid, Event("move", move_data.__dict__))
+
+        if move_data.outcome:
+            await self.gc.handle_end_of_round(gid, game, move_data.outcome, move_data.winner)
+
+    def _resync_data(self, game: Game):
+        board = game.board
+        position = self.positions.lookup(board)
+        return ResyncData(
+            seq=board.ply(),
+            fen=board.fen(),
             turn=int(board.turn),
-            winner=int(outcome.winner) if outcome else None,
-            matchScore=match_score,
-            outcome=outcome.termination.value if outcome else None,
-            move=str(board.peek()),
-            castles=castles.value if castles else None,
-            isCheck=board.is_check(),
-            enPassant=en_passant,
-            legalMoves=[str(m) for m in board.legal_moves],
+            isCheck=position.is_check,
+            legalMoves=list(position.legal_moves),
             moveStack=[str(m) for m in board.move_stack],
             timeRemainingWhite=game.tr_w,
             timeRemainingBlack=game.tr_b,
         )
 
-        # send updated game state to clients in room
-        utils.publish_event(self.rmq.channel, gid, Event("move", move_data.__dict__))
-
-        if outcome:
-            await self.gc.handle_end_of_round(gid, game)
-        else:
-            await self.gc.save_game(gid, game, sid)
+    async def resync(self, sid):
+        """Send full board state to a client that has missed one or more move events"""
+        game, _ = await self.gc.get_game_by_sid(sid, read_only=True)
+        await self.sio.emit("resync", self._resync_data(game).__dict__, to=sid)  # N.B no need to publish this to MQ
+
+    async def resume(self, sid, gid, token):
+        """
+        Rejoin a game after a disconnect: sends the player's place in the match (and a new resume token), the full board
+        state, then the events they missed, in order
+        """
+        game, missed = await self.gc.resume(sid, gid, token)
+        resumed = {
+            "gameId": gid,
+            "colour": game.players.index(sid),
+            "round": game.round,
+            "totalRounds": game.n_rounds,
+            "matchScore": [game.match_score[pid] for pid in game.players],
+            "roundOver": game.round_over,
+            "resumeToken": self.gc.resumer.issue_token(gid, sid),
+        }
+        self.gc.delivery.emit(Event("resumed", resumed), sid)
+        self.gc.delivery.emit(Event("resync", self._resync_data(game).__dict__), sid)
+        for event in missed:
+            self.gc.delivery.emit(Event(**event), sid)
 
     async def offer_draw(self, sid):
-        game, gid = await self.gc.get_game_by_sid(sid)
-        utils.publish_event(self.rmq.channel, gid, Event("drawOffer", None), next(p for p in game.players if p != sid))
+        game, gid = await self.gc.get_game_by_sid(sid, read_only=True)
+        self.bus.publish(gid, Event("drawOffer", None), next(p for p in game.players if p != sid))
+
+    def _end_round(self, sid, outcome, winner_ind=None):
+        """Produces a game update that ends the current round with the given outcome"""
+
+        def end_round(game: Game):
+            if game.round_over:
+                raise CustomException("Round has finished", sid)
+            winner_sid = game.players[winner_ind] if winner_ind is not None else None
+            game, match_score = self._update_match_score(game, outcome, winner_sid)
+            game.round_over = True
+            return match_score
+
+        return end_round
 
     async def accept_draw(self, sid):
-        game, gid = await self.gc.get_game_by_sid(sid)
+        gid = self.gc.gr.get_gid(sid)
         outcome = Outcome.AGREEMENT.value
         # update match score
-        game, match_score = self._update_match_score(game, outcome, None)
-        utils.publish_event(self.rmq.channel, gid, Event("move", {"winner": None, "outcome": outcome, "matchScore": match_score}))
-        await self.gc.handle_end_of_round(gid, game)  # NOTE: this will save the updated match score to redis and start next round
+        game, match_score = await self.gc.update_game(gid, sid, self._end_round(sid, outcome))
+        self.bus.publish(gid, Event("move", {"winner": None, "outcome": outcome, "matchScore": match_score}))
+        await self.gc.handle_end_of_round(gid, game, outcome)
 
     async def resign(self, sid):
-        game, gid = await self.gc.get_game_by_sid(sid)
-        winner_ind = utils.opponent_ind(game.players.index(sid))
+        gid = self.gc.gr.get_gid(sid)
         outcome = Outcome.RESIGNATION.value
+
+        def resign(game: Game):
+            return self._end_round(sid, outcome, utils.opponent_ind(game.players.index(sid)))(game)
+
         # update match score
-        game, match_score = self._update_match_score(game, outcome, game.players[winner_ind])
+        game, match_score = await self.gc.update_game(gid, sid, resign)
+        winner_ind = utils.opponent_ind(game.players.index(sid))
         # outcome event
-        utils.publish_event(self.rmq.channel, gid, Event("move", {"winner": winner_ind, "outcome": outcome, "matchScore": match_score}))
-        # handle end of round (+ save match score)
-        await self.gc.handle_end_of_round(gid, game)
-
-    async def flag(self, sid, flagged):
-        game, gid = await self.gc.get_game_by_sid(sid)
-        winner_ind = utils.opponent_ind(flagged)
-        outcome = Outcome.TIMEOUT.value
-        # update match score
-        game, match_score = self._update_match_score(game, outcome, game.players[winner_ind])
+        self.bus.publish(gid, Event("move", {"winner": winner_ind, "outcome": outcome, "matchScore": match_score}))
+        # handle end of round
+        await self.gc.handle_end_of_round(gid, game, outcome, winner_ind)
+
+    async def flag(self, sid):
+        """Client reports that the player to move has run out of time (only acted on if the server clock agrees)"""
+        await self._flag_if_expired(self.gc.gr.get_gid(sid), sid)
+
+    async def timeout(self, gid):
+        """Fired by the server clock when the player to move in a game may have run out of time"""
+        try:
+            await self._flag_if_expired(gid)
+        except CustomException as exc:
+            self.gc.logger.error(f"Exception caught in timeout for game {gid}: {exc}")
+
+    def _flag(self, sid=None):
+        """Produces a game update that ends the current round on time, if the player to move has run out of it"""
+
+        def flag(game: Game):
+            if game.finished or game.round_over or len(game.players) < 2:
+                return None
+            if utils.time_remaining(game, time_ns() / 1_000_000) > 0:
+                return None  # clock has not run out (or has been reset by a move)
+            winner_ind = utils.opponent_ind(int(game.board.turn))
+            if game.board.turn:
+                game.tr_w = 0
+            else:
+                game.tr_b = 0
+            return self._end_round(sid, Outcome.TIMEOUT.value, winner_ind)(game), winner_ind
+
+        return flag
+
+    async def _end_on_time(self, gid, game, result):
+        match_score, winner_ind = result
         # outcome event
-        utils.publish_event(self.rmq.channel, gid, Event("move", {"winner": winner_ind, "outcome": outcome, "matchScore": match_score}))
-        # save game
-        await self.gc.handle_end_of_round(gid, game)
+        self.bus.publish(gid, Event("move", {"winner": winner_ind, "outcome": Outcome.TIMEOUT.value, "matchScore": match_score}))
+        # handle end of round
+        await self.gc.handle_end_of_round(gid, game, Outcome.TIMEOUT.value, winner_ind)
+
+    async def _flag_if_expired(self, gid, sid=None):
+        # update match score
+        game, result = await self.gc.update_game(gid, sid, self._flag(sid))
+        if result is not None:
+            await self._end_on_time(gid, game, result)
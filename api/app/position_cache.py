@@ -0,0 +1,94 @@
+from collections import Counter
+from typing import NamedTuple, Optional, Tuple
+
+from app.models import Game
+from chess import Board, Outcome, Termination
+from chess.polyglot import zobrist_hash
+from lru import LRU
+
+
+class PositionCacheConfig:
+    MAX_SIZE = 65536  # max number of positions held in memory per worker
+
+
+class PositionInfo(NamedTuple):
+    legal_moves: Tuple[str, ...]  # UCI
+    is_check: bool
+    outcome: Optional[Outcome]  # checkmate, stalemate or insufficient material (i.e. not depending on move history)
+
+
+class PositionCache:
+    """
+    Per-worker LRU cache of move generation results, keyed by position (Zobrist hash)
+
+    Openings are repeated across many games, so legal moves, check status and outcome only need computing once per
+    position. Outcomes that depend on the move history (repetitions, fifty/seventy-five move rules) are worked out
+    from the game's halfmove clock and its repetition counts, which are kept up to date move by move instead of
+    replaying the move stack.
+    """
+
+    def __init__(self, max_size=PositionCacheConfig.MAX_SIZE):
+        self.positions = LRU(max_size)  # zobrist hash -> PositionInfo
+
+    def lookup(self, board: Board, key: int | None = None) -> PositionInfo:
+        if key is None:
+            key = zobrist_hash(board)
+        info = self.positions.get(key)
+        if info is None:
+            info = self.positions[key] = self._analyse(board)
+        return info
+
+    def analyse(self, game: Game) -> Tuple[PositionInfo, Optional[Outcome]]:
+        """Position info for the game's current position, and the outcome of the round (as board.outcome(claim_draw=True))"""
+        board = game.board
+        key = zobrist_hash(board)
+        info = self.lookup(board, key)
+        repetitions = self._update_repetitions(game, key)
+        return info, self._outcome(board, info, repetitions, key)
+
+    @staticmethod
+    def _analyse(board: Board):
+        legal_moves = tuple(str(m) for m in board.legal_moves)
+        is_check = board.is_check()
+        outcome = None
+        if not legal_moves and is_check:
+            outcome = Outcome(Termination.CHECKMATE, not board.turn)
+        elif board.is_insufficient_material():
+            outcome = Outcome(Termination.INSUFFICIENT_MATERIAL, None)
+        elif not legal_moves:
+            outcome = Outcome(Termination.STALEMATE, None)
+        return PositionInfo(legal_moves, is_check, outcome)
+
+    @staticmethod
+    def _update_repetitions(game: Game, key: int):
+        """Count the current position, or recount the whole round if the counts are not one move behind the board"""
+        n_positions = len(game.board.move_stack) + 1
+        repetitions = game.repetitions
+        if repetitions is not None and repetitions.total() == n_positions - 1:
+            repetitions[key] += 1
+        elif repetitions is None or repetitions.total() != n_positions:
+            board = game.board.root()
+            repetitions = Counter([zobrist_hash(board)])
+            for move in game.board.move_stack:
+                board.push(move)
+                repetitions[zobrist_hash(board)] += 1
+            game.repetitions = repetitions
+        return repetitions
+
+    @staticmethod
+    def _outcome(board: Board, info: PositionInfo, repetitions: Counter, key: int):
+        # same order of precedence as board.outcome(claim_draw=True)
+        if info.outcome:
+            return info.outcome
+        if board.halfmove_clock >= 150:
+            return Outcome(Termination.SEVENTYFIVE_MOVES, None)
+        if repetitions[key] >= 5:
+            return Outcome(Termination.FIVEFOLD_REPETITION, None)
+        if board.halfmove_clock >= 99 and board.can_claim_fifty_moves():
+            return Outcome(Termination.FIFTY_MOVES, None)
+        if repetitions[key] >= 3:
+            return Outcome(Termination.THREEFOLD_REPETITION, None)
+        # a draw can also be claimed by a move into a position that has already occurred twice
+        if max(repetitions.values()) >= 2 and board.can_claim_threefold_repetition():
+            return Outcome(Termination.THREEFOLD_REPETITION, None)
+        return None
@@ -1,35 +1,86 @@
-import asyncio
+from logging import Logger
+
+import aioredis
+from aioredis.client import Redis
+from app.constants import TRUSTED_PROXY_HOPS
 
 
 class RateLimitConfig:
     CONCURRENT_GAME_LIMIT = 100
-    BUCKET_CAPACITY = 100
-    INITIAL_TOKENS = 20
-    REFILL_RATE_MINUTE = 4
+    # token buckets per action and scope: (capacity, refill rate per minute)
+    #   global - shared by all clients, ip - per client IP address, wallet - per player wallet address
+    BUCKETS = {
+        "connect": {"global": (100, 60), "ip": (20, 10)},
+        "create": {"global": (100, 30), "ip": (10, 4), "wallet": (10, 4)},
+        "move": {"ip": (120, 600)},
+        "spectate": {"ip": (30, 60)},
+    }
 
 
 class TokenBucketRateLimiter:
-    def __init__(self):
-        self.bucket = RateLimitConfig.INITIAL_TOKENS
-        self.refiller = None
+    """
+    Token bucket rate limiter shared across workers (state in Redis)
+
+    Tokens refill continuously based on the time elapsed since the bucket was last used, and an action is only allowed
+    if every bucket that applies to it (global, client IP, wallet) has a token, in which case one is taken from each.
+    Check and consume happen atomically in a Lua script, using the Redis server clock.
+    """
+
+    # KEYS: buckets. ARGV: capacity and refill rate (tokens/ms) of each bucket, in order. Returns 1 if allowed
+    CONSUME_SCRIPT = """
+    local t = redis.call("TIME")
+    local now = t[1] * 1000 + math.floor(t[2] / 1000)
+    local tokens = {}
+    for i, key in ipairs(KEYS) do
+        local capacity, rate = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+        local bucket = redis.call("HMGET", key, "tokens", "ts")
+        local last_tokens, last_ts = tonumber(bucket[1]) or capacity, tonumber(bucket[2]) or now
+        tokens[i] = math.min(capacity, last_tokens + math.max(0, now - last_ts) * rate)
+        if tokens[i] < 1 then
+            return 0
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        local capacity, rate = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+        redis.call("HSET", key, "tokens", tokens[i] - 1, "ts", now)
+        redis.call("PEXPIRE", key, math.ceil(capacity / rate))  -- bucket is full again by then
+    end
+    return 1
+    """
+
+    def __init__(self, redis_client: Redis, logger: Logger):
+        self.consume_script = redis_client.register_script(self.CONSUME_SCRIPT)
+        self.client_ips = {}  # sid -> client IP address, for clients connected to this worker
+        self.logger = logger
 
-    async def refill_tokens(self):
+    @staticmethod
+    def get_client_ip(environ):
         """
-        Refills tokens in the token bucket every minute based on REFILL_RATE_MINUTE
+        Client IP address: the X-Forwarded-For entry appended by the outermost trusted proxy (TRUSTED_PROXY_HOPS from
+        the end, as each proxy appends the peer it saw), or the peer address. Entries before it are set by the client
         """
-        while True:
-            await asyncio.sleep(60)
-            self.bucket = min(self.bucket + RateLimitConfig.REFILL_RATE_MINUTE, RateLimitConfig.BUCKET_CAPACITY)
+        forwarded = [ip.strip() for ip in environ.get("HTTP_X_FORWARDED_FOR", "").split(",") if ip.strip()]
+        if TRUSTED_PROXY_HOPS and len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+        return environ.get("REMOTE_ADDR")
 
-    def start_refiller(self):
-        asyncio.create_task(self.refill_tokens())
+    def add_client(self, sid, environ):
+        self.client_ips[sid] = self.get_client_ip(environ)
 
-    def stop_refiller(self):
-        if self.refiller:
-            self.refiller.cancel()
+    def remove_client(self, sid):
+        self.client_ips.pop(sid, None)
 
-    def consume_token(self):
-        if self.bucket > 0:
-            self.bucket -= 1
+    async def consume_token(self, action, sid=None, wallet_addr=None):
+        """Take a token from every bucket for the action; returns False if any of them is empty"""
+        ids = {"global": "all", "ip": self.client_ips.get(sid), "wallet": wallet_addr}
+        keys, args = [], []
+        for scope, (capacity, refill_rate_minute) in RateLimitConfig.BUCKETS[action].items():
+            if ids[scope] is None:
+                continue
+            keys.append(f"rate_limit:{action}:{scope}:{ids[scope]}")
+            args += [capacity, refill_rate_minute / 60000]
+        try:
+            return bool(await self.consume_script(keys=keys, args=args))
+        except aioredis.RedisError as exc:
+            self.logger.error(f"Rate limiter unavailable, allowing {action}: {exc}")  # fail open
             return True
-        return False
@@ -0,0 +1,56 @@
+import asyncio
+from logging import Logger
+from time import time
+
+from aioredis.client import Redis
+from app.constants import ACTIVE_GAMES_KEY, GAME_IDLE_TIMEOUT, REAPER_LOCK_KEY
+from app.game_controller import GameController
+
+
+class ReaperConfig:
+    INTERVAL = 60  # seconds between passes (across all workers)
+    BATCH_SIZE = 100  # games reaped per batch
+    MAX_BATCHES = 10  # batches per pass, a larger backlog is worked through over several passes
+
+
+class GameReaper:
+    """
+    Garbage collects games that have been idle for longer than GAME_IDLE_TIMEOUT
+
+    One worker per interval (whichever takes the lock first) settles, tears down and deletes idle games, in bounded
+    batches, so orphaned games don't keep counting toward the concurrent game limit or hold on to broker resources. It
+    also adopts the clocks of games in progress left behind by workers that went away, so they still flag.
+    """
+
+    def __init__(self, redis_client: Redis, gc: GameController, logger: Logger):
+        self.redis_client = redis_client
+        self.gc = gc
+        self.logger = logger
+        self.runner = None
+
+    async def run(self):
+        while True:
+            try:
+                # the lock is left to expire, so passes are at least an interval apart whichever worker runs them
+                if await self.redis_client.set(REAPER_LOCK_KEY, self.gc.gr.worker_id, px=ReaperConfig.INTERVAL * 1000, nx=True):
+                    await self.reap()
+                    await self.gc.adopt_clocks()
+            except Exception as exc:
+                self.logger.error(f"Reaper pass failed: {exc}")
+            await asyncio.sleep(ReaperConfig.INTERVAL)
+
+    async def reap(self):
+        skipped = 0  # games left for the next pass stay at the front of the range
+        for _ in range(ReaperConfig.MAX_BATCHES):
+            cutoff = time() - GAME_IDLE_TIMEOUT
+            gids = await self.redis_client.zrangebyscore(ACTIVE_GAMES_KEY, "-inf", cutoff, start=skipped, num=ReaperConfig.BATCH_SIZE)
+            if not gids:
+                return
+            skipped += len(gids) - await self.gc.reap_games([gid.decode() for gid in gids])
+
+    def start(self):
+        self.runner = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.runner:
+            self.runner.cancel()
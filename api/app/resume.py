@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import secrets
+from collections import deque
+from logging import Logger
+
+import app.utils as utils
+from aioredis.client import Redis
+from app.constants import BROADCAST_KEY, GAME_KEY_TTL, RESUMABLE_SESSIONS, RESUME_SECRET, SPECTATOR_KEY
+from app.event_bus import EventBus
+
+
+class ResumeConfig:
+    GRACE_PERIOD = 30  # seconds a disconnected player has to resume before forfeiting
+    REPLAY_BUFFER_LEN = 200  # events kept per game for replay (approximate, oldest trimmed first)
+    MAX_PENDING = 10000  # events awaiting a write to the replay buffers (oldest dropped first)
+    SECRET_KEY = "resume:secret"  # shared token signing key, generated by the first worker if RESUME_SECRET is not set
+
+
+class SessionResumer:
+    """
+    Resumable sessions: resume tokens, players away (disconnected within their grace period) and per-game replay buffers
+
+    A resume token is an HMAC of the game and player IDs, so it is checked without a lookup. Every game event published
+    is also appended (in batches, once per event loop iteration) to a capped Redis stream per game. When a player
+    disconnects, the position of the stream is recorded, so on resuming they can be sent just the events they missed.
+    """
+
+    def __init__(self, redis_client: Redis, bus: EventBus, logger: Logger):
+        self.redis_client = redis_client
+        self.logger = logger
+        self.secret = RESUME_SECRET.encode() if RESUME_SECRET else None
+        self.pending = deque()  # (gid, routing key, body)
+        self.flusher = None
+        if RESUMABLE_SESSIONS:
+            bus.add_on_publish_callback(self.on_publish)
+
+    @staticmethod
+    def get_away_key(gid, sid):
+        return f"away:{gid}:{sid}"
+
+    async def start(self):
+        if RESUMABLE_SESSIONS and self.secret is None:
+            await self.redis_client.set(ResumeConfig.SECRET_KEY, secrets.token_hex(32), nx=True)
+            self.secret = await self.redis_client.get(ResumeConfig.SECRET_KEY)
+
+    def issue_token(self, gid, sid):
+        digest = hmac.new(self.secret, f"{gid}:{sid}".encode(), hashlib.sha256).hexdigest()
+        return f"{sid}.{digest}"
+
+    def verify_token(self, gid, token: str):
+        """Player ID the token was issued to for the game, or None if it is not valid"""
+        sid, _, _ = str(token).rpartition(".")
+        if sid and hmac.compare_digest(self.issue_token(gid, sid), token):
+            return sid
+        return None
+
+    def on_publish(self, gid: str, routing_key: str, body: bytes):
+        """Queue a published game event for its game's replay buffer"""
+        if routing_key == SPECTATOR_KEY:
+            return
+        if len(self.pending) >= ResumeConfig.MAX_PENDING:
+            self.logger.error("Replay buffer queue full, dropping oldest event")
+            self.pending.popleft()
+        self.pending.append((gid, routing_key, body))
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush())
+
+    async def flush_pending(self):
+        """Wait for the events published on this worker so far to be appended to their replay buffers"""
+        if self.flusher is not None and not self.flusher.done():
+            await asyncio.shield(self.flusher)
+
+    async def flush(self):
+        while self.pending:
+            batch = list(self.pending)
+            self.pending.clear()
+            try:
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for gid, routing_key, body in batch:
+                        key = utils.get_redis_events_key(gid)
+                        pipe.xadd(key, {"rk": routing_key, "event": body}, maxlen=ResumeConfig.REPLAY_BUFFER_LEN, approximate=True)
+                        pipe.expire(key, GAME_KEY_TTL)
+                    await pipe.execute()
+            except Exception as exc:
+                self.logger.error(f"Failed to append {len(batch)} events to replay buffers: {exc}")
+
+    async def mark_away(self, gid, sid):
+        """Record that a player has disconnected, and the position in the game's replay buffer at that point"""
+        last = await self.redis_client.xrevrange(utils.get_redis_events_key(gid), count=1)
+        marker = last[0][0] if last else b"0-0"
+        await self.redis_client.set(self.get_away_key(gid, sid), marker, ex=ResumeConfig.GRACE_PERIOD * 2)
+
+    async def get_away_marker(self, gid, sid):
+        """Replay buffer position at which a player disconnected, or None if they are not away"""
+        marker = await self.redis_client.get(self.get_away_key(gid, sid))
+        return marker.decode() if marker else None
+
+    async def clear_away(self, gid, sid):
+        await self.redis_client.delete(self.get_away_key(gid, sid))
+
+    async def get_missed_events(self, gid, sid, marker):
+        """Events for a player (by the ID they disconnected with) published since the given replay buffer position"""
+        entries = await self.redis_client.xrange(utils.get_redis_events_key(gid), min=f"({marker}", count=ResumeConfig.REPLAY_BUFFER_LEN)
+        events = []
+        for _, fields in entries:
+            if fields[b"rk"].decode() in (BROADCAST_KEY, sid):
+                events.append(json.loads(fields[b"event"]))
+        return events
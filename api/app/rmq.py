@@ -1,30 +1,80 @@
+import asyncio
+import random
+from collections import deque
 from logging import Logger
 
-from pika import URLParameters
-from pika.adapters.asyncio_connection import AsyncioConnection
+import aio_pika
+import app.metrics as metrics
+from aio_pika.abc import AbstractRobustChannel, AbstractRobustConnection
+from aio_pika.exceptions import AMQPConnectionError
+from aio_pika.pool import Pool
 
-# TODO: just use aio-pika - much easier than callback hell
+
+class RMQConfig:
+    CHANNEL_POOL_SIZE = 4  # number of channels used for publishing
+    RECONNECT_INTERVAL = 2  # seconds between reconnection attempts once connected
+    CONNECT_BACKOFF_INITIAL = 0.5  # initial connection attempt backoff (seconds), doubles up to CONNECT_BACKOFF_MAX
+    CONNECT_BACKOFF_MAX = 30
+    MAX_PENDING_MESSAGES = 10000  # messages buffered while the broker is unavailable (oldest dropped first)
+    MAX_PUBLISH_ATTEMPTS = 3
 
 
 class RMQConnectionManager:
-    def __init__(self, url: str, logger: Logger):
-        self.channel = None
+    """
+    Robust RabbitMQ connection (aio-pika)
+
+    The connection reconnects automatically; exchanges, queues, bindings and consumers declared on the channel are
+    re-declared on reconnect. Messages are published from a pool of channels, in batches: everything published during
+    one event loop iteration goes out together, and with publisher confirms the batch is confirmed together rather
+    than waiting for one round trip per message.
+    """
+
+    def __init__(self, url: str, logger: Logger, publisher_confirms=False):
+        self.url = url
         self.logger = logger
-        self.rmq_params = URLParameters(url)
-        self.rmq_conn = AsyncioConnection(
-            self.rmq_params,
-            on_open_callback=lambda conn: self.setup_rmq(conn, self.set_channel),
-            on_open_error_callback=lambda _, err: self.on_connection_open_error(
-                err,
-            ),
-            on_close_callback=lambda _, reason: self.on_connection_closed(reason),
-        )
-
-    def set_channel(self, ch):
-        self.channel = ch
-
-    def setup_rmq(self, conn, set_channel):
-        conn.channel(on_open_callback=lambda ch: self.on_channel_open(ch, conn, set_channel))
+        self.publisher_confirms = publisher_confirms
+        self.connection: AbstractRobustConnection = None
+        self.channel: AbstractRobustChannel = None  # topology and consumers
+        self.channel_pool: Pool = None  # publishing
+        self.on_channel_open_callbacks = []
+        self.pending = deque()  # (exchange, routing key, body, attempts)
+        self.flusher = None
+
+    async def connect(self):
+        backoff = RMQConfig.CONNECT_BACKOFF_INITIAL
+        while True:
+            try:
+                self.connection = await aio_pika.connect_robust(self.url, reconnect_interval=RMQConfig.RECONNECT_INTERVAL)
+                break
+            except (AMQPConnectionError, OSError) as err:
+                self.on_connection_open_error(err)
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+                backoff = min(backoff * 2, RMQConfig.CONNECT_BACKOFF_MAX)
+
+        self.connection.reconnect_callbacks.add(lambda _: self.on_reconnected())
+        self.connection.close_callbacks.add(lambda _, reason: self.on_connection_closed(reason))
+
+        self.channel = await self.connection.channel()
+        self.channel_pool = Pool(self.open_publish_channel, max_size=RMQConfig.CHANNEL_POOL_SIZE)
+        self.logger.info("Channel opened")
+        for callback in self.on_channel_open_callbacks:
+            await callback(self.channel)
+        self.schedule_flush()  # anything published before the connection was up
+
+    async def open_publish_channel(self):
+        return await self.connection.channel(publisher_confirms=self.publisher_confirms)
+
+    async def close(self):
+        if self.flusher:
+            await self.flusher
+        if self.channel_pool:
+            await self.channel_pool.close()
+        if self.connection:
+            await self.connection.close()
+
+    def add_on_channel_open_callback(self, callback):
+        """Register a coroutine function to be called with the channel once it is open (e.g. to declare topology)"""
+        self.on_channel_open_callbacks.append(callback)
 
     def on_connection_open_error(self, err):
         self.logger.error("Connection open failed: %s", err)
@@ -32,10 +82,47 @@ class RMQConnectionManager:
     def on_connection_closed(self, reason):
         self.logger.warning("Connection closed: %s", reason)
 
-    def on_channel_closed(self, conn):
-        conn.close()
+    def on_reconnected(self):
+        self.logger.info("Connection re-established")
+        self.schedule_flush()
 
-    def on_channel_open(self, ch, conn, set_channel):
-        self.logger.info("Channel opened")
-        set_channel(ch)
-        ch.add_on_close_callback(lambda _, __: self.on_channel_closed(conn))
+    @property
+    def is_connected(self):
+        return self.connection is not None and not self.connection.is_closed
+
+    def publish(self, exchange: str, routing_key: str, body: bytes):
+        """Queue a message to be published at the end of the current event loop iteration"""
+        if len(self.pending) >= RMQConfig.MAX_PENDING_MESSAGES:
+            self.logger.error("Publish buffer full, dropping oldest message")
+            self.pending.popleft()
+        self.pending.append((exchange, routing_key, body, 0))
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        while self.pending and self.is_connected and self.channel_pool is not None:
+            batch = list(self.pending)
+            self.pending.clear()
+            try:
+                with metrics.flush_duration.time():
+                    async with self.channel_pool.acquire() as channel:
+                        results = await asyncio.gather(*(self._publish(channel, *msg[:3]) for msg in batch), return_exceptions=True)
+            except Exception as exc:
+                results = [exc] * len(batch)
+
+            failed = [(*msg[:3], msg[3] + 1) for msg, res in zip(batch, results) if isinstance(res, Exception)]
+            metrics.flush_messages.labels("published").inc(len(batch) - len(failed))
+            metrics.flush_messages.labels("failed").inc(len(failed))
+            if failed:
+                self.logger.error(f"Failed to publish {len(failed)} message(s): {next(r for r in results if isinstance(r, Exception))}")
+                retry = [msg for msg in failed if msg[3] < RMQConfig.MAX_PUBLISH_ATTEMPTS]
+                self.pending.extendleft(reversed(retry))  # keep original order ahead of newer messages
+                await asyncio.sleep(RMQConfig.RECONNECT_INTERVAL)
+        # if the connection is down, pending messages are flushed on reconnect
+
+    async def _publish(self, channel: AbstractRobustChannel, exchange: str, routing_key: str, body: bytes):
+        exchange = await channel.get_exchange(exchange, ensure=False)
+        await exchange.publish(aio_pika.Message(body), routing_key=routing_key)
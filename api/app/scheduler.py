@@ -0,0 +1,111 @@
+import asyncio
+import json
+from logging import Logger
+from time import time
+
+from aioredis.client import Redis
+from app.constants import DEAD_JOBS_KEY, DELAYED_JOBS_KEY, JOB_ATTEMPTS_KEY
+
+
+class SchedulerConfig:
+    TICK_INTERVAL = 0.5  # seconds between polls for due jobs
+    BATCH_SIZE = 100  # max jobs claimed per poll
+    LEASE = 30  # seconds a claimed job has to complete before it is due again (e.g. if its worker died)
+    MAX_ATTEMPTS = 5  # times a job is claimed before it is moved to the dead jobs list
+
+
+class JobScheduler:
+    """
+    Durable delayed jobs (e.g. starting the next round of a match), in a Redis sorted set scored by due time
+
+    Every worker polls for due jobs; claiming a job pushes its due time back by a lease rather than removing it, and it
+    is only removed once its handler has completed. Jobs are therefore run at least once, even if a worker goes away
+    mid-job, so handlers must be idempotent. Scheduling the same job (type and arguments) again is a no-op. Nothing is
+    held in memory per pending job. Claims are counted, and a job still not completed after MAX_ATTEMPTS (e.g. its
+    handler keeps failing, or none is registered for its type) is moved to the dead jobs list.
+    """
+
+    # KEYS: jobs, job attempts, dead jobs. ARGV: now, max jobs, lease, max attempts. Returns the due jobs claimed, with
+    # their due time pushed back by the lease, and those moved to the dead jobs list instead
+    CLAIM_SCRIPT = """
+    local jobs = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+    local claimed, dead = {}, {}
+    for _, job in ipairs(jobs) do
+        if redis.call("HINCRBY", KEYS[2], job, 1) > tonumber(ARGV[4]) then
+            redis.call("ZREM", KEYS[1], job)
+            redis.call("HDEL", KEYS[2], job)
+            redis.call("RPUSH", KEYS[3], job)
+            table.insert(dead, job)
+        else
+            redis.call("ZADD", KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[3]), job)
+            table.insert(claimed, job)
+        end
+    end
+    return {claimed, dead}
+    """
+
+    def __init__(self, redis_client: Redis, logger: Logger):
+        self.redis_client = redis_client
+        self.logger = logger
+        self.claim_script = redis_client.register_script(self.CLAIM_SCRIPT)
+        self.handlers = {}  # job type -> coroutine function called with the job's arguments
+        self.ticker = None
+        self.running = set()  # jobs being run (referenced until done)
+
+    @staticmethod
+    def _job_key(job_type: str, args: dict):
+        return json.dumps({"type": job_type, **args}, sort_keys=True)
+
+    def register(self, job_type: str, handler):
+        self.handlers[job_type] = handler
+
+    async def schedule(self, job_type: str, delay: float, **args):
+        """Run a job (handler registered for job_type, called with args) in delay seconds"""
+        await self.redis_client.zadd(DELAYED_JOBS_KEY, {self._job_key(job_type, args): time() + delay}, nx=True)
+
+    async def cancel(self, job_type: str, **args):
+        await self._remove(self._job_key(job_type, args))
+
+    async def _remove(self, job):
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.zrem(DELAYED_JOBS_KEY, job)
+            pipe.hdel(JOB_ATTEMPTS_KEY, job)
+            await pipe.execute()
+
+    async def tick(self):
+        while True:
+            await asyncio.sleep(SchedulerConfig.TICK_INTERVAL)
+            try:
+                jobs, dead = await self.claim_script(
+                    keys=[DELAYED_JOBS_KEY, JOB_ATTEMPTS_KEY, DEAD_JOBS_KEY],
+                    args=[time(), SchedulerConfig.BATCH_SIZE, SchedulerConfig.LEASE, SchedulerConfig.MAX_ATTEMPTS],
+                )
+            except Exception as exc:
+                self.logger.error(f"Failed to poll for due jobs: {exc}")
+                continue
+            for job in dead:
+                self.logger.error(f"Job {job.decode()} failed {SchedulerConfig.MAX_ATTEMPTS} times, moved to {DEAD_JOBS_KEY}")
+            for job in jobs:
+                task = asyncio.create_task(self._run(job))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+
+    async def _run(self, job: bytes):
+        args = json.loads(job)
+        job_type = args.pop("type")
+        handler = self.handlers.get(job_type)
+        if handler is None:  # e.g. scheduled by a newer version of the app, retried in case a worker running it claims it
+            self.logger.error(f"No handler for job {job_type} {args}")
+            return
+        try:
+            await handler(**args)
+            await self._remove(job)
+        except Exception as exc:  # retried once the lease expires
+            self.logger.error(f"Job {job_type} {args} failed: {exc}")
+
+    def start(self):
+        self.ticker = asyncio.create_task(self.tick())
+
+    def stop(self):
+        if self.ticker:
+            self.ticker.cancel()
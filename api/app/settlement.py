@@ -0,0 +1,230 @@
+import asyncio
+import json
+import math
+import os
+import uuid
+from logging import Logger
+from time import time
+
+import app.utils as utils
+from aioredis.client import Redis
+from app.constants import SETTLEMENT_FAILED_KEY, SETTLEMENT_INFLIGHT_KEY, SETTLEMENT_LOCK_KEY, SETTLEMENT_QUEUE_KEY
+from app.event_bus import EventBus
+from app.game_contract import GameContract
+from app.models import Event
+
+
+class SettlementConfig:
+    POLL_INTERVAL = 2  # seconds between passes over the queue and in-flight transactions
+    BUMP_AFTER = 60  # seconds without a receipt after which a transaction is resent with higher fees
+    FEE_BUMP = 1.125  # replacement transactions need fees at least 10% higher
+    MAX_ATTEMPTS = 5  # attempts to send a job before it is moved to the failed list
+    LOCK_TTL = 30000  # signer lock TTL (ms), refreshed on every pass and before every transaction sent
+    MAX_SENDS_PER_PASS = 20  # queued jobs sent per pass
+
+
+class SettlementStatus:
+    QUEUED = "queued"
+    SUBMITTED = "submitted"
+    CONFIRMED = "confirmed"
+    FAILED = "failed"
+
+
+class SignerLockLost(Exception):
+    pass
+
+
+class SettlementQueue:
+    """
+    Durable queue of on-chain match settlements (declareWinner/declareDraw)
+
+    Socket handlers only enqueue jobs in Redis. One worker at a time (holding the signer lock) sends them, managing the
+    account nonce locally so concurrent settlements can't collide, and tracks receipts without blocking: transactions
+    that stay unmined are resent with the same nonce and bumped fees. A transaction is recorded as in flight (with its
+    nonce and signed form) before it is sent, so a send that fails is retried with the same nonce, and a new nonce is
+    only used if the chain shows the old one taken by another transaction. Players still in the game get a "settlement"
+    event as a job progresses.
+    """
+
+    # KEYS: lock. ARGV: owner, ttl (ms). Takes the lock if free, or refreshes it if already held by owner
+    LOCK_SCRIPT = """
+    local owner = redis.call("GET", KEYS[1])
+    if owner == false then
+        return redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2]) and 1 or 0
+    elseif owner == ARGV[1] then
+        return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    def __init__(self, redis_client: Redis, contract: GameContract, bus: EventBus, logger: Logger):
+        self.redis_client = redis_client
+        self.contract = contract
+        self.bus = bus
+        self.logger = logger
+        self.lock_script = redis_client.register_script(self.LOCK_SCRIPT)
+        self.worker_id = f"{os.getpid()}:{uuid.uuid4()}"
+        self.nonce = None  # next nonce to use, only set while this worker is the signer
+        self.runner = None
+
+    async def enqueue(self, gid: str, winner_addr: str | None):
+        """Queue settlement of a match (winner_addr None for a draw)"""
+        job = {"gid": gid, "winner": winner_addr, "attempts": 0}
+        await self.redis_client.rpush(SETTLEMENT_QUEUE_KEY, json.dumps(job))
+        await self._publish_status(gid, SettlementStatus.QUEUED)
+
+    async def _publish_status(self, gid, status, tx_hash=None):
+        """
+        Send a job's status to the game's players, unless both have left: the routing of its events is then torn down (or
+        about to be), and publishing to a deleted per game exchange would close the shared publish channel
+        """
+        if not await self.redis_client.exists(utils.get_redis_registry_key(gid)):  # players leave the registry first
+            return
+        self.bus.publish(gid, Event("settlement", {"status": status, "txHash": tx_hash}))
+
+    async def run(self):
+        while True:
+            try:
+                if await self._hold_lock():
+                    if self.nonce is None:
+                        await self._sync_nonce()
+                        self.logger.info(f"Worker {self.worker_id} is settlement signer, next nonce {self.nonce}")
+                    await self._track_inflight()
+                    await self._send_queued()
+                else:
+                    self.nonce = None
+            except SignerLockLost:
+                self.logger.warning(f"Worker {self.worker_id} lost the settlement signer lock mid-pass")
+                self.nonce = None
+            except Exception as exc:
+                self.logger.error(f"Settlement pass failed: {exc}")
+                self.nonce = None  # re-sync nonce
+            await asyncio.sleep(SettlementConfig.POLL_INTERVAL)
+
+    async def _hold_lock(self):
+        """Take or refresh the signer lock; returns False if another worker holds it"""
+        return bool(await self.lock_script(keys=[SETTLEMENT_LOCK_KEY], args=[self.worker_id, SettlementConfig.LOCK_TTL]))
+
+    async def _ensure_lock(self):
+        """Refresh the signer lock before sending a transaction, ending the pass if it has been lost"""
+        if not await self._hold_lock():
+            raise SignerLockLost()
+
+    async def _sync_nonce(self):
+        """Next nonce: the chain's pending count, or past the highest nonce of the transactions in flight"""
+        nonce = await self.contract.get_nonce()
+        for raw in await self.redis_client.hvals(SETTLEMENT_INFLIGHT_KEY):
+            nonce = max(nonce, json.loads(raw)["nonce"] + 1)
+        self.nonce = nonce
+
+    async def _send_queued(self):
+        for _ in range(SettlementConfig.MAX_SENDS_PER_PASS):
+            raw = await self.redis_client.lindex(SETTLEMENT_QUEUE_KEY, 0)
+            if raw is None:
+                return
+            job = json.loads(raw)
+            try:
+                tx_hash, raw_tx, fees = await self.contract.sign_result(job["gid"], job["winner"], self.nonce)
+            except Exception as exc:
+                await self._retry_later(job, exc)
+                raise  # re-sync nonce and back off before retrying
+
+            # recorded as in flight before it is sent, so if sending fails (even after the transaction went out) it is
+            # retried under the same nonce by _track_inflight, never sent again with a new one
+            inflight = {**job, "txHashes": [tx_hash], "rawTx": raw_tx, "nonce": self.nonce, "fees": fees, "sentAt": time()}
+            await self._ensure_lock()
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                pipe.lpop(SETTLEMENT_QUEUE_KEY)
+                pipe.hset(SETTLEMENT_INFLIGHT_KEY, job["gid"], json.dumps(inflight))
+                await pipe.execute()
+            self.nonce += 1
+            try:
+                await self.contract.broadcast(raw_tx)
+            except Exception as exc:
+                self.logger.error(f"Sending settlement for game {job['gid']} failed, retrying with nonce {inflight['nonce']}: {exc}")
+                return
+            await self._publish_status(job["gid"], SettlementStatus.SUBMITTED, tx_hash)
+
+    async def _retry_later(self, job, exc):
+        """Put a job that could not be sent back at the head of the queue, or in the failed list after MAX_ATTEMPTS"""
+        job["attempts"] += 1
+        self.logger.error(f"Sending settlement for game {job['gid']} failed (attempt {job['attempts']}): {exc}")
+        failed = job["attempts"] >= SettlementConfig.MAX_ATTEMPTS
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.lpop(SETTLEMENT_QUEUE_KEY)
+            if failed:
+                pipe.rpush(SETTLEMENT_FAILED_KEY, json.dumps(job))
+            else:
+                pipe.lpush(SETTLEMENT_QUEUE_KEY, json.dumps(job))
+            await pipe.execute()
+        if failed:
+            await self._publish_status(job["gid"], SettlementStatus.FAILED)
+
+    async def _find_receipt(self, tx):
+        """Receipt of whichever transaction sent with the job's nonce was mined, and its hash (None, None if none was)"""
+        for tx_hash in reversed(tx["txHashes"]):
+            if (receipt := await self.contract.get_receipt(tx_hash)) is not None:
+                return tx_hash, receipt
+        return None, None
+
+    async def _track_inflight(self):
+        mined_count = None  # number of the account's transactions mined (fetched when first needed)
+        for gid, raw in (await self.redis_client.hgetall(SETTLEMENT_INFLIGHT_KEY)).items():
+            gid, tx = gid.decode(), json.loads(raw)
+            mined, receipt = await self._find_receipt(tx)
+            if mined is None and not any([await self.contract.is_pending(h) for h in tx["txHashes"]]):
+                # unknown to the node: never sent (the send failed), dropped, or the nonce was used by another transaction
+                if mined_count is None:
+                    mined_count = await self.contract.get_nonce("latest")
+                if mined_count <= tx["nonce"]:
+                    await self._ensure_lock()
+                    raw_tx = tx.get("rawTx") or (await self.contract.sign_result(gid, tx["winner"], tx["nonce"], tx["fees"]))[1]
+                    try:
+                        await self.contract.broadcast(raw_tx)
+                    except Exception as exc:
+                        self.logger.error(f"Resending settlement for game {gid} with nonce {tx['nonce']} failed: {exc}")
+                        continue
+                    tx["sentAt"] = time()
+                    await self.redis_client.hset(SETTLEMENT_INFLIGHT_KEY, gid, json.dumps(tx))
+                    await self._publish_status(gid, SettlementStatus.SUBMITTED, tx["txHashes"][-1])
+                    continue
+                mined, receipt = await self._find_receipt(tx)  # in case it was mined since it was looked up
+                if mined is None:
+                    self.logger.warning(f"Nonce {tx['nonce']} of settlement for game {gid} used by another transaction, requeueing")
+                    job = {"gid": gid, "winner": tx["winner"], "attempts": tx["attempts"]}
+                    async with self.redis_client.pipeline(transaction=True) as pipe:
+                        pipe.hdel(SETTLEMENT_INFLIGHT_KEY, gid)
+                        pipe.lpush(SETTLEMENT_QUEUE_KEY, json.dumps(job))
+                        await pipe.execute()
+                    continue
+
+            if mined is not None:
+                await self.redis_client.hdel(SETTLEMENT_INFLIGHT_KEY, gid)
+                if receipt["status"] == 1:
+                    await self._publish_status(gid, SettlementStatus.CONFIRMED, mined)
+                else:
+                    self.logger.error(f"Settlement transaction {mined} for game {gid} reverted")
+                    await self.redis_client.rpush(SETTLEMENT_FAILED_KEY, json.dumps(tx))
+                    await self._publish_status(gid, SettlementStatus.FAILED, mined)
+            elif time() - tx["sentAt"] > SettlementConfig.BUMP_AFTER:
+                # replace stuck transaction (same nonce, higher fees), recorded before it is sent
+                fees = {k: math.ceil(v * SettlementConfig.FEE_BUMP) for k, v in tx["fees"].items()}
+                tx_hash, tx["rawTx"], tx["fees"] = await self.contract.sign_result(gid, tx["winner"], tx["nonce"], fees)
+                tx["txHashes"].append(tx_hash)
+                tx["sentAt"] = time()
+                await self._ensure_lock()
+                await self.redis_client.hset(SETTLEMENT_INFLIGHT_KEY, gid, json.dumps(tx))
+                self.logger.warning(f"Settlement for game {gid} not mined after {SettlementConfig.BUMP_AFTER}s, resending as {tx_hash}")
+                try:
+                    await self.contract.broadcast(tx["rawTx"])
+                except Exception as exc:
+                    self.logger.error(f"Resending settlement for game {gid} with nonce {tx['nonce']} failed: {exc}")
+                    continue
+                await self._publish_status(gid, SettlementStatus.SUBMITTED, tx_hash)
+
+    def start(self):
+        self.runner = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.runner:
+            self.runner.cancel()
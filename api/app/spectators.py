@@ -0,0 +1,113 @@
+import asyncio
+from collections import defaultdict, deque
+from logging import Logger
+from time import time_ns
+
+import app.utils as utils
+from app.event_bus import EventBus
+from app.exceptions import CustomException
+from app.game_controller import GameController
+from app.models import Event
+from socketio.asyncio_server import AsyncServer
+
+
+class SpectatorHub:
+    """
+    Spectators of games, connected to this worker
+
+    Each worker subscribes to the event bus once per watched game (for the game's broadcast and spectator events), and
+    fans each event out to the game's spectators through a local Socket.IO room. Broker load therefore grows with the
+    number of watched games per worker, not with the number of spectators.
+
+    A new spectator is sent a snapshot of the game (from the cache or Redis) once the worker is subscribed to its events;
+    move events with a seq not above the snapshot's are already included in it. Spectators are also sent a snapshot at
+    the start of each round. Subscription changes are made one at a time, so concurrent first spectators of a game
+    share one subscription, and each waits for it before being sent the snapshot.
+    """
+
+    IGNORED_EVENTS = ("error",)  # broadcast events meant for the players only
+
+    def __init__(self, bus: EventBus, sio: AsyncServer, gc: GameController, logger: Logger):
+        self.bus = bus
+        self.sio = sio
+        self.gc = gc
+        self.logger = logger
+        self.spectators = defaultdict(set)  # gid -> sids watching
+        self.watching = {}  # sid -> gid
+        self.subscribed = set()  # games this worker is subscribed to the events of
+        self.lock = asyncio.Lock()  # held while (un)subscribing
+        self.pending = deque()  # (gid, event) awaiting fan out, in order
+        self.fanout = None
+        bus.on_spectator_event = self.on_event
+
+    @staticmethod
+    def get_room(gid):
+        return f"spectate:{gid}"
+
+    def on_event(self, gid, event: Event):
+        if gid not in self.spectators or event.name in self.IGNORED_EVENTS:
+            return
+        self.pending.append((gid, event))
+        if self.fanout is None or self.fanout.done():
+            self.fanout = asyncio.create_task(self.fan_out())
+
+    async def fan_out(self):
+        while self.pending:
+            gid, event = self.pending.popleft()
+            try:
+                # emitted to this worker's room members only, each worker fans out to its own spectators
+                await self.sio.emit(event.name, event.data, room=self.get_room(gid), ignore_queue=True)
+            except Exception as exc:
+                self.logger.error(f"Failed to send {event.name} event to spectators of game {gid}: {exc}")
+
+    async def _update_subscription(self, gid):
+        """Subscribe to a game's events while it has spectators on this worker, unsubscribe once it has none"""
+        async with self.lock:
+            wanted = gid in self.spectators
+            if wanted and gid not in self.subscribed:
+                try:
+                    await self.bus.watch(gid)
+                except Exception:
+                    await self.bus.unwatch(gid)  # drop any binding made before the failure
+                    raise
+                self.subscribed.add(gid)
+            elif not wanted and gid in self.subscribed:
+                self.subscribed.discard(gid)
+                await self.bus.unwatch(gid)
+
+    async def watch(self, sid, gid):
+        """Start sending a game's events to a client"""
+        if not self.bus.is_ready:
+            raise CustomException("Server is starting up. Please try again shortly", sid)
+        if self.gc.gr.get_gid(sid):
+            raise CustomException("Players can't spectate", sid)
+        await self.unwatch(sid)
+        await self.gc.get_game_by_gid(gid, sid, read_only=True)  # raises if there is no such game, before subscribing
+
+        self.spectators[gid].add(sid)
+        self.watching[sid] = gid
+        self.sio.enter_room(sid, self.get_room(gid))
+        try:
+            await self._update_subscription(gid)
+            # read again after subscribing, so no event is missed between the snapshot and the live events
+            game = await self.gc.get_game_by_gid(gid, sid, read_only=True)  # left in the players' worker cache
+        except CustomException:
+            await self.unwatch(sid)  # game deleted since
+            raise
+        except Exception as exc:  # e.g. the broker failed to bind
+            self.logger.error(f"Failed to subscribe to the events of game {gid}: {exc}")
+            await self.unwatch(sid)
+            raise CustomException("Failed to watch the game, please try again", sid)
+        await self.sio.emit("spectate", utils.get_spectate_data(game, time_ns() / 1_000_000).__dict__, to=sid)
+
+    async def unwatch(self, sid):
+        """Stop sending game events to a client (e.g. once it has disconnected)"""
+        gid = self.watching.pop(sid, None)
+        if gid is None:
+            return
+        self.sio.leave_room(sid, self.get_room(gid))
+        self.spectators[gid].discard(sid)
+        if self.spectators[gid]:
+            return
+        del self.spectators[gid]
+        await self._update_subscription(gid)
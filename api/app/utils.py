@@ -1,42 +1,86 @@
-import copy
-import json
-
-from app.constants import BROADCAST_KEY
-from app.models import Event, Game
-from chess import Board
-from pika.channel import Channel
+from app.codec import decode_game, decode_legacy_game, encode_game
+from app.models import Game, SpectateData
 
 
 def get_queue_name(gid: str, sid: str):
     return f"{gid}::{sid}"
 
 
+def get_shared_routing_key(gid: str, rk: str):
+    return f"{gid}.{rk}"
+
+
 def get_redis_key(gid: str):
     return f"game:{gid}"
 
 
+def get_redis_version_key(gid: str):
+    return f"game_version:{gid}"
+
+
+def get_redis_registry_key(gid: str):
+    return f"game_players:{gid}"
+
+
+def get_redis_events_key(gid: str):
+    return f"game_events:{gid}"
+
+
+def get_redis_clock_key(gid: str):
+    return f"game_clock:{gid}"
+
+
 def opponent_ind(turn: int):
     return int(not bool(turn))
 
 
+def time_remaining(game: Game, now: float = None):
+    """Time remaining (ms) on the clock of the player to move, at time now (epoch ms) or at the start of the turn"""
+    tr = game.tr_w if game.board.turn else game.tr_b
+    if now is None:
+        return tr
+    return tr - (now - game.turn_start_time)
+
+
+def get_spectate_data(game: Game, now: float = None):
+    """Snapshot of a game for spectators, with the clock of the player to move run down to now (epoch ms)"""
+    board = game.board
+    started = len(game.players) > 1
+    black, white = (game.player_wallet_addrs[pid] for pid in game.players) if started else (None, None)
+    tr_w, tr_b = game.tr_w, game.tr_b
+    if now is not None and started and not game.round_over and not game.finished:
+        if board.turn:
+            tr_w = time_remaining(game, now)
+        else:
+            tr_b = time_remaining(game, now)
+    return SpectateData(
+        round=game.round,
+        totalRounds=game.n_rounds,
+        white=white,
+        black=black,
+        matchScore=tuple(game.match_score[pid] for pid in game.players) if started else (0, 0),
+        seq=board.ply(),
+        fen=board.fen(),
+        turn=int(board.turn),
+        moveStack=[str(m) for m in board.move_stack],
+        timeRemainingWhite=tr_w,
+        timeRemainingBlack=tr_b,
+        roundOver=game.round_over,
+        finished=game.finished,
+    )
+
+
 def serialise_game_state(game: Game):
-    """Serialise game state to JSON string for storage in Redis"""
+    """Serialise game state to binary for storage in Redis"""
     if not game:
         return
-    game_dict = copy.deepcopy(game.__dict__)
-    game_dict["board"] = game.board.fen()
-    return json.dumps(game_dict)
+    return encode_game(game)
 
 
-def deserialise_game_state(game: str):
-    """Deserialise game state from Redis JSON string"""
+def deserialise_game_state(game: bytes | str):
+    """Deserialise game state from Redis (binary, or legacy JSON string)"""
     if not game:
         return
-    game_dict = json.loads(game)
-    game_dict["board"] = Board(game_dict["board"])
-    return Game(**game_dict)
-
-
-def publish_event(channel: Channel, gid: str, event: Event, rk=BROADCAST_KEY):
-    # TODO: better place to put this?
-    channel.basic_publish(exchange=gid, routing_key=rk, body=json.dumps(event.__dict__))
+    if isinstance(game, str) or game[:1] == b"{":
+        return decode_legacy_game(game)
+    return decode_game(game)
@@ -0,0 +1,62 @@
+"""
+Micro-benchmark: binary game state codec vs legacy JSON + FEN codec
+
+Run from /api: python -m benchmarks.bench_codec
+"""
+
+import copy
+import json
+import random
+import timeit
+
+from app.codec import decode_game, decode_legacy_game, encode_game
+from app.models import Game
+from chess import Board
+
+N_ITER = 2000
+PLIES = (0, 20, 60, 120)
+
+
+def legacy_encode(game: Game):
+    game_dict = copy.deepcopy(game.__dict__)
+    game_dict["board"] = game.board.fen()
+    return json.dumps(game_dict)
+
+
+def make_game(plies: int, rng: random.Random):
+    board = Board()
+    for _ in range(plies):
+        moves = list(board.legal_moves)
+        if not moves:
+            break
+        board.push(rng.choice(moves))
+    sids = ["Hq3xU0Qm9F2cL7pVAAAB", "Zk1yP8Rr4T6nJ0wXAAAD"]
+    return Game(
+        players=sids,
+        board=board,
+        tr_w=172345.25,
+        tr_b=168012.5,
+        turn_start_time=1718000000000.123,
+        time_control=3,
+        wager=12.5,
+        player_wallet_addrs={sids[0]: "0x" + "a" * 40, sids[1]: "0x" + "b" * 40},
+        match_score={sids[0]: 0.5, sids[1]: 1},
+        round=2,
+        n_rounds=3,
+    )
+
+
+def main():
+    rng = random.Random(0)
+    print(f"{'plies':>6} {'codec':>7} {'bytes':>6} {'encode us':>10} {'decode us':>10}")
+    for plies in PLIES:
+        game = make_game(plies, rng)
+        for name, enc, dec in (("legacy", legacy_encode, decode_legacy_game), ("binary", encode_game, decode_game)):
+            blob = enc(game)
+            t_enc = timeit.timeit(lambda: enc(game), number=N_ITER) / N_ITER * 1e6
+            t_dec = timeit.timeit(lambda: dec(blob), number=N_ITER) / N_ITER * 1e6
+            print(f"{len(game.board.move_stack):>6} {name:>7} {len(blob):>6} {t_enc:>10.1f} {t_dec:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark: latency of claiming an opponent from the matchmaking queue, as the queue grows
+
+For each queue depth, a bucket is filled with that many open games, then concurrent seekers claim games from it, each
+claim's game replaced by a new one so the depth stays the same. Reports claims per second and claim latency
+percentiles; latency should grow with log(depth) at most, and no game may be claimed twice.
+
+Requires a running Redis (REDIS_URL). Run from /api:
+    python -m benchmarks.bench_matchmaking [queue depths] [claims per depth] [concurrent seekers]
+e.g. python -m benchmarks.bench_matchmaking 0,1000,10000,100000,1000000 20000 64
+"""
+
+import asyncio
+import logging
+import sys
+import uuid
+from time import perf_counter
+
+import aioredis
+import app.utils as utils
+from app.constants import REDIS_BATCH_SIZE, REDIS_URL
+from app.matchmaking import Matchmaker
+from benchmarks.load_games import percentile
+
+BUCKET = "seeks:bench"
+
+
+async def enqueue(redis_client, gids, score):
+    """Queue open games (with placeholder state, claims only check that it exists)"""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for gid in gids:
+            pipe.set(utils.get_redis_key(gid), b"", ex=3600)
+        pipe.zadd(BUCKET, {gid: score for gid in gids})
+        await pipe.execute()
+
+
+async def run(matchmaker: Matchmaker, redis_client, depth: int, n_claims: int, concurrency: int):
+    for i in range(0, depth, REDIS_BATCH_SIZE):
+        await enqueue(redis_client, [str(uuid.uuid4()) for _ in range(min(REDIS_BATCH_SIZE, depth - i))], 0)
+
+    claimed, latencies, queued = set(), [], 0
+
+    async def seeker():
+        nonlocal queued
+        while len(latencies) < n_claims:
+            start = perf_counter()
+            result = await matchmaker.claim(BUCKET)
+            if result is None:  # nothing to claim at depth 0: create and queue a game, as a seeker would
+                queued += 1
+                await enqueue(redis_client, [str(uuid.uuid4())], queued)
+                continue
+            latencies.append(perf_counter() - start)
+            gid = result[0]
+            assert gid not in claimed, f"game {gid} claimed twice"
+            claimed.add(gid)
+            await redis_client.delete(utils.get_redis_key(gid))
+            if depth:
+                await enqueue(redis_client, [str(uuid.uuid4())], 1)
+
+    start = perf_counter()
+    await asyncio.gather(*(seeker() for _ in range(concurrency)))
+    elapsed = perf_counter() - start
+
+    remaining = [gid.decode() for gid in await redis_client.zrange(BUCKET, 0, -1)]
+    for i in range(0, len(remaining), REDIS_BATCH_SIZE):
+        await redis_client.delete(*(utils.get_redis_key(gid) for gid in remaining[i : i + REDIS_BATCH_SIZE]))
+    await redis_client.delete(BUCKET)
+    return len(latencies) / elapsed, sorted(latencies)
+
+
+async def main(depths, n_claims: int, concurrency: int):
+    redis_client = aioredis.Redis.from_url(REDIS_URL)
+    matchmaker = Matchmaker(redis_client, None, None, None, logging.getLogger("bench_matchmaking"))
+    for depth in depths:
+        rate, latencies = await run(matchmaker, redis_client, depth, n_claims, concurrency)
+        print(
+            f"depth={depth:<8} claims/s={rate:.0f} latency (ms): "
+            + " ".join(f"p{p}={percentile(latencies, p) * 1000:.2f}" for p in (50, 90, 99))
+        )
+    await redis_client.close()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    asyncio.run(
+        main(
+            [int(n) for n in args[0].split(",")] if args else [0, 1000, 10000, 100000, 1000000],
+            int(args[1]) if len(args) > 1 else 20000,
+            int(args[2]) if len(args) > 2 else 64,
+        )
+    )
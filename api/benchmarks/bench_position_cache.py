@@ -0,0 +1,114 @@
+"""
+Benchmark: per-move position analysis (legal moves, check, outcome) with and without the Zobrist-keyed position cache
+
+Replays a corpus of games move by move, as PlayController.move does. Pass a PGN file of real games (e.g. a Lichess
+database extract) to use it as the corpus; without one, games are generated from a handful of popular openings
+followed by random play.
+
+Run from /api: python -m benchmarks.bench_position_cache [games.pgn] [max games]
+"""
+
+import random
+import sys
+from time import perf_counter
+
+import chess.pgn
+from app.models import Game
+from app.position_cache import PositionCache
+from chess import Board, Move
+
+OPENINGS = [
+    "e2e4 e7e5 g1f3 b8c6 f1b5 a7a6 b5a4 g8f6 e1g1 f8e7 f1e1 b7b5 a4b3 d7d6 c2c3 e8g8",  # Ruy Lopez
+    "e2e4 c7c5 g1f3 d7d6 d2d4 c5d4 f3d4 g8f6 b1c3 a7a6 c1e3 e7e5 d4b3 c8e6",  # Sicilian Najdorf
+    "d2d4 d7d5 c2c4 e7e6 b1c3 g8f6 c1g5 f8e7 e2e3 e8g8 g1f3 b8d7",  # Queen's Gambit Declined
+    "e2e4 e7e5 g1f3 b8c6 f1c4 f8c5 c2c3 g8f6 d2d4 e5d4 c3d4 c5b4",  # Italian
+    "e2e4 e7e6 d2d4 d7d5 b1c3 g8f6 c1g5 f8e7 e4e5 f6d7 g5e7 d8e7",  # French
+    "d2d4 g8f6 c2c4 g7g6 b1c3 f8g7 e2e4 d7d6 g1f3 e8g8 f1e2 e7e5",  # King's Indian
+    "e2e4 c7c6 d2d4 d7d5 b1c3 d5e4 c3e4 c8f5 e4g3 f5g6",  # Caro-Kann
+    "c2c4 e7e5 b1c3 g8f6 g1f3 b8c6 g2g3 d7d5 c4d5 f6d5",  # English
+]
+
+
+def generated_corpus(n_games: int, rng: random.Random):
+    for i in range(n_games):
+        board = Board()
+        opening = OPENINGS[i % len(OPENINGS)].split()
+        for uci in opening[: rng.randint(len(opening) // 2, len(opening))]:
+            board.push(Move.from_uci(uci))
+        while not board.is_game_over(claim_draw=True) and board.ply() < 160:
+            board.push(rng.choice(list(board.legal_moves)))
+        yield board.move_stack
+
+
+def pgn_corpus(path: str, n_games: int):
+    with open(path) as pgn:
+        for _ in range(n_games):
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                return
+            yield list(game.mainline_moves())
+
+
+def new_game():
+    return Game(
+        players=[],
+        board=Board(),
+        tr_w=0,
+        tr_b=0,
+        turn_start_time=0,
+        time_control=3,
+        wager=0,
+        player_wallet_addrs={},
+        match_score={},
+        round=1,
+        n_rounds=1,
+    )
+
+
+def uncached(game: Game):
+    board = game.board
+    return [str(m) for m in board.legal_moves], board.is_check(), board.outcome(claim_draw=True)
+
+
+def cached(positions: PositionCache):
+    def analyse(game: Game):
+        info, outcome = positions.analyse(game)
+        return list(info.legal_moves), info.is_check, outcome
+
+    return analyse
+
+
+def replay(corpus, analyse):
+    """Time spent analysing positions, over every move of every game (seconds), and the number of moves"""
+    elapsed, n_moves = 0.0, 0
+    for moves in corpus:
+        game = new_game()
+        for move in moves:
+            game.board.push(move)
+            start = perf_counter()
+            analyse(game)
+            elapsed += perf_counter() - start
+            n_moves += 1
+    return elapsed, n_moves
+
+
+def main():
+    args = sys.argv[1:]
+    path = args.pop(0) if args and not args[0].isdigit() else None
+    n_games = int(args[0]) if args else 500
+    corpus = list(pgn_corpus(path, n_games) if path else generated_corpus(n_games, random.Random(0)))
+
+    positions = PositionCache()
+    base, n_moves = replay(corpus, uncached)
+    cold, _ = replay(corpus, cached(positions))  # fills the cache
+    warm, _ = replay(corpus, cached(positions))
+
+    print(f"games={len(corpus)} moves={n_moves} positions cached={len(positions.positions)} ({path or 'generated corpus'})")
+    print(f"{'uncached':>10}: {base / n_moves * 1e6:8.1f} us/move")
+    for label, elapsed in (("cold", cold), ("warm", warm)):
+        saved = (base - elapsed) / n_moves * 1e6
+        print(f"{label:>10}: {elapsed / n_moves * 1e6:8.1f} us/move (saves {saved:.1f} us/move, {base / elapsed:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
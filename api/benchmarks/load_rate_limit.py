@@ -0,0 +1,57 @@
+"""
+Load test: rate limiting shared across workers
+
+Several simulated workers (each with its own limiter, sharing one Redis) hammer the same per-IP "connect" bucket. The
+number of allowed attempts must stay within the bucket's capacity plus what refills during the run, however many
+workers there are.
+
+Requires a running Redis (REDIS_URL). Run from /api: python -m benchmarks.load_rate_limit [workers] [seconds]
+"""
+
+import asyncio
+import logging
+import sys
+import uuid
+from time import perf_counter
+
+import aioredis
+from app.constants import REDIS_URL
+from app.rate_limit import RateLimitConfig, TokenBucketRateLimiter
+
+
+async def main(n_workers: int, duration: float):
+    logger = logging.getLogger("load_rate_limit")
+    redis_client = aioredis.Redis.from_url(REDIS_URL)
+    limiters = [TokenBucketRateLimiter(redis_client, logger) for _ in range(n_workers)]
+
+    # same client IP seen by every worker, a fresh one so the bucket starts full
+    sid, ip = "load", f"load-test-{uuid.uuid4()}"
+    for limiter in limiters:
+        limiter.client_ips[sid] = ip
+
+    # only the IP bucket is exercised, so the run doesn't drain the live global connect bucket
+    RateLimitConfig.BUCKETS["load"] = {"ip": RateLimitConfig.BUCKETS["connect"]["ip"]}
+    allowed = attempts = 0
+
+    async def worker(limiter: TokenBucketRateLimiter):
+        nonlocal allowed, attempts
+        deadline = perf_counter() + duration
+        while perf_counter() < deadline:
+            attempts += 1
+            allowed += await limiter.consume_token("load", sid)
+
+    start = perf_counter()
+    await asyncio.gather(*(worker(limiter) for limiter in limiters))
+    elapsed = perf_counter() - start
+
+    capacity, refill_rate_minute = RateLimitConfig.BUCKETS["connect"]["ip"]
+    limit = capacity + int(refill_rate_minute * elapsed / 60)
+    print(f"workers={n_workers} attempts={attempts} elapsed={elapsed:.2f}s ({attempts / elapsed:.0f}/s)")
+    print(f"allowed={allowed} limit={limit} ({'OK' if allowed <= limit else 'EXCEEDED'})")
+
+    await redis_client.delete(f"rate_limit:load:ip:{ip}")
+    await redis_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 8, float(sys.argv[2]) if len(sys.argv) > 2 else 10))
@@ -0,0 +1,57 @@
+"""
+API server for load testing: the real app, with the smart contract stubbed and the limits raised
+
+Needs Redis and RabbitMQ (e.g. docker run -p 6379:6379 redis, docker run -p 5672:5672 -p 15672:15672
+rabbitmq:3-management) with REDIS_URL and CLOUDAMQP_URL set. Run from /api:
+    uvicorn benchmarks.load_server:chess_api --port 8000 --workers 8
+With EVENT_BUS=redis, RabbitMQ is not needed. With EVENT_BUS=memory and a single worker, neither is it, and every
+event takes the in-process path. Compare move latencies (benchmarks/load_games.py) with EVENT_BUS_LOCAL_FAST_PATH=false
+to measure the local fast path.
+"""
+
+import asyncio
+import os
+import uuid
+
+# throwaway signing key, nothing is ever sent on chain
+os.environ.setdefault("WALLET_PK", "0x" + "11" * 32)
+
+from app.main import chess_api, settlement  # noqa: E402
+from app.rate_limit import RateLimitConfig  # noqa: E402
+
+LIMIT_SCALE = 1000  # token bucket capacities and refill rates are multiplied by this
+
+RateLimitConfig.CONCURRENT_GAME_LIMIT = 100000
+RateLimitConfig.BUCKETS = {
+    action: {scope: (capacity * LIMIT_SCALE, rate * LIMIT_SCALE) for scope, (capacity, rate) in buckets.items()}
+    for action, buckets in RateLimitConfig.BUCKETS.items()
+}
+
+
+class StubContract:
+    """Stands in for GameContract: transactions are 'mined' as soon as they are sent"""
+
+    def __init__(self):
+        self.nonce = 0
+
+    async def get_nonce(self, block="pending"):
+        return self.nonce
+
+    async def sign_result(self, gid, winner_addr, nonce, fees=None):
+        tx_hash = "0x" + uuid.uuid4().hex * 2
+        return tx_hash, tx_hash, fees or {"gasPrice": 1}
+
+    async def broadcast(self, raw_tx):
+        await asyncio.sleep(0)
+        self.nonce += 1
+
+    async def is_pending(self, tx_hash):
+        return True
+
+    async def get_receipt(self, tx_hash):
+        return {"status": 1, "transactionHash": tx_hash}
+
+
+settlement.contract = StubContract()
+
+__all__ = ["chess_api"]
@@ -0,0 +1,144 @@
+"""
+End to end check of the settlement queue against a local chain (anvil, from Foundry)
+
+Drives SettlementQueue passes by hand, with mining switched off so transactions stay pending until mined on purpose:
+  - enqueue -> submit: the job is sent with the account's next nonce and is pending on the node
+  - send failure: a transaction whose broadcast failed is resent by the tracker, signed as before (same nonce)
+  - fee bump: a transaction left unmined past BUMP_AFTER is replaced (same nonce, higher fees)
+  - confirm: once mined, the replacement's receipt is found and the job leaves the in-flight hash
+  - players gone: no status is published once the game's players have left (its event routing is torn down)
+Settlement statuses are published on an in-memory event bus, and recorded per game.
+
+The contract is stood in for by code that accepts any call (anvil_setCode), so nothing needs compiling or deploying.
+Requires anvil (ANVIL_URL, default http://127.0.0.1:8545) and a running Redis (REDIS_URL). Run from /api:
+    anvil & python -m benchmarks.settlement_anvil
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import uuid
+from types import SimpleNamespace
+
+# anvil's first pre-funded account
+os.environ.setdefault("WALLET_PK", "0xac0974bec39a17e36ba4a6b4d238ff944bacb478cbed5efcae784d7bf4f2ff80")
+os.environ.setdefault("SC_ADDRESS", "0x5FbDB2315678afecb367f032d93F642f64180aa3")
+
+import aioredis  # noqa: E402
+from app.constants import REDIS_URL, SC_ADDRESS, SETTLEMENT_INFLIGHT_KEY, SETTLEMENT_LOCK_KEY, SETTLEMENT_QUEUE_KEY  # noqa: E402
+from app.event_bus import InMemoryEventBus  # noqa: E402
+from app.game_contract import GameContract  # noqa: E402
+from app.game_registry import GameRegistry  # noqa: E402
+from app.settlement import SettlementConfig, SettlementQueue, SettlementStatus  # noqa: E402
+from web3 import AsyncWeb3  # noqa: E402
+
+ANVIL_URL = os.environ.get("ANVIL_URL", "http://127.0.0.1:8545")
+WINNER = "0x70997970C51812dc3A010C7d01b50e0d17dc79C8"
+
+
+class RecordingBus(InMemoryEventBus):
+    """Records the settlement statuses published for each game"""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.statuses = []
+
+    def publish(self, gid, event, *args):
+        if event.name == "settlement":
+            self.statuses.append((gid, event.data["status"]))
+        super().publish(gid, event, *args)
+
+
+class FlakyContract(GameContract):
+    """GameContract whose next broadcast fails without reaching the node"""
+
+    fail_next = False
+
+    async def broadcast(self, raw_tx):
+        if self.fail_next:
+            self.fail_next = False
+            raise ConnectionError("simulated send failure")
+        await super().broadcast(raw_tx)
+
+
+def check(name, ok, detail=""):
+    print(f"{name:<24} {'ok' if ok else 'FAILED'} {detail}")
+    return ok
+
+
+async def inflight(redis_client, gid):
+    raw = await redis_client.hget(SETTLEMENT_INFLIGHT_KEY, gid)
+    return json.loads(raw) if raw else None
+
+
+async def main():
+    logger = logging.getLogger("settlement_anvil")
+    w3 = AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(ANVIL_URL))
+    await w3.provider.make_request("anvil_setCode", [SC_ADDRESS, "0x00"])  # STOP: every call succeeds
+    await w3.provider.make_request("evm_setAutomine", [False])
+
+    redis_client = aioredis.Redis.from_url(REDIS_URL)
+    await redis_client.delete(SETTLEMENT_QUEUE_KEY, SETTLEMENT_INFLIGHT_KEY, SETTLEMENT_LOCK_KEY)
+    gr = GameRegistry(redis_client)
+    bus = RecordingBus(gr, SimpleNamespace(emit=lambda event, sid: None), logger)
+    contract = FlakyContract(w3, logger)
+    queue = SettlementQueue(redis_client, contract, bus, logger)
+
+    gid = str(uuid.uuid4())
+    for sid in ("p1", "p2"):
+        await gr.add_player_gid_record(sid, gid)
+
+    ok = True
+    try:
+        assert await queue._hold_lock(), "signer lock held by another worker"
+        await queue._sync_nonce()
+        first_nonce = queue.nonce
+
+        await queue.enqueue(gid, WINNER)
+        await queue._send_queued()
+        tx = await inflight(redis_client, gid)
+        ok &= check("submit", tx is not None and tx["nonce"] == first_nonce and await contract.is_pending(tx["txHashes"][0]))
+
+        # a second match whose send fails: resent by the tracker with the same nonce and signed transaction
+        other = str(uuid.uuid4())
+        await gr.add_player_gid_record("p3", other)
+        await queue.enqueue(other, None)
+        contract.fail_next = True
+        await queue._send_queued()
+        other_tx = await inflight(redis_client, other)
+        unsent = not await contract.is_pending(other_tx["txHashes"][0])
+        await queue._track_inflight()
+        other_tx = await inflight(redis_client, other)
+        resent = other_tx["nonce"] == first_nonce + 1 and len(other_tx["txHashes"]) == 1 and await contract.is_pending(other_tx["txHashes"][0])
+        ok &= check("send failure retried", unsent and resent)
+
+        SettlementConfig.BUMP_AFTER = 0
+        await queue._track_inflight()
+        SettlementConfig.BUMP_AFTER = 60
+        tx = await inflight(redis_client, gid)
+        bumped = len(tx["txHashes"]) == 2 and tx["nonce"] == first_nonce
+        ok &= check("fee bump", bumped and await contract.is_pending(tx["txHashes"][-1]), f"fees {tx['fees']}")
+
+        await gr.remove_player_gid_record("p3")  # the second game's players have left
+        await w3.provider.make_request("evm_mine", [])
+        await queue._track_inflight()
+        receipt = await contract.get_receipt(tx["txHashes"][-1])
+        ok &= check("confirm", await inflight(redis_client, gid) is None and receipt is not None and receipt["status"] == 1)
+        other_statuses = [status for g, status in bus.statuses if g == other]
+        ok &= check("no status once left", await inflight(redis_client, other) is None and SettlementStatus.CONFIRMED not in other_statuses)
+
+        expected = [SettlementStatus.QUEUED, SettlementStatus.SUBMITTED, SettlementStatus.SUBMITTED, SettlementStatus.CONFIRMED]
+        ok &= check("statuses", [status for g, status in bus.statuses if g == gid] == expected)
+    finally:
+        await w3.provider.make_request("evm_setAutomine", [True])
+        await redis_client.delete(SETTLEMENT_QUEUE_KEY, SETTLEMENT_INFLIGHT_KEY, SETTLEMENT_LOCK_KEY)
+        for sid in ("p1", "p2", "p3"):
+            await gr.remove_player_gid_record(sid)
+        await redis_client.close()
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)
@@ -0,0 +1,80 @@
+"""
+Stress test: concurrent read-modify-write updates of one game from several simulated workers
+
+Each simulated worker has its own GameController and GameCache, sharing one Redis. Every update increments a counter
+on the game; with optimistic concurrency control no increment may be lost.
+
+Requires a running Redis (REDIS_URL). Run from /api: python -m benchmarks.stress_cas [workers] [updates per worker]
+"""
+
+import asyncio
+import logging
+import sys
+import uuid
+from time import perf_counter
+
+import aioredis
+import app.utils as utils
+from app.clock import GameClock
+from app.constants import MAX_UPDATE_RETRIES, REDIS_URL
+from app.exceptions import CustomException
+from app.game_cache import GameCache
+from app.game_controller import GameController
+from app.models import Game
+from chess import Board
+
+
+def new_game(sid):
+    return Game(
+        players=[sid],
+        board=Board(),
+        tr_w=0,
+        tr_b=0,
+        turn_start_time=-1,
+        time_control=3,
+        wager=1,
+        player_wallet_addrs={sid: "0x0"},
+        match_score={sid: 0},
+        round=1,
+        n_rounds=1,
+    )
+
+
+def increment(game: Game):
+    game.tr_w += 1
+    return True
+
+
+async def main(n_workers: int, n_updates: int):
+    logger = logging.getLogger("stress_cas")
+    redis_client = aioredis.Redis.from_url(REDIS_URL)
+    controllers = [GameController(None, redis_client, None, None, GameCache(), GameClock(logger), None, None, None, None, None, logger) for _ in range(n_workers)]
+
+    gid, sid = str(uuid.uuid4()), "stress"
+    await controllers[0].save_game(gid, new_game(sid))
+
+    busy = 0
+
+    async def worker(gc: GameController):
+        nonlocal busy
+        for _ in range(n_updates):
+            try:
+                await gc.update_game(gid, sid, increment)
+            except CustomException:
+                busy += 1  # gave up after MAX_UPDATE_RETRIES conflicts
+
+    start = perf_counter()
+    await asyncio.gather(*(worker(gc) for gc in controllers))
+    elapsed = perf_counter() - start
+
+    game = await controllers[0].get_game_by_gid(gid, sid)
+    applied = n_workers * n_updates - busy
+    print(f"workers={n_workers} updates={n_workers * n_updates} elapsed={elapsed:.2f}s ({n_workers * n_updates / elapsed:.0f}/s)")
+    print(f"applied={applied} rejected after {MAX_UPDATE_RETRIES} retries={busy} counter={int(game.tr_w)} lost={applied - int(game.tr_w)}")
+
+    await redis_client.delete(utils.get_redis_key(gid), utils.get_redis_version_key(gid))
+    await redis_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 8, int(sys.argv[2]) if len(sys.argv) > 2 else 200))
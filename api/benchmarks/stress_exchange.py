@@ -0,0 +1,117 @@
+"""
+Stress test: the exchange rate cache against a local mock of the CoinMarketCap API
+
+Several simulated workers (an ExchangeRateCache each, sharing one Redis) get the rate concurrently:
+  - cold: nothing cached, every get misses. The upstream API must be called once
+  - hot: cached in worker memory. Reports get latency
+  - stale, upstream failing: stale rates must still be served, with at most one upstream call per FAILURE_TTL
+  - cold, upstream failing: gets must fail fast (not wait out the refresh lock), with at most one upstream call
+
+Requires a running Redis (REDIS_URL). Run from /api: python -m benchmarks.stress_exchange [workers] [gets per worker]
+"""
+
+import asyncio
+import sys
+from time import perf_counter, time
+
+import aioredis
+from aiohttp import web
+from app.constants import REDIS_URL
+from app.exchange import ExchangeRateCache, ExchangeRateConfig
+from benchmarks.load_games import percentile
+
+RATE = 0.42
+
+
+class MockUpstream:
+    def __init__(self):
+        self.calls = 0
+        self.failing = False
+
+    async def handle(self, _):
+        self.calls += 1
+        await asyncio.sleep(0.05)  # upstream latency, so concurrent misses overlap
+        if self.failing:
+            return web.Response(status=500)
+        return web.json_response({"data": {"MATIC": [{"quote": {"GBP": {"price": RATE}}}]}})
+
+
+async def get_all(caches, n_gets):
+    async def worker(cache):
+        results = []
+        for _ in range(n_gets):
+            try:
+                results.append((await cache.get())[0])
+            except Exception as exc:
+                results.append(exc)
+        return results
+
+    return [r for results in await asyncio.gather(*(worker(cache) for cache in caches)) for r in results]
+
+
+async def reset(redis_client, caches, rate=None):
+    await redis_client.delete(ExchangeRateCache.REDIS_KEY, ExchangeRateCache.LOCK_KEY, ExchangeRateCache.FAILURE_KEY)
+    for cache in caches:
+        cache.rate, cache.failed_until = rate, 0
+
+
+def report(name, upstream, calls_before, results, ok):
+    errors = sum(isinstance(r, Exception) for r in results)
+    print(f"{name:<24} gets={len(results)} errors={errors} upstream calls={upstream.calls - calls_before} {'ok' if ok else 'FAILED'}")
+
+
+async def main(n_workers: int, n_gets: int):
+    upstream = MockUpstream()
+    app = web.Application()
+    app.router.add_get("/quotes", upstream.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/quotes"
+
+    redis_client = aioredis.Redis.from_url(REDIS_URL)
+    caches = [ExchangeRateCache(redis_client, url=url, api_key="mock") for _ in range(n_workers)]
+    for cache in caches:
+        await cache.start()
+
+    try:
+        await reset(redis_client, caches)
+        calls = upstream.calls
+        results = await get_all(caches, n_gets)
+        report("cold", upstream, calls, results, upstream.calls - calls == 1 and all(r == RATE for r in results))
+
+        latencies = []
+        for _ in range(n_gets):
+            start = perf_counter()
+            await caches[0].get()
+            latencies.append(perf_counter() - start)
+        latencies.sort()
+        print("hot                      get latency (ms): " + " ".join(f"p{p}={percentile(latencies, p) * 1000:.3f}" for p in (50, 99)))
+
+        upstream.failing = True
+        stale = (RATE, time() - ExchangeRateConfig.FRESH_TTL - 1)
+        await reset(redis_client, caches, stale)
+        calls = upstream.calls
+        results = await get_all(caches, n_gets)
+        await asyncio.sleep(0.2)  # let the background refreshes finish
+        report("stale, upstream failing", upstream, calls, results, upstream.calls - calls <= 1 and all(r == RATE for r in results))
+
+        await reset(redis_client, caches)
+        calls = upstream.calls
+        start = perf_counter()
+        results = await get_all(caches, n_gets)
+        elapsed = perf_counter() - start
+        ok = upstream.calls - calls <= 1 and all(isinstance(r, Exception) for r in results) and elapsed < ExchangeRateConfig.REFRESH_LOCK_TTL
+        report("cold, upstream failing", upstream, calls, results, ok)
+        print(f"{'':<24} failed in {elapsed:.2f}s (refresh lock TTL {ExchangeRateConfig.REFRESH_LOCK_TTL}s)")
+    finally:
+        await reset(redis_client, caches)
+        for cache in caches:
+            await cache.close()
+        await redis_client.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 8, int(sys.argv[2]) if len(sys.argv) > 2 else 200))
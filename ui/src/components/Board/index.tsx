@@ -2,9 +2,9 @@ import cloneDeep from "lodash/cloneDeep"
 import { useEffect, useRef, useState } from "react"
 import { boardArray, initialLegalMoves, initialState } from "../../constants/board"
 import { socket } from "../../socket"
-import { BoardState, Castles, Colour, Move, Outcome, PieceInfo, PieceRef, PieceType } from "../../types"
+import { BoardState, Castles, Colour, Move, Outcome, PieceInfo, PieceRef, PieceType, ResyncState } from "../../types"
 import { getAlgebraicNotation, moveToUci, uciToMove } from "../../utils"
-import { isCastles, isEnPassant, isIllegalMove, isPromotion } from "../../utils/board"
+import { fenToState, isCastles, isEnPassant, isIllegalMove, isPromotion } from "../../utils/board"
 import Piece from "../Piece"
 import Square from "./Square"
 import styles from "./board.module.css"
@@ -23,6 +23,7 @@ export default function Board({ colour, turn, setTurn, setOutcome, setWinner, se
   const animating = useRef(false)
   const squareCoords = useRef<Map<string, { x: number; y: number }>>()
   const oppositeColour = useRef(colour === Colour.WHITE ? Colour.BLACK : Colour.WHITE)
+  const lastSeq = useRef(0) // seq number of the last move event applied
 
   const [selectedPiece, setSelectedPiece] = useState<PieceRef>()
   const [state, setState] = useState<(PieceInfo | null)[][]>(initialState)
@@ -107,9 +108,22 @@ export default function Board({ colour, turn, setTurn, setOutcome, setWinner, se
 
   useEffect(() => {
     function onMove(data: BoardState) {
-      if (data.turn == colour && data.move) {
+      if (data.seq !== undefined) {
+        if (data.seq <= lastSeq.current) {
+          // already applied (e.g. duplicate after resync)
+          return
+        }
+        if (data.seq > lastSeq.current + 1) {
+          // missed one or more moves, request full state from server (outcome is still processed below)
+          socket.emit("resync")
+        } else {
+          lastSeq.current = data.seq
+        }
+      }
+
+      if (data.turn == colour && data.move && data.seq === lastSeq.current) {
         // if other player just moved
-        setPrevMove(data.moveStack?.at(-1) ?? "")
+        setPrevMove(data.move)
 
         const move = uciToMove(data.move)
         const newState = cloneDeep(state)
@@ -184,10 +198,22 @@ export default function Board({ colour, turn, setTurn, setOutcome, setWinner, se
       }
     }
 
+    function onResync(data: ResyncState) {
+      lastSeq.current = data.seq
+      setState(fenToState(data.fen))
+      setPrevMove(data.moveStack.at(-1) ?? "")
+      setSelectedPiece(undefined)
+      setLegalMoves(data.legalMoves.map((m) => uciToMove(m)))
+      setTurn(data.turn)
+      setIsCheck(data.isCheck)
+    }
+
     socket.on("move", onMove)
+    socket.on("resync", onResync)
 
     return () => {
       socket.off("move", onMove)
+      socket.off("resync", onResync)
     }
   }, [squareCoords.current, state])
 
@@ -1,6 +1,6 @@
 import { useEffect, useRef, useState } from "react"
 import { socket } from "../../socket"
-import { BoardState, Colour, Outcome, TimerData } from "../../types"
+import { BoardState, Colour, Outcome, ResyncState, TimerData } from "../../types"
 import { millisecondsToTimeFormat } from "../../utils"
 import styles from "./timer.module.css"
 
@@ -29,10 +29,20 @@ export default function Timer({ side, timeControl, outcome }: Readonly<TimerProp
       }
     }
 
+    const onResync = (data: ResyncState) => {
+      setTurn(data.turn)
+      setTimer({
+        white: data.timeRemainingWhite,
+        black: data.timeRemainingBlack,
+      })
+    }
+
     socket.on("move", onMove)
+    socket.on("resync", onResync)
 
     return () => {
       socket.off("move", onMove)
+      socket.off("resync", onResync)
     }
   }, [])
 
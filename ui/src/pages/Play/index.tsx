@@ -5,7 +5,7 @@ import Board from "../../components/Board"
 import ResultModal from "../../components/ResultModal"
 import Timer from "../../components/Timer"
 import { socket } from "../../socket"
-import { Colour, Outcome } from "../../types"
+import { Colour, Outcome, SettlementData } from "../../types"
 import styles from "./play.module.css"
 
 export default function Play() {
@@ -30,6 +30,14 @@ export default function Play() {
       endedRef.current = true
     }
 
+    function onSettlement(data: SettlementData) {
+      if (data.status === "confirmed") {
+        toast.success("Match result settled on-chain")
+      } else if (data.status === "failed") {
+        toast.error("Match result could not be settled on-chain")
+      }
+    }
+
     function onBeforeUnload(event: BeforeUnloadEvent) {
       if (endedRef.current) {
         return
@@ -40,12 +48,14 @@ export default function Play() {
 
     socket.on("drawOffer", onReceiveDrawOffer)
     socket.on("matchEnded", onMatchEnded)
+    socket.on("settlement", onSettlement)
 
     window.addEventListener("beforeunload", onBeforeUnload)
 
     return () => {
       socket.off("drawOffer", onReceiveDrawOffer)
       socket.off("matchEnded", onMatchEnded)
+      socket.off("settlement", onSettlement)
       window.removeEventListener("beforeunload", onBeforeUnload)
     }
   }, [])
@@ -7,3 +7,32 @@ export const socket = io(API_URL, {
   autoConnect: false,
   timeout: 2000,
 })
+
+// the server may batch events sent in quick succession (e.g. move + matchEnded) into a single "events" message of
+// [name, data] pairs, in order. Dispatch each to the listeners registered for it
+socket.on("events", (events: [string, unknown][]) => {
+  for (const [name, data] of events) {
+    for (const listener of socket.listeners(name)) {
+      listener(data)
+    }
+  }
+})
+
+// resumable sessions: keep the resume token for the game in progress, and rejoin the game after a reconnect (the
+// server replies with "resumed", a "resync" of the board and any events missed in the meantime)
+let resumeSession: { gameId: string; token: string } | null = null
+
+socket.on("resumeToken", (data: { gameId: string; token: string }) => {
+  resumeSession = data
+})
+socket.on("resumed", (data: { gameId: string; resumeToken: string }) => {
+  resumeSession = { gameId: data.gameId, token: data.resumeToken }
+})
+socket.on("matchEnded", () => {
+  resumeSession = null
+})
+socket.io.on("reconnect", () => {
+  if (resumeSession) {
+    socket.emit("resume", resumeSession.gameId, resumeSession.token)
+  }
+})
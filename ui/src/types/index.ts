@@ -62,11 +62,22 @@ export type BoardState = {
   enPassant: boolean
   isCheck: boolean
   legalMoves: string[]
-  moveStack?: string[]
+  seq?: number
   timeRemainingWhite?: number
   timeRemainingBlack?: number
 }
 
+export type ResyncState = {
+  seq: number
+  fen: string
+  turn: Colour
+  isCheck: boolean
+  legalMoves: string[]
+  moveStack: string[]
+  timeRemainingWhite: number
+  timeRemainingBlack: number
+}
+
 export interface StartData {
   colour: Colour
   timeRemaining: number
@@ -84,3 +95,8 @@ export interface GameInfo {
   wagerAmount: number
   totalRounds: number
 }
+
+export interface SettlementData {
+  status: "queued" | "submitted" | "confirmed" | "failed"
+  txHash: string | null
+}
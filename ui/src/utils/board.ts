@@ -1,5 +1,31 @@
 import { Colour, Move, PieceInfo, PieceRef, PieceType } from "../types"
 
+/**
+ * Converts the piece placement field of a FEN string to a board state array.
+ *
+ * @param {string} fen The FEN string.
+ * @returns {(PieceInfo | null)[][]} Board state indexed by [rank][file], rank 0 being white's back rank.
+ */
+export function fenToState(fen: string): (PieceInfo | null)[][] {
+  const ranks = fen.split(" ")[0].split("/")
+  const state: (PieceInfo | null)[][] = []
+  for (let i = ranks.length - 1; i >= 0; i--) {
+    const rank: (PieceInfo | null)[] = []
+    for (const c of ranks[i]) {
+      if (c >= "1" && c <= "8") {
+        rank.push(...Array(parseInt(c)).fill(null))
+      } else {
+        rank.push({
+          pieceType: c.toUpperCase() as PieceType,
+          colour: c === c.toUpperCase() ? Colour.WHITE : Colour.BLACK,
+        })
+      }
+    }
+    state.push(rank)
+  }
+  return state
+}
+
 export function isEnPassant(rank_idx: number, file_idx: number, state: (PieceInfo | null)[][], selectedPiece?: PieceRef) {
   return selectedPiece?.pieceType === PieceType.PAWN && state[rank_idx][file_idx] === null && file_idx !== selectedPiece?.file && rank_idx !== selectedPiece?.rank
 }